@@ -1,8 +1,39 @@
 from django.contrib import admin
+from django.utils import timezone
 
+from base.backend.audit_archive import month_start, add_months
 from base.models import State, TransactionType, Transaction, NotificationType, Notification, School, Classroom, Subject
 
 
+
+class PeriodFilter(admin.SimpleListFilter):
+	"""
+	Limits a change list to one month of date_created, this month unless another period is picked, so the list and
+	its count only scan the current partition.
+	"""
+	title = 'period'
+	parameter_name = 'period'
+
+	def lookups(self, request, model_admin):
+		return (('current', 'This month'), ('previous', 'Last month'), ('all', 'All'))
+
+	def queryset(self, request, queryset):
+		period = self.value() or 'current'
+		if period == 'all':
+			return queryset
+		start = month_start(timezone.now())
+		if period == 'previous':
+			start = add_months(start, -1)
+		return queryset.filter(date_created__gte=start, date_created__lt=add_months(start, 1))
+
+	def choices(self, changelist):
+		for lookup, title in self.lookup_choices:
+			yield {
+				'selected': (self.value() or 'current') == lookup,
+				'query_string': changelist.get_query_string({self.parameter_name: lookup}),
+				'display': title,
+			}
+
 @admin.register(State)
 class StateAdmin(admin.ModelAdmin):
 	list_display = ('name', 'description', 'date_modified', 'date_created')
@@ -16,9 +47,12 @@ class TransactionTypeAdmin(admin.ModelAdmin):
 @admin.register(Transaction)
 class TransactionAdmin(admin.ModelAdmin):
 	list_display = (
-		'transaction_type', 'source_ip', 'request', 'response', 'notification_response', 'state', 'date_modified',
-		'date_created')
+		'transaction_type', 'source_ip', 'request', 'response', 'response_code', 'notification_response', 'state',
+		'date_modified', 'date_created')
 	search_fields = ('transaction_type__name', 'source_ip', 'state')
+	list_filter = (PeriodFilter, 'response_code')
+	list_select_related = ('transaction_type', 'state')
+	show_full_result_count = False
 
 @admin.register(NotificationType)
 class NotificationTypeAdmin(admin.ModelAdmin):
@@ -28,8 +62,12 @@ class NotificationTypeAdmin(admin.ModelAdmin):
 @admin.register(Notification)
 class NotificationAdmin(admin.ModelAdmin):
 	list_display = (
-		'notification_type', 'title', 'message', 'destination', 'state', 'date_modified', 'date_created')
+		'notification_type', 'title', 'message', 'destination', 'attempts', 'next_attempt_at', 'state', 'date_modified',
+		'date_created')
 	search_fields = ('notification_type__name', 'title', 'message', 'destination', 'state')
+	list_filter = (PeriodFilter,)
+	list_select_related = ('notification_type', 'state')
+	show_full_result_count = False
 
 @admin.register(School)
 class SchoolAdmin(admin.ModelAdmin):
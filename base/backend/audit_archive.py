@@ -0,0 +1,259 @@
+import datetime
+import gzip
+import json
+import logging
+import os
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction as trx
+from django.utils import timezone
+
+from base.models import State, Transaction, Notification
+
+lgr = logging.getLogger(__name__)
+
+
+def month_start(value):
+    return value.astimezone(datetime.timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(value, months):
+    month = value.month - 1 + months
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1)
+
+
+class AuditArchiver(object):
+    """
+    Keeps the Transaction and Notification tables down to the months still in use.
+    On PostgreSQL both tables are range partitioned by month on date_created: ensure_partitions adds the partitions
+    of the coming months, and archive detaches the partition of every closed month older than AUDIT_RETENTION_MONTHS,
+    writes it to a compressed JSON lines file under AUDIT_ARCHIVE_DIR and then drops it. Rows logged for the month
+    once it is detached land in the default partition and are archived by a later run. Other databases keep plain
+    tables, so archive deletes exactly the rows it wrote out, leaving any that arrived meanwhile for a later run.
+    """
+    MODELS = (Transaction, Notification)
+
+    def __init__(self, archive_dir=None, retention_months=None, chunk_size=None):
+        self.archive_dir = archive_dir or settings.AUDIT_ARCHIVE_DIR
+        self.retention_months = retention_months if retention_months is not None else \
+            settings.AUDIT_RETENTION_MONTHS
+        self.chunk_size = chunk_size or settings.AUDIT_ARCHIVE_CHUNK_SIZE
+
+    @staticmethod
+    def partitioned(model):
+        """
+        @return: Whether the model's table is partitioned.
+        @rtype: bool
+        """
+        if connection.vendor != "postgresql":
+            return False
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass", [model._meta.db_table])
+            return cursor.fetchone() is not None
+
+    @staticmethod
+    def partition_name(model, start):
+        return "%s_p%s" % (model._meta.db_table, start.strftime("%Y_%m"))
+
+    def partitions(self, model):
+        """
+        @return: The names of the model's partitions.
+        @rtype: set
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                "WHERE pg_inherits.inhparent = %s::regclass", [model._meta.db_table])
+            return {row[0] for row in cursor.fetchall()}
+
+    def detached_partitions(self, model):
+        """
+        Lists monthly partitions that were detached but not dropped, e.g. because writing their archive failed.
+        @return: The start of each detached partition's month, oldest first.
+        @rtype: list
+        """
+        table = model._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT relname FROM pg_class WHERE relkind = 'r' AND NOT relispartition AND relname LIKE %s",
+                [table.replace("_", "\\_") + "\\_p%"])
+            names = [row[0] for row in cursor.fetchall()]
+        starts = []
+        for name in names:
+            try:
+                start = datetime.datetime.strptime(name[len(table) + 2:], "%Y_%m")
+            except ValueError:
+                continue
+            starts.append(start.replace(tzinfo=datetime.timezone.utc))
+        return sorted(starts)
+
+    def ensure_partitions(self, months_ahead=None):
+        """
+        Creates the monthly partitions from this month up to months_ahead months ahead. Rows that already landed in
+        the default partition for one of those months are moved into the new partition.
+        @param months_ahead: Defaults to AUDIT_PARTITION_MONTHS_AHEAD.
+        @type months_ahead: int | None
+        @return: The partitions created.
+        @rtype: list
+        """
+        months_ahead = months_ahead if months_ahead is not None else settings.AUDIT_PARTITION_MONTHS_AHEAD
+        created = []
+        for model in self.MODELS:
+            if not self.partitioned(model):
+                continue
+            table = model._meta.db_table
+            existing = self.partitions(model)
+            start = month_start(timezone.now())
+            for _ in range(months_ahead + 1):
+                end = add_months(start, 1)
+                name = self.partition_name(model, start)
+                if name not in existing:
+                    with trx.atomic(), connection.cursor() as cursor:
+                        # Attaching checks the default partition holds no rows for the month, so move them first
+                        cursor.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)" % (name, table))
+                        cursor.execute(
+                            "WITH moved AS (DELETE FROM %s_default WHERE date_created >= %%s AND date_created < %%s "
+                            "RETURNING *) INSERT INTO %s SELECT * FROM moved" % (table, name), [start, end])
+                        cursor.execute("ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM ('%s') TO ('%s')" % (
+                            table, name, start.isoformat(), end.isoformat()))
+                    created.append(name)
+                start = end
+        return created
+
+    def closed_periods(self, model):
+        """
+        Lists the months of the model's rows that are older than the retention period.
+        @return: The (start, end) of each month, oldest first.
+        @rtype: list
+        """
+        cutoff = add_months(month_start(timezone.now()), -self.retention_months)
+        first = model.objects.filter(date_created__lt=cutoff).order_by("date_created").values_list(
+            "date_created", flat=True).first()
+        periods = []
+        if first is None:
+            return periods
+        start = month_start(first)
+        while start < cutoff:
+            periods.append((start, add_months(start, 1)))
+            start = add_months(start, 1)
+        return periods
+
+    def archive(self):
+        """
+        Archives and removes every closed month of the Transaction and Notification tables.
+        @return: The rows archived and the file written for each month, per table.
+        @rtype: dict
+        """
+        archived = {}
+        for model in self.MODELS:
+            table = model._meta.db_table
+            archived[table] = []
+            partitioned = self.partitioned(model)
+            partitions = self.partitions(model) if partitioned else set()
+            for start in self.detached_partitions(model) if partitioned else []:
+                try:
+                    path, rows = self.archive_partition(model, start)
+                    archived[table].append({"period": start.strftime("%Y-%m"), "rows": rows, "file": path})
+                except Exception as e:
+                    lgr.exception("AuditArchiver archive %s %s exception: %s" % (table, start.strftime("%Y-%m"), e))
+            for start, end in self.closed_periods(model):
+                queryset = model.objects.filter(date_created__gte=start, date_created__lt=end)
+                if model is Notification and queryset.filter(state=State.pending()).exists():
+                    lgr.warning("AuditArchiver - %s %s still has pending notifications, not archived" % (
+                        table, start.strftime("%Y-%m")))
+                    continue
+                try:
+                    if self.partition_name(model, start) in partitions:
+                        self.detach_partition(model, start)
+                        path, rows = self.archive_partition(model, start)
+                    elif not queryset.exists():
+                        continue
+                    else:
+                        path, rows, ids = self.write(model, start, self.rows(model, queryset))
+                        self.delete(model, ids)
+                    archived[table].append({"period": start.strftime("%Y-%m"), "rows": rows, "file": path})
+                except Exception as e:
+                    lgr.exception("AuditArchiver archive %s %s exception: %s" % (table, start.strftime("%Y-%m"), e))
+        return archived
+
+    def rows(self, model, queryset):
+        fields = [field.attname for field in model._meta.concrete_fields]
+        return queryset.order_by("date_created").values(*fields).iterator(chunk_size=self.chunk_size)
+
+    def partition_rows(self, model, start):
+        """
+        Reads a detached partition in date_created order, converting each column as the model field would.
+        """
+        fields = model._meta.concrete_fields
+        with connection.chunked_cursor() as cursor:
+            cursor.execute("SELECT %s FROM %s ORDER BY date_created" % (
+                ", ".join(connection.ops.quote_name(field.column) for field in fields),
+                self.partition_name(model, start)))
+            while True:
+                chunk = cursor.fetchmany(self.chunk_size)
+                if not chunk:
+                    return
+                for values in chunk:
+                    row = {}
+                    for field, value in zip(fields, values):
+                        if hasattr(field, "from_db_value"):
+                            value = field.from_db_value(value, None, connection)
+                        row[field.attname] = value
+                    yield row
+
+    def archive_partition(self, model, start):
+        """
+        Writes a detached partition out and drops it. Reading runs in one transaction so the server side cursor
+        stays open.
+        @return: The path of the archive and the number of rows in it.
+        @rtype: tuple
+        """
+        with trx.atomic():
+            path, rows = self.write(model, start, self.partition_rows(model, start))[:2]
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TABLE %s" % self.partition_name(model, start))
+        return path, rows
+
+    def write(self, model, start, rows):
+        """
+        Writes one month of rows to <AUDIT_ARCHIVE_DIR>/<table>/<YYYY-MM>.jsonl.gz. The file is only put in place
+        once it is complete and synced, so a month is never removed without its archive.
+        @param rows: The rows as dicts of field attnames to values, in date_created order.
+        @type rows: iterator
+        @return: The path of the archive, the number of rows in it and their ids.
+        @rtype: tuple
+        """
+        directory = os.path.join(self.archive_dir, model._meta.db_table)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "%s.jsonl.gz" % start.strftime("%Y-%m"))
+        if os.path.exists(path):
+            # A month archived before got more rows later, e.g. flushed from a journal; keep both files
+            path = os.path.join(directory, "%s-%s.jsonl.gz" % (
+                start.strftime("%Y-%m"), timezone.now().strftime("%Y%m%d%H%M%S")))
+        ids = []
+        with open(path + ".partial", "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as f:
+            for row in rows:
+                f.write((json.dumps(row, cls=DjangoJSONEncoder) + "\n").encode())
+                ids.append(row["id"])
+            f.close()
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(path + ".partial", path)
+        return path, len(ids), ids
+
+    def detach_partition(self, model, start):
+        """
+        Detaches a month's partition so no row can be added to or changed in it while it is archived.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute("ALTER TABLE %s DETACH PARTITION %s" % (
+                model._meta.db_table, self.partition_name(model, start)))
+
+    def delete(self, model, ids):
+        """
+        Deletes the rows with the given ids, which were written out, in chunks.
+        """
+        for offset in range(0, len(ids), self.chunk_size):
+            model.objects.filter(id__in=ids[offset:offset + self.chunk_size]).delete()
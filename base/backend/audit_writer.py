@@ -0,0 +1,274 @@
+import atexit
+import datetime
+import glob
+import json
+import logging
+import os
+import re
+import threading
+import uuid
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from base.models import Transaction
+
+lgr = logging.getLogger(__name__)
+
+
+class AuditWriter(object):
+    """
+    Buffers transaction log writes in memory and flushes them to the database in batches.
+    Logging, completing or failing a transaction only records it in the buffer. The buffer is written with one upsert
+    per batch once AUDIT_BATCH_SIZE transactions are waiting, or AUDIT_FLUSH_SECONDS after the first one arrived, and
+    at exit. Every buffered change is also appended to a per process journal in AUDIT_JOURNAL_DIR, which any process's
+    next flush replays if the process died before it could write them, so a crash does not lose the audit trail.
+    Each flush starts a new journal file for the changes that arrive while it writes, and deletes the files it took
+    over only once their transactions are stored, so a busy process never has a journal that grows without bound.
+    """
+    FIELDS = (
+        "state", "response", "response_code", "notification_response", "reference", "source_ip", "request",
+        "date_modified")
+    JOURNAL_NAME = re.compile(r"^audit-(\d+)(?:-(\d+))?\.jsonl$")
+
+    def __init__(self, batch_size=None, flush_seconds=None, journal_dir=None):
+        self.batch_size = batch_size or settings.AUDIT_BATCH_SIZE
+        self.flush_seconds = flush_seconds if flush_seconds is not None else settings.AUDIT_FLUSH_SECONDS
+        self.journal_dir = journal_dir if journal_dir is not None else settings.AUDIT_JOURNAL_DIR
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._journal = None
+        self._generation = 0
+        self._retired = []
+
+    def write(self, transaction):
+        """
+        Queues the current values of a transaction to be written. Writing the same transaction again before it is
+        flushed only keeps its latest values.
+        @param transaction: The transaction to write, new or already stored.
+        @type transaction: Transaction
+        @return: The transaction.
+        @rtype: Transaction
+        """
+        if not settings.AUDIT_BUFFERED:
+            self._save([transaction])
+            return transaction
+        self._start()
+        with self._lock:
+            self._pending[transaction.id] = transaction
+            self._append_journal(transaction)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wakeup.set()
+        return transaction
+
+    def flush(self):
+        """
+        Writes everything buffered, and anything left in the journals of dead processes, to the database.
+        @return: The number of transactions written.
+        @rtype: int
+        """
+        with self._flush_lock:
+            # Workers are restarted at any time, so their journals are looked for on every flush, not only the first
+            written = self.recover()
+            with self._lock:
+                transactions = list(self._pending.values())
+                self._pending = {}
+                if transactions:
+                    self._rotate_journal()
+                journals, self._retired = self._retired, []
+            if not transactions:
+                self._remove_journals(journals)
+                return written
+            try:
+                self._save(transactions)
+            except Exception as e:
+                lgr.exception("AuditWriter flush exception: %s" % e)
+                with self._lock:
+                    for transaction in transactions:
+                        self._pending.setdefault(transaction.id, transaction)
+                    # Kept until a later flush stores these transactions
+                    self._retired = journals + self._retired
+                return written
+            self._remove_journals(journals)
+            return written + len(transactions)
+
+    def recover(self):
+        """
+        Replays the journals left behind by processes that exited without flushing.
+        @return: The number of transactions recovered.
+        @rtype: int
+        """
+        if not self.journal_dir:
+            return 0
+        recovered = 0
+        for pid, paths in self._journals().items():
+            if pid == os.getpid() or self._alive(pid):
+                continue
+            try:
+                transactions = self._load(paths)
+                if transactions:
+                    self._save(list(transactions.values()))
+                self._remove_journals(paths)
+                recovered += len(transactions)
+            except Exception as e:
+                lgr.exception("AuditWriter recover %s exception: %s" % (pid, e))
+        if recovered:
+            lgr.warning("AuditWriter - recovered %s transactions from journals" % recovered)
+        return recovered
+
+    def _journals(self):
+        """
+        Lists the journal files in AUDIT_JOURNAL_DIR.
+        @return: The paths of each process's journal files, oldest generation first, by pid.
+        @rtype: dict
+        """
+        journals = {}
+        for path in glob.glob(os.path.join(self.journal_dir, "audit-*.jsonl")):
+            match = self.JOURNAL_NAME.match(os.path.basename(path))
+            if match:
+                journals.setdefault(int(match.group(1)), []).append((int(match.group(2) or -1), path))
+        return {pid: [path for generation, path in sorted(paths)] for pid, paths in journals.items()}
+
+    def _load(self, paths):
+        """
+        Reads the latest values of each transaction in a process's journal files, given oldest first.
+        @rtype: dict
+        """
+        transactions = {}
+        for path in paths:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        transaction = self.decode(line)
+                    except Exception:
+                        # The last line of a journal is cut short if its process died while writing it
+                        lgr.warning("AuditWriter - skipping a partial line in %s" % path)
+                        continue
+                    transactions[transaction.id] = transaction
+        return transactions
+
+    @staticmethod
+    def encode(transaction):
+        values = {}
+        for field in Transaction._meta.concrete_fields:
+            value = getattr(transaction, field.attname)
+            if isinstance(value, uuid.UUID):
+                value = str(value)
+            elif isinstance(value, datetime.datetime):
+                value = value.isoformat()
+            values[field.attname] = value
+        return json.dumps(values)
+
+    @staticmethod
+    def decode(line):
+        values = json.loads(line)
+        for field in Transaction._meta.concrete_fields:
+            if values.get(field.attname) is not None:
+                values[field.attname] = field.to_python(values[field.attname])
+        return Transaction(**values)
+
+    def _save(self, transactions):
+        """
+        Inserts the new transactions and updates the stored ones in one statement per batch.
+        """
+        # On PostgreSQL the table is partitioned by date_created, which is part of its primary key
+        unique_fields = ["id", "date_created"] if connection.vendor == "postgresql" else ["id"]
+        Transaction.objects.bulk_create(
+            transactions, batch_size=self.batch_size, update_conflicts=True, unique_fields=unique_fields,
+            update_fields=list(self.FIELDS))
+
+    def _start(self):
+        """
+        Starts the flushing thread in this process. Forked workers get their own thread and journal.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._pending = {}
+            self._journal = None
+            self._generation = 0
+            self._retired = []
+            if self.journal_dir:
+                try:
+                    os.makedirs(self.journal_dir, exist_ok=True)
+                    # Left behind by an earlier process that had the same pid
+                    self._retired = self._journals().get(self._pid, [])
+                    self._pending = self._load(self._retired)
+                    self._generation = len(self._retired)
+                    self._open_journal()
+                except Exception as e:
+                    lgr.exception("AuditWriter journal exception, continuing without one: %s" % e)
+            threading.Thread(target=self._run, name="audit-writer", daemon=True).start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            if self._pending:
+                self.flush()
+                close_old_connections()
+
+    def _append_journal(self, transaction):
+        if self._journal is None:
+            return
+        try:
+            self._journal.write(self.encode(transaction) + "\n")
+            self._journal.flush()
+            if settings.AUDIT_JOURNAL_FSYNC:
+                os.fsync(self._journal.fileno())
+        except Exception as e:
+            lgr.exception("AuditWriter journal write exception: %s" % e)
+
+    def _open_journal(self):
+        path = os.path.join(self.journal_dir, "audit-%s-%s.jsonl" % (self._pid, self._generation))
+        while os.path.exists(path):
+            self._generation += 1
+            path = os.path.join(self.journal_dir, "audit-%s-%s.jsonl" % (self._pid, self._generation))
+        self._journal = open(path, "a")
+
+    def _rotate_journal(self):
+        """
+        Moves new writes on to the next journal file, retiring the current one until its transactions are stored.
+        Called with the lock held.
+        """
+        if self._journal is None:
+            return
+        try:
+            self._journal.close()
+            self._retired.append(self._journal.name)
+            self._generation += 1
+            self._open_journal()
+        except Exception as e:
+            lgr.exception("AuditWriter journal rotate exception, continuing without one: %s" % e)
+            self._journal = None
+
+    @staticmethod
+    def _remove_journals(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                lgr.exception("AuditWriter journal remove %s exception: %s" % (path, e))
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+
+audit_writer = AuditWriter()
@@ -0,0 +1,189 @@
+import logging
+import platform
+import time
+
+import django
+from django.db import connection, transaction as trx
+from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from base.models import State, School, state_registry, transaction_type_registry, notification_type_registry
+from books.backend.search import book_search
+from books.models import Book
+from identities.backend.identity_cache import identity_cache
+from identities.models import Identity
+from users.backend.search import user_search
+from users.models import User
+
+lgr = logging.getLogger(__name__)
+
+
+class EndpointBenchmark(object):
+    """
+    Drives the real URL routes through Django's test client against a generated school (see SyntheticSchoolData) and
+    reports the latency percentiles and query counts of each endpoint.
+    A run happens inside one database transaction that is rolled back at the end, with audit logging unbuffered so
+    it joins that transaction, so the identities, loans and audit rows it creates are not left behind. The on-commit
+    work of each request is run as the request ends, as it would be after a commit, and the caches it filled are
+    dropped once the run is rolled back.
+    """
+    ENDPOINTS = (
+        "filter_books", "search_books", "filter_users", "search_users", "login", "issue_book", "return_book",
+        "get_user_borrowing_history")
+
+    def __init__(self, school, password="benchmark", iterations=50, warmup=5):
+        self.school = school
+        self.password = password
+        self.iterations = iterations
+        self.warmup = warmup
+        self.client = Client()
+        self.admin = User.objects.filter(school=school, role__name="Admin", state=State.active()).first()
+        self.students = list(User.objects.filter(
+            school=school, role__name="Student", state=State.active()).values_list("id", flat=True)[:500])
+        if not self.admin or not self.students:
+            raise Exception("School %s has no generated admin or students" % school.code)
+        self.token = None
+        self._tokens = []
+        self._books = iter(Book.objects.filter(school=school, state=State.idle()).values_list("id", flat=True))
+        self._issued = []
+
+    def run(self, endpoints=None):
+        """
+        Benchmarks the given endpoints.
+        @param endpoints: The endpoint names, defaults to ENDPOINTS.
+        @type endpoints: list | None
+        @return: The run's environment and the stats of each endpoint.
+        @rtype: dict
+        """
+        for endpoint in endpoints or self.ENDPOINTS:
+            if endpoint not in self.ENDPOINTS:
+                raise Exception("Unknown endpoint %s" % endpoint)
+        # Registries are not warmed inside the run's transaction, so warm them first as a running worker would be
+        for registry in (state_registry, transaction_type_registry, notification_type_registry):
+            registry.warm()
+        try:
+            with override_settings(AUDIT_BUFFERED=False), trx.atomic():
+                try:
+                    identity = Identity.objects.create(user=self.admin, state=State.active(), source_ip="127.0.0.1")
+                    self.token = str(identity.token)
+                    self._tokens.append(self.token)
+                    results = {endpoint: self._measure(endpoint) for endpoint in endpoints or self.ENDPOINTS}
+                finally:
+                    trx.set_rollback(True)
+        finally:
+            self.reset_caches()
+        return {
+            "started_at": timezone.now().isoformat(),
+            "database": connection.vendor,
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "school": self.school.code,
+            "iterations": self.iterations,
+            "endpoints": results,
+        }
+
+    def _measure(self, endpoint):
+        call = getattr(self, "_%s" % endpoint)
+        for _ in range(self.warmup):
+            with TestCase.captureOnCommitCallbacks(execute=True):
+                call()
+        timings, queries, errors = [], [], 0
+        for _ in range(self.iterations):
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                with TestCase.captureOnCommitCallbacks(execute=True):
+                    response = call()
+                timings.append((time.perf_counter() - start) * 1000)
+            queries.append(len(captured.captured_queries))
+            if response.status_code != 200 or response.json().get("code") != "100.000.000":
+                errors += 1
+        return self.summarise(timings, queries, errors)
+
+    def reset_caches(self):
+        """
+        Drops what the rolled back run left in the caches: the admin's tokens, including those the run issued, the
+        school's search indexes and any types first created during the run.
+        """
+        identity_cache.discard_user(self.admin)
+        if self._tokens:
+            identity_cache.discard(*self._tokens)
+        book_search.invalidate(self.school.id)
+        user_search.invalidate(self.school.id)
+        for registry in (state_registry, transaction_type_registry, notification_type_registry):
+            registry.clear()
+        self.token = None
+        self._tokens = []
+
+    @staticmethod
+    def percentile(values, percent):
+        values = sorted(values)
+        if not values:
+            return None
+        rank = (len(values) - 1) * percent / 100.0
+        low = int(rank)
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (values[high] - values[low]) * (rank - low)
+
+    def summarise(self, timings, queries, errors):
+        return {
+            "p50_ms": round(self.percentile(timings, 50), 3),
+            "p95_ms": round(self.percentile(timings, 95), 3),
+            "p99_ms": round(self.percentile(timings, 99), 3),
+            "mean_ms": round(sum(timings) / len(timings), 3),
+            "max_ms": round(max(timings), 3),
+            "queries_mean": round(sum(queries) / len(queries), 2),
+            "queries_max": max(queries),
+            "errors": errors,
+        }
+
+    def _post(self, url_name, **data):
+        data.setdefault("token", self.token)
+        return self.client.post(reverse(url_name), data, content_type="application/json")
+
+    def _student(self):
+        return str(self.students[len(self._issued) % len(self.students)])
+
+    def _filter_books(self):
+        return self._post("books:filter-books", school_id=str(self.school.id))
+
+    def _search_books(self):
+        return self._post("books:search-books", school_id=str(self.school.id), search_word="riv")
+
+    def _filter_users(self):
+        return self._post("users:filter-users", school_id=str(self.school.id))
+
+    def _search_users(self):
+        return self._post("users:search-users", school_id=str(self.school.id), search_word="wa")
+
+    def _login(self):
+        response = self._post("identities:login", token="", username=self.admin.username, password=self.password)
+        if response.status_code == 200 and response.json().get("data", {}).get("token"):
+            self._tokens.append(response.json()["data"]["token"])
+        return response
+
+    def _issue_book(self):
+        book_id = str(next(self._books))
+        self._issued.append(book_id)
+        return self._post("books:issue-book", user_id=self._student(), book_id=book_id)
+
+    def _return_book(self):
+        if not self._issued:
+            self._issue_book()
+        return self._post("books:return-book", book_id=self._issued.pop(0))
+
+    def _get_user_borrowing_history(self):
+        return self._post("books:user-borrowing-history", user_id=self._student())
+
+    @classmethod
+    def find_school(cls, code=None):
+        """
+        Picks the school to benchmark.
+        @param code: The school's code, defaults to the most recent generated school.
+        @type code: str | None
+        @rtype: School | None
+        """
+        if code:
+            return School.objects.filter(code=code).first()
+        return School.objects.filter(code__startswith="bench").order_by("-date_created").first()
@@ -0,0 +1,57 @@
+import logging
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from base.backend.query_metrics import QueryRecorder, query_budget, query_metrics
+
+lgr = logging.getLogger(__name__)
+
+
+class QueryMetricsMiddleware(object):
+    """
+    Records the number of SQL queries, SQL time, Python time and response size of every request against the resolved
+    URL name of its view. The stats are added to query_metrics and attached to the response as query_stats so tests
+    can hold a view to its budget in QUERY_BUDGETS.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, "QUERY_METRICS_ENABLED", True)
+
+    def __call__(self, request):
+        if not self.enabled:
+            return self.get_response(request)
+        recorder = QueryRecorder(
+            slow_seconds=getattr(settings, "QUERY_SLOW_SECONDS", None),
+            record_shapes=getattr(settings, "QUERY_SHAPES_RECORDED", False))
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - start
+        try:
+            resolver_match = getattr(request, "resolver_match", None)
+            view_name = resolver_match.view_name if resolver_match else "unresolved"
+            budget = query_budget(view_name)
+            stats = {
+                "view": view_name,
+                "queries": recorder.count,
+                "sql_seconds": recorder.seconds,
+                "python_seconds": max(elapsed - recorder.seconds, 0.0),
+                "response_bytes": None if response.streaming else len(response.content),
+                "budget": budget,
+                "over_budget": budget is not None and recorder.count > budget,
+            }
+            if stats["over_budget"]:
+                lgr.warning("%s ran %s queries, over its budget of %s" % (view_name, recorder.count, budget))
+            query_metrics.record(view_name, stats)
+            if recorder.shapes:
+                query_metrics.record_shapes(view_name, recorder.shapes)
+            response.query_stats = stats
+        except Exception as e:
+            lgr.exception("QueryMetricsMiddleware exception: %s" % e)
+        return response
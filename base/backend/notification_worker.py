@@ -0,0 +1,119 @@
+import json
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction as trx
+from django.utils import timezone
+
+from base.backend.services import NotificationService
+from base.models import State, Notification
+from utils.notification_bus import notification_bus, decode_files
+
+lgr = logging.getLogger(__name__)
+
+
+class NotificationWorker(object):
+    """
+    Drains the notification outbox. Pending notifications are leased in batches, sent to the bus over the client's
+    connection pool and marked Sent, retried with exponential backoff, or marked Failed after
+    NOTIFICATION_MAX_ATTEMPTS attempts. Leases that are never settled (e.g. the worker died) expire after
+    NOTIFICATION_LEASE_SECONDS and the notifications are picked up again.
+    """
+    MESSAGE_TYPES = {"SMS": "1", "EMAIL": "2"}
+
+    def __init__(self, batch_size=None, threads=None, client=None):
+        self.batch_size = batch_size or settings.NOTIFICATION_BATCH_SIZE
+        self.threads = threads or settings.NOTIFICATION_WORKER_THREADS
+        self.client = client or notification_bus
+
+    def claim(self):
+        """
+        Leases the next batch of due notifications to this worker.
+        @return: The leased notifications.
+        @rtype: list
+        """
+        now = timezone.now()
+        with trx.atomic():
+            queryset = Notification.objects.filter(state=State.pending(), next_attempt_at__lte=now) \
+                .select_related("notification_type").order_by("next_attempt_at")
+            if connection.features.has_select_for_update_skip_locked:
+                queryset = queryset.select_for_update(skip_locked=True, of=("self",))
+            notifications = list(queryset[:self.batch_size])
+            if notifications:
+                Notification.objects.filter(id__in=[n.id for n in notifications]).update(
+                    next_attempt_at=now + timedelta(seconds=settings.NOTIFICATION_LEASE_SECONDS))
+        return notifications
+
+    def run_once(self):
+        """
+        Claims and dispatches one batch of notifications.
+        @return: The number of notifications processed.
+        @rtype: int
+        """
+        notifications = self.claim()
+        if not notifications:
+            return 0
+        results = self.client.send_many([self.payload(n) for n in notifications], threads=self.threads)
+        for notification, (confirmation_code, error) in zip(notifications, results):
+            if error is None:
+                self._mark_sent(notification, confirmation_code)
+            else:
+                lgr.warning("NotificationWorker - notification %s not sent: %s" % (notification.id, error))
+                self._mark_retry(notification, error)
+        return len(notifications)
+
+    def run_forever(self, interval=None):
+        """
+        Keeps draining the outbox, sleeping for the given interval whenever it is empty.
+        @param interval: Seconds to sleep when there is nothing to send.
+        @type interval: int | float
+        """
+        interval = interval if interval is not None else settings.NOTIFICATION_POLL_INTERVAL_SECONDS
+        while True:
+            try:
+                if self.run_once():
+                    continue
+            except Exception as e:
+                lgr.exception("NotificationWorker run_forever exception: %s" % e)
+            time.sleep(interval)
+
+    def payload(self, notification):
+        """
+        Rebuilds the bus message for a queued notification.
+        @param notification: The queued notification.
+        @type notification: Notification
+        @return: The notification detail as built by create_notification_detail, with its files if it has any.
+        @rtype: dict
+        """
+        payload = {
+            "destination": notification.destination,
+            "message_type": self.MESSAGE_TYPES.get(notification.notification_type.name, "3"),
+            "lang": "en",
+            "message_code": notification.title,
+            "replace_tags": json.loads(notification.message or "{}")
+        }
+        if notification.attachments:
+            payload["files"] = decode_files(notification.attachments)
+        return payload
+
+    @staticmethod
+    def _mark_sent(notification, confirmation_code):
+        # The transaction it was sent against may still be waiting in the audit writer's buffer, so the bus
+        # confirmation is kept on the notification alone
+        NotificationService().update(
+            pk=notification.id, state=State.sent(), attempts=notification.attempts + 1, next_attempt_at=None,
+            response=confirmation_code)
+
+    @staticmethod
+    def _mark_retry(notification, error):
+        attempts = notification.attempts + 1
+        if attempts >= settings.NOTIFICATION_MAX_ATTEMPTS:
+            NotificationService().update(
+                pk=notification.id, state=State.failed(), attempts=attempts, next_attempt_at=None, response=str(error))
+            return
+        backoff = settings.NOTIFICATION_RETRY_BACKOFF_SECONDS * (2 ** (attempts - 1))
+        NotificationService().update(
+            pk=notification.id, attempts=attempts, response=str(error),
+            next_attempt_at=timezone.now() + timedelta(seconds=backoff))
@@ -0,0 +1,249 @@
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+
+from django.conf import settings
+
+lgr = logging.getLogger(__name__)
+
+
+SQL_SUBQUERY = re.compile(r"\(\s*SELECT\b", re.I)
+SQL_CLAUSE = re.compile(r"\b(FROM|WHERE|GROUP BY|HAVING|ORDER BY|LIMIT|OFFSET|SET|RETURNING)\b", re.I)
+SQL_TARGET = re.compile(r'^\s*(?:SELECT\b.*?\bFROM|UPDATE|DELETE\s+FROM)\s+"(\w+)"', re.I | re.S)
+SQL_COMPARISON = re.compile(r'"(\w+)"\."(\w+)"\s*(NOT\s+)?(=|<=|>=|<|>|IN\b|IS\b|BETWEEN\b|LIKE\b|ILIKE\b|GLOB\b)', re.I)
+SQL_ORDERING = re.compile(r'^"(\w+)"\."(\w+)"(?:\s+(ASC|DESC))?', re.I)
+
+
+def _mask_subqueries(sql):
+    """
+    Blanks out the parenthesised subqueries of a statement so only its own clauses are left.
+    """
+    while True:
+        match = SQL_SUBQUERY.search(sql)
+        if not match:
+            return sql
+        depth, end = 0, len(sql)
+        for position in range(match.start(), len(sql)):
+            if sql[position] == "(":
+                depth += 1
+            elif sql[position] == ")":
+                depth -= 1
+                if depth == 0:
+                    end = position + 1
+                    break
+        sql = sql[:match.start()] + "(?)" + sql[end:]
+
+
+def query_shape(sql):
+    """
+    Works out the shape of a statement Django generated: the columns of its table it matches exactly, those it
+    matches by range and those it orders by.
+    Columns only matched with LIKE or compared against other tables are left out, as no btree index can serve them,
+    and so is the ordering of a statement without a LIMIT.
+    @param sql: The statement, with placeholders for its parameters.
+    @type sql: str
+    @return: The table, the columns matched exactly and by range, each sorted by name, and the ordering columns
+    (prefixed with "-" when descending) in order, or None if the statement neither filters nor orders its table.
+    @rtype: tuple | None
+    """
+    sql = _mask_subqueries(sql)
+    target = SQL_TARGET.match(sql)
+    if not target:
+        return None
+    table = target.group(1)
+    clauses = {}
+    matches = list(SQL_CLAUSE.finditer(sql))
+    for match, following in zip(matches, matches[1:] + [None]):
+        clauses.setdefault(match.group(1).upper(), sql[match.end():following.start() if following else len(sql)])
+    ordering = []
+    # Without a LIMIT the database sorts whatever the filters return, so the ordering only counts for top-N queries
+    for term in clauses.get("ORDER BY", "").split(",") if "LIMIT" in clauses else ():
+        match = SQL_ORDERING.match(term.strip())
+        # An index cannot serve the rest of an ordering once it moves on to another table or an expression
+        if not match or match.group(1) != table:
+            break
+        ordering.append(("-" if (match.group(3) or "").upper() == "DESC" else "") + match.group(2))
+    equal, ranged = set(), set()
+    for match in SQL_COMPARISON.finditer(clauses.get("WHERE", "")):
+        operator = match.group(4).upper()
+        if match.group(1) != table or operator in ("LIKE", "ILIKE", "GLOB"):
+            continue
+        if operator in ("=", "IN", "IS") and not match.group(3):
+            equal.add(match.group(2))
+        else:
+            ranged.add(match.group(2))
+    # Keyset pagination compares the ordering columns, which the ordering itself serves
+    ordered = {column.lstrip("-") for column in ordering}
+    equal, ranged = equal - ordered, ranged - ordered - equal
+    if not equal and not ranged and not ordering:
+        return None
+    return table, tuple(sorted(equal)), tuple(sorted(ranged)), tuple(ordering)
+
+
+class QueryRecorder(object):
+    """
+    Database execute wrapper counting and timing the queries run while serving one request.
+    Queries slower than QUERY_SLOW_SECONDS are logged along with the line of project code that issued them. With
+    record_shapes, the shape of every query is kept in shapes for check_hot_query_indexes.
+    """
+
+    def __init__(self, slow_seconds=None, record_shapes=False):
+        self.slow_seconds = slow_seconds
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = set() if record_shapes else None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.count += 1
+            self.seconds += elapsed
+            if self.shapes is not None:
+                shape = query_shape(sql)
+                if shape:
+                    self.shapes.add(shape)
+            if self.slow_seconds is not None and elapsed >= self.slow_seconds:
+                lgr.warning("Slow query (%.1f ms) from %s: %s" % (elapsed * 1000, self.origin(), sql))
+
+    @staticmethod
+    def origin():
+        """
+        Finds the line of project code that issued the current query.
+        @return: The file, line and function of the innermost project frame, or "unknown".
+        @rtype: str
+        """
+        base_dir = str(settings.BASE_DIR)
+        for frame in reversed(traceback.extract_stack()[:-2]):
+            if frame.filename.startswith(base_dir) and "site-packages" not in frame.filename \
+                    and frame.filename != __file__:
+                return "%s:%s in %s" % (os.path.relpath(frame.filename, base_dir), frame.lineno, frame.name)
+        return "unknown"
+
+
+class QueryMetrics(object):
+    """
+    Per view totals of requests, queries, SQL time, Python time and response bytes for this process, rendered in the
+    Prometheus text format. Views are labelled with their resolved URL name, e.g. books:issue-book.
+    """
+    COUNTERS = (
+        ("requests_total", "Requests served.", "counter"),
+        ("sql_queries_total", "SQL queries run.", "counter"),
+        ("sql_seconds_total", "Time spent running SQL queries.", "counter"),
+        ("python_seconds_total", "Time spent serving requests outside SQL queries.", "counter"),
+        ("response_bytes_total", "Response body bytes sent.", "counter"),
+        ("query_budget_exceeded_total", "Requests that ran more queries than the view's budget.", "counter"),
+        ("sql_queries_max", "Most SQL queries run by a single request.", "gauge"),
+    )
+    PREFIX = "school_management"
+
+    def __init__(self):
+        self._views = {}
+        self._shapes = {}
+        self._lock = threading.Lock()
+
+    def record(self, view_name, stats):
+        """
+        Adds a served request to the totals of its view.
+        @param view_name: The resolved URL name of the view.
+        @type view_name: str
+        @param stats: The request's stats as built by QueryMetricsMiddleware.
+        @type stats: dict
+        """
+        with self._lock:
+            totals = self._views.setdefault(view_name, {name: 0 for name, help_text, kind in self.COUNTERS})
+            totals["requests_total"] += 1
+            totals["sql_queries_total"] += stats["queries"]
+            totals["sql_seconds_total"] += stats["sql_seconds"]
+            totals["python_seconds_total"] += stats["python_seconds"]
+            totals["response_bytes_total"] += stats["response_bytes"] or 0
+            totals["query_budget_exceeded_total"] += 1 if stats["over_budget"] else 0
+            totals["sql_queries_max"] = max(totals["sql_queries_max"], stats["queries"])
+
+    def record_shapes(self, view_name, shapes):
+        """
+        Notes the query shapes a view was seen to run.
+        @param view_name: The resolved URL name of the view.
+        @type view_name: str
+        @param shapes: The shapes recorded by the request's QueryRecorder.
+        @type shapes: set
+        """
+        with self._lock:
+            for shape in shapes:
+                self._shapes.setdefault(shape, set()).add(view_name)
+
+    def shapes(self):
+        """
+        @return: The names of the views that ran each recorded query shape, keyed by shape.
+        @rtype: dict
+        """
+        with self._lock:
+            return {shape: set(view_names) for shape, view_names in self._shapes.items()}
+
+    def snapshot(self):
+        """
+        @return: A copy of the totals, keyed by view name.
+        @rtype: dict
+        """
+        with self._lock:
+            return {view_name: dict(totals) for view_name, totals in self._views.items()}
+
+    def reset(self):
+        with self._lock:
+            self._views = {}
+            self._shapes = {}
+
+    def render(self):
+        """
+        Renders the totals in the Prometheus text exposition format.
+        @return: The metrics text.
+        @rtype: str
+        """
+        views = self.snapshot()
+        lines = []
+        for name, help_text, kind in self.COUNTERS:
+            metric = "%s_%s" % (self.PREFIX, name)
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s %s" % (metric, kind))
+            for view_name in sorted(views):
+                value = views[view_name][name]
+                value = ("%.6f" % value) if isinstance(value, float) else str(value)
+                lines.append('%s{view="%s"} %s' % (metric, view_name.replace('"', '\\"'), value))
+        return "\n".join(lines) + "\n"
+
+
+def query_budget(view_name):
+    """
+    Fetches the most queries a view may run per request.
+    @param view_name: The resolved URL name of the view.
+    @type view_name: str
+    @return: The view's budget from QUERY_BUDGETS, or None if it has none.
+    @rtype: int | None
+    """
+    return getattr(settings, "QUERY_BUDGETS", {}).get(view_name, None)
+
+
+def assert_within_query_budget(response, budget=None):
+    """
+    Fails when the request behind a test client response ran more queries than its view's budget.
+    @param response: The response returned by the Django test client.
+    @type response: HttpResponse
+    @param budget: The budget to hold the request to, defaults to the view's budget in QUERY_BUDGETS.
+    @type budget: int | None
+    """
+    stats = getattr(response, "query_stats", None)
+    if stats is None:
+        raise AssertionError("The response has no query stats; is QueryMetricsMiddleware installed and enabled?")
+    budget = budget if budget is not None else stats["budget"]
+    if budget is None:
+        raise AssertionError("No query budget set for %s" % stats["view"])
+    if stats["queries"] > budget:
+        raise AssertionError("%s ran %s queries, over its budget of %s" % (stats["view"], stats["queries"], budget))
+
+
+query_metrics = QueryMetrics()
@@ -0,0 +1,163 @@
+import logging
+import random
+import uuid
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.db import transaction as trx
+from django.utils import timezone
+
+from base.models import State, School, Classroom, Subject
+from books.backend.library_stats import library_stats
+from books.backend.search import book_search
+from books.models import Author, Publisher, BookCategory, Book, UserBook
+from users.backend.search import user_search
+from users.models import Role, User
+
+lgr = logging.getLogger(__name__)
+
+
+class SyntheticSchoolData(object):
+    """
+    Generates reproducible schools for benchmarking: classrooms, users per role, authors, publishers, books and loan
+    history. The same seed always produces the same rows (ids included), so runs on different databases or commits
+    work on identical data. Everything generated is prefixed with bench<seed> and can be removed with flush().
+    """
+    FIRST_NAMES = (
+        "Amani", "Baraka", "Chege", "Daudi", "Esther", "Faith", "Grace", "Hassan", "Imani", "Jabari", "Kamau", "Lilian",
+        "Mercy", "Njeri", "Otieno", "Purity", "Rehema", "Samuel", "Tumaini", "Wanjiru", "Zawadi")
+    LAST_NAMES = (
+        "Achieng", "Barasa", "Cheruiyot", "Gitau", "Kariuki", "Kiprop", "Mutua", "Mwangi", "Njoroge", "Ochieng",
+        "Odhiambo", "Omondi", "Onyango", "Wafula", "Wambui", "Wekesa")
+    TITLE_WORDS = (
+        "River", "Between", "Child", "Source", "Arrow", "Secondary", "Mathematics", "Chemistry", "Biology", "History",
+        "Kiswahili", "Grammar", "Poems", "Stories", "Atlas", "Revision", "Guide", "Form", "Practical", "Modern")
+    CATEGORIES = ("Fiction", "Textbook", "Reference", "Revision", "Poetry")
+    SUBJECTS = ("English", "Mathematics", "Kiswahili", "Biology", "Chemistry", "History", "Geography")
+    BATCH_SIZE = 1000
+
+    def __init__(self, seed=1, password="benchmark"):
+        self.seed = seed
+        self.prefix = "bench%s" % seed
+        self.password = password
+        self.rng = random.Random(seed)
+
+    def uuid(self):
+        return uuid.UUID(int=self.rng.getrandbits(128), version=4)
+
+    def flush(self):
+        """
+        Deletes everything previously generated with this seed.
+        @return: The number of rows deleted.
+        @rtype: int
+        """
+        deleted = 0
+        with trx.atomic():
+            for queryset in (
+                    School.objects.filter(code__startswith="%s-" % self.prefix),
+                    Author.objects.filter(name__startswith="%s " % self.prefix),
+                    Publisher.objects.filter(name__startswith="%s " % self.prefix)):
+                deleted += queryset.delete()[0]
+        return deleted
+
+    def generate(
+            self, schools=1, classrooms=10, students=30, teachers=10, clerks=2, admins=1, authors=200, publishers=20,
+            books=2000, loans=5000):
+        """
+        Generates the schools and everything in them. Counts other than schools, authors and publishers are per school
+        (students per classroom).
+        @return: The number of rows generated per model.
+        @rtype: dict
+        """
+        counts = {}
+        roles = {"Admin": Role.admin(), "Clerk": Role.clerk(), "Teacher": Role.teacher(), "Student": Role.student()}
+        password_hash = make_password(self.password)
+        active, idle, issued, returned = State.active(), State.idle(), State.issued(), State.returned()
+        now = timezone.now()
+        with trx.atomic():
+            categories = [BookCategory.objects.get_or_create(name=name, state=active)[0] for name in self.CATEGORIES]
+            subjects = [Subject.objects.get_or_create(name=name, state=active)[0] for name in self.SUBJECTS]
+            author_rows = self._create(Author, [
+                Author(id=self.uuid(), name="%s %s %s" % (self.prefix, self.rng.choice(self.FIRST_NAMES),
+                                                          self.rng.choice(self.LAST_NAMES)), state=active)
+                for _ in range(authors)], counts)
+            publisher_rows = self._create(Publisher, [
+                Publisher(id=self.uuid(), name="%s Publishers %s" % (self.prefix, n), state=active)
+                for n in range(1, publishers + 1)], counts)
+            for school_number in range(1, schools + 1):
+                code = "%s-%s" % (self.prefix, school_number)
+                school = self._create(School, [
+                    School(id=self.uuid(), name="Bench School %s" % school_number, code=code, state=active)], counts)[0]
+                classroom_rows = self._create(Classroom, [
+                    Classroom(id=self.uuid(), name="Form %s%s" % (n % 4 + 1, chr(65 + n // 4)), school=school,
+                              state=active)
+                    for n in range(classrooms)], counts)
+                users = []
+                for role_name, count in (("Admin", admins), ("Clerk", clerks), ("Teacher", teachers)):
+                    users += [self._user(code, role_name, n, school, None, roles, password_hash, active)
+                              for n in range(1, count + 1)]
+                users += [self._user(code, "Student", n, school, classroom_rows[(n - 1) // students], roles,
+                                     password_hash, active)
+                          for n in range(1, classrooms * students + 1)]
+                user_rows = self._create(User, users, counts)
+                student_rows = [user for user in user_rows if user.role_id == roles["Student"].id]
+                book_rows = [self._book(code, n, school, author_rows, publisher_rows, categories, subjects, idle)
+                             for n in range(1, books + 1)]
+                loan_rows = []
+                if student_rows and book_rows:
+                    on_loan = set()
+                    for n in range(loans):
+                        book = self.rng.choice(book_rows)
+                        # Roughly one loan in ten is still out, at most one per book
+                        current = book.id not in on_loan and self.rng.random() < 0.1
+                        # Open loans are due anywhere from two weeks ago to two weeks ahead, so some are overdue
+                        loan = UserBook(
+                            id=self.uuid(), user=self.rng.choice(student_rows), book=book,
+                            state=active if current else returned, returned_at=None if current else now,
+                            due_at=now + timedelta(days=self.rng.randint(-14, 14)) if current else now)
+                        if current:
+                            on_loan.add(book.id)
+                            book.state = issued
+                            book.current_borrower, book.current_loan_id, book.loan_started_at = loan.user, loan.id, now
+                        loan_rows.append(loan)
+                self._create(Book, book_rows, counts)
+                self._create(UserBook, loan_rows, counts)
+                # Bulk inserts skip the signals that keep the statistics current
+                library_stats.recompute(school)
+                trx.on_commit(lambda school_id=school.id: user_search.invalidate(school_id))
+                trx.on_commit(lambda school_id=school.id: book_search.invalidate(school_id))
+        return counts
+
+    def _create(self, model, rows, counts):
+        model.objects.bulk_create(rows, batch_size=self.BATCH_SIZE)
+        counts[model.__name__] = counts.get(model.__name__, 0) + len(rows)
+        return rows
+
+    def _user(self, code, role_name, number, school, classroom, roles, password_hash, active):
+        username = "%s-%s-%s" % (code, role_name.lower(), number)
+        data = {
+            "username": username,
+            "email": "%s@bench.example" % username,
+            "phone_number": "07%08d" % self.rng.randrange(10 ** 8),
+            "first_name": self.rng.choice(self.FIRST_NAMES),
+            "last_name": self.rng.choice(self.LAST_NAMES),
+            "other_name": None,
+            "other_phone_number": None,
+            "id_no": "%s-%s" % (code, role_name[0] + str(number)) if role_name != "Student" else None,
+            "reg_no": "%s/%s" % (code, number) if role_name == "Student" else None,
+        }
+        return User(
+            id=self.uuid(), password=password_hash, school=school, classroom=classroom, role=roles[role_name],
+            state=active, gender=self.rng.choice(User.GENDER)[0], search_document=User.make_search_document(**data),
+            **data)
+
+    def _book(self, code, number, school, authors, publishers, categories, subjects, idle):
+        author = self.rng.choice(authors)
+        publisher = self.rng.choice(publishers)
+        title = " ".join(self.rng.sample(self.TITLE_WORDS, self.rng.randint(2, 4)))
+        book_number = "%s-B%05d" % (code, number)
+        return Book(
+            id=self.uuid(), number=book_number, title=title, school=school, author=author, publisher=publisher,
+            category=self.rng.choice(categories), subject=self.rng.choice(subjects),
+            publication_year=self.rng.randint(1960, 2024), state=idle,
+            search_document=Book.make_search_document(book_number, title, author.name, publisher.name))
@@ -0,0 +1,114 @@
+from django.apps import apps
+from django.core import checks
+
+from base.backend.query_metrics import query_metrics
+
+
+def index_columns(model):
+    """
+    Lists the column sequences a model has an index on.
+    @param model: The model whose indexes we are listing.
+    @type model: Model
+    @return: The field names of each index, in index order and without ordering signs.
+    @rtype: list
+    """
+    columns = []
+    for field in model._meta.concrete_fields:
+        if field.primary_key or field.unique or field.db_index:
+            columns.append([field.name])
+    for index in model._meta.indexes:
+        if index.fields:
+            columns.append([name.lstrip("-") for name in index.fields])
+    for fields in model._meta.unique_together:
+        columns.append(list(fields))
+    for constraint in model._meta.constraints:
+        if getattr(constraint, "fields", None) and getattr(constraint, "condition", None) is None:
+            columns.append(list(constraint.fields))
+    return columns
+
+
+def serves(columns, equal, ranged, ordering):
+    """
+    Tells whether one of a model's indexes serves a query shape.
+    An index serves it when its leading fields are the fields matched exactly, in any order, followed by the ordering
+    fields, or by a field matched by range when the index cannot give the ordering anyway. An index the exact matches
+    use up serves a query with no ordering too.
+    @param columns: The model's indexes, as listed by index_columns.
+    @type columns: list
+    @param equal: The names of the fields matched exactly.
+    @type equal: set
+    @param ranged: The names of the fields matched by range.
+    @type ranged: set
+    @param ordering: The names of the fields ordered by, without ordering signs.
+    @type ordering: list
+    @rtype: bool
+    """
+    for index in columns:
+        leading = 0
+        while leading < len(index) and index[leading] in equal:
+            leading += 1
+        rest = index[leading:]
+        if leading < len(equal):
+            if leading and not rest and not ordering:
+                return True
+            continue
+        if ordering and rest[:len(ordering)] == ordering:
+            return True
+        if (equal and not ordering) or (rest and rest[0] in ranged):
+            return True
+    return False
+
+
+@checks.register(checks.Tags.models)
+def check_hot_query_indexes(app_configs=None, shapes=None, **kwargs):
+    """
+    Fails when a hot query shape has no index to serve it.
+    Models declare the shapes of their frequent queries in HOT_QUERIES, each a tuple of the fields the query filters
+    on followed by the fields it orders by (prefixed with "-" when descending). A declared shape is covered when some
+    index starts with exactly those fields in that order.
+    The shapes of the queries the views were seen to run are checked too, from the shapes given or else those in
+    query_metrics, which QueryMetricsMiddleware records with QUERY_SHAPES_RECORDED. benchmark_endpoints
+    --check-indexes runs every endpoint and then this check, so a view's new filter or ordering is caught without
+    anyone declaring it.
+    """
+    errors = []
+    models = apps.get_models() if app_configs is None else [
+        model for app_config in app_configs for model in app_config.get_models()]
+    for model in models:
+        declared = getattr(model, "HOT_QUERIES", ())
+        if not declared:
+            continue
+        columns = index_columns(model)
+        for shape in declared:
+            names = [name.lstrip("-") for name in shape]
+            if not any(index[:len(names)] == names for index in columns):
+                errors.append(checks.Error(
+                    "Hot query on %s has no index" % ", ".join(shape),
+                    hint="Add an index on %s to %s.Meta.indexes." % (names, model.__name__),
+                    obj=model, id="base.E001"))
+    tables = {model._meta.db_table: model for model in models}
+    recorded = shapes if shapes is not None else query_metrics.shapes()
+    for (table, equal, ranged, ordering), view_names in sorted(recorded.items()):
+        model = tables.get(table, None)
+        if model is None:
+            continue
+        fields = {field.column: field.name for field in model._meta.concrete_fields}
+        equal = {fields.get(column, column) for column in equal}
+        ranged = {fields.get(column, column) for column in ranged}
+        ordering = [
+            ("-" if column.startswith("-") else "") + fields.get(column.lstrip("-"), column.lstrip("-"))
+            for column in ordering]
+        # A primary key or unique field finds the row on its own
+        if any(field.name in equal for field in model._meta.concrete_fields if field.primary_key or field.unique):
+            continue
+        if serves(index_columns(model), equal, ranged, [name.lstrip("-") for name in ordering]):
+            continue
+        filters = sorted(equal) + sorted(ranged)
+        errors.append(checks.Error(
+            "Query on %s filtering on %s%s from %s has no index" % (
+                table, ", ".join(filters) or "nothing", " ordered by %s" % ", ".join(ordering) if ordering else "",
+                ", ".join(sorted(view_names))),
+            hint="Add an index on %s to %s.Meta.indexes and the shape to its HOT_QUERIES." % (
+                sorted(equal) + [name.lstrip("-") for name in ordering] + sorted(ranged), model.__name__),
+            obj=model, id="base.E002"))
+    return errors
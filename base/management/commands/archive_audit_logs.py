@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from base.backend.audit_archive import AuditArchiver
+
+
+class Command(BaseCommand):
+    help = "Creates the coming months' audit partitions and moves closed months of transactions and notifications " \
+           "to compressed JSON lines archives."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--retention-months", type=int, help="Months kept in the database besides this one.")
+        parser.add_argument("--months-ahead", type=int, help="Months of partitions to create ahead (PostgreSQL).")
+        parser.add_argument("--archive-dir", help="Where the archives are written.")
+        parser.add_argument("--partitions-only", action="store_true", help="Only create the coming partitions.")
+
+    def handle(self, *args, **options):
+        archiver = AuditArchiver(archive_dir=options["archive_dir"], retention_months=options["retention_months"])
+        for name in archiver.ensure_partitions(months_ahead=options["months_ahead"]):
+            self.stdout.write("Created partition %s" % name)
+        if options["partitions_only"]:
+            return
+        for table, periods in archiver.archive().items():
+            for period in periods:
+                self.stdout.write("%s %s: archived %s rows to %s" % (
+                    table, period["period"], period["rows"], period["file"]))
@@ -0,0 +1,56 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from base.backend.benchmark import EndpointBenchmark
+from base.backend.query_metrics import query_metrics
+from base.checks import check_hot_query_indexes
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the main endpoints against a generated school and reports latency percentiles and query counts."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--school-code", help="Defaults to the most recently generated school.")
+        parser.add_argument("--password", default="benchmark", help="The password the school was generated with.")
+        parser.add_argument("--iterations", type=int, default=50, help="Timed requests per endpoint.")
+        parser.add_argument("--warmup", type=int, default=5, help="Untimed requests per endpoint.")
+        parser.add_argument(
+            "--endpoint", action="append", dest="endpoints", choices=EndpointBenchmark.ENDPOINTS,
+            help="Only benchmark this endpoint. Can be repeated.")
+        parser.add_argument("--output", help="Write the results as JSON to this file instead of stdout.")
+        parser.add_argument(
+            "--check-indexes", action="store_true",
+            help="Record the shape of every query the endpoints run and fail if one has no index to serve it.")
+
+    def handle(self, *args, **options):
+        school = EndpointBenchmark.find_school(options["school_code"])
+        if not school:
+            raise CommandError("School not found, generate one with generate_school_data")
+        try:
+            benchmark = EndpointBenchmark(
+                school, password=options["password"], iterations=options["iterations"], warmup=options["warmup"])
+            query_metrics.reset()
+            with override_settings(QUERY_SHAPES_RECORDED=options["check_indexes"]):
+                results = benchmark.run(options["endpoints"])
+        except Exception as e:
+            raise CommandError(str(e))
+        report = json.dumps(results, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(report + "\n")
+            for endpoint, stats in results["endpoints"].items():
+                self.stdout.write(
+                    "%-28s p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  queries %5.1f  errors %s" % (
+                        endpoint, stats["p50_ms"], stats["p95_ms"], stats["p99_ms"], stats["queries_mean"],
+                        stats["errors"]))
+        else:
+            self.stdout.write(report)
+        if options["check_indexes"]:
+            errors = check_hot_query_indexes(shapes=query_metrics.shapes())
+            for error in errors:
+                self.stderr.write("%s\n    HINT: %s" % (error.msg, error.hint))
+            if errors:
+                raise CommandError("%s queries have no index" % len(errors))
+            self.stdout.write("Every query the endpoints ran has an index")
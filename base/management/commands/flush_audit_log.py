@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from base.backend.audit_writer import audit_writer
+
+
+class Command(BaseCommand):
+    help = "Writes the transaction logs left in the audit journals of stopped processes to the database."
+
+    def handle(self, *args, **options):
+        self.stdout.write("Recovered %s transactions" % audit_writer.flush())
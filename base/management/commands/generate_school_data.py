@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from base.backend.synthetic_data import SyntheticSchoolData
+
+
+class Command(BaseCommand):
+    help = "Generates reproducible synthetic schools, users, books and loan history for benchmarking."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seed", type=int, default=1, help="The same seed always generates the same data.")
+        parser.add_argument("--schools", type=int, default=1)
+        parser.add_argument("--classrooms", type=int, default=10, help="Classrooms per school.")
+        parser.add_argument("--students", type=int, default=30, help="Students per classroom.")
+        parser.add_argument("--teachers", type=int, default=10, help="Teachers per school.")
+        parser.add_argument("--clerks", type=int, default=2, help="Clerks per school.")
+        parser.add_argument("--admins", type=int, default=1, help="Admins per school.")
+        parser.add_argument("--authors", type=int, default=200)
+        parser.add_argument("--publishers", type=int, default=20)
+        parser.add_argument("--books", type=int, default=2000, help="Books per school.")
+        parser.add_argument("--loans", type=int, default=5000, help="Loans per school.")
+        parser.add_argument("--password", default="benchmark", help="The password of every generated user.")
+        parser.add_argument("--flush", action="store_true", help="Delete the data generated with this seed first.")
+
+    def handle(self, *args, **options):
+        generator = SyntheticSchoolData(seed=options["seed"], password=options["password"])
+        if options["flush"]:
+            self.stdout.write("Deleted %s rows" % generator.flush())
+        start = time.perf_counter()
+        counts = generator.generate(**{key: options[key] for key in (
+            "schools", "classrooms", "students", "teachers", "clerks", "admins", "authors", "publishers", "books",
+            "loans")})
+        for model, count in counts.items():
+            self.stdout.write("%s: %s" % (model, count))
+        self.stdout.write("Generated in %.1fs" % (time.perf_counter() - start))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from base.backend.notification_worker import NotificationWorker
+
+
+class Command(BaseCommand):
+    help = "Sends queued notifications to the Notifications Bus."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, help="Notifications leased per batch.")
+        parser.add_argument("--threads", type=int, help="Concurrent requests to the bus.")
+        parser.add_argument("--interval", type=float, help="Seconds to sleep when the outbox is empty.")
+        parser.add_argument("--once", action="store_true", help="Drain the outbox once and exit.")
+
+    def handle(self, *args, **options):
+        worker = NotificationWorker(batch_size=options["batch_size"], threads=options["threads"])
+        if not options["once"]:
+            worker.run_forever(interval=options["interval"])
+            return
+        total = 0
+        while True:
+            processed = worker.run_once()
+            if not processed:
+                break
+            total += processed
+        self.stdout.write("Processed %s notifications" % total)
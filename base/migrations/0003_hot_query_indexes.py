@@ -0,0 +1,25 @@
+# Generated by Django 5.0.4 on 2026-10-18 17:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0002_notification_outbox'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='classroom',
+            index=models.Index(fields=['school', 'state', 'name'], name='classroom_school_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subject',
+            index=models.Index(fields=['name', 'state'], name='subject_name_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subject',
+            index=models.Index(fields=['state', '-date_created'], name='subject_state_created_idx'),
+        ),
+    ]
@@ -0,0 +1,98 @@
+# Generated by Django 5.0.4 on 2026-10-18 17:51
+
+import datetime
+
+import django.utils.timezone
+from django.db import migrations, models
+
+TABLES = ('base_transaction', 'base_notification')
+MONTHS_AHEAD = 3
+
+
+def add_months(value, months):
+    month = value.month - 1 + months
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1)
+
+
+def rebuild(cursor, table, partitioned):
+    """
+    Recreates a table as monthly range partitions on date_created, or back as a plain table, keeping its rows,
+    indexes and foreign keys. A partitioned table's primary key has to include the partition key.
+    """
+    cursor.execute(
+        "SELECT indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s AND indexname NOT IN "
+        "(SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype IN ('p', 'u'))", [table, table])
+    indexes = [row[0].replace(' ON ONLY ', ' ON ') for row in cursor.fetchall()]
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'",
+        [table])
+    foreign_keys = cursor.fetchall()
+    cursor.execute('SELECT min(date_created) FROM %s' % table)
+    first = cursor.fetchone()[0] or django.utils.timezone.now()
+    legacy = '%s_legacy' % table
+    cursor.execute('ALTER TABLE %s RENAME TO %s' % (table, legacy))
+    if partitioned:
+        cursor.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) PARTITION BY RANGE (date_created)' % (table, legacy))
+        start = first.astimezone(datetime.timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        last = add_months(django.utils.timezone.now().astimezone(datetime.timezone.utc), MONTHS_AHEAD)
+        while start <= last:
+            end = add_months(start, 1)
+            cursor.execute("CREATE TABLE %s_p%s PARTITION OF %s FOR VALUES FROM ('%s') TO ('%s')" % (
+                table, start.strftime('%Y_%m'), table, start.isoformat(), end.isoformat()))
+            start = end
+        cursor.execute('CREATE TABLE %s_default PARTITION OF %s DEFAULT' % (table, table))
+    else:
+        cursor.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)' % (table, legacy))
+    cursor.execute('INSERT INTO %s SELECT * FROM %s' % (table, legacy))
+    cursor.execute('DROP TABLE %s' % legacy)
+    cursor.execute('ALTER TABLE %s ADD PRIMARY KEY (%s)' % (table, 'id, date_created' if partitioned else 'id'))
+    for index in indexes:
+        cursor.execute(index)
+    for name, definition in foreign_keys:
+        cursor.execute('ALTER TABLE %s ADD CONSTRAINT %s %s' % (table, name, definition))
+
+
+def partition_tables(apps, schema_editor):
+    # Partitions are PostgreSQL only; elsewhere archive_audit_logs rotates closed months out of the plain tables
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for table in TABLES:
+            rebuild(cursor, table, partitioned=True)
+
+
+def unpartition_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for table in TABLES:
+            rebuild(cursor, table, partitioned=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0004_notification_transaction_no_constraint'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='notification',
+            name='date_created',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='date_created',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['-date_created'], name='notification_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['-date_created'], name='transaction_created_idx'),
+        ),
+        migrations.RunPython(partition_tables, unpartition_tables),
+    ]
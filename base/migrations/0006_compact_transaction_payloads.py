@@ -0,0 +1,83 @@
+# Generated by Django 5.0.4 on 2026-10-18 17:53
+
+import ast
+import json
+
+import utils.compact_json
+from django.db import migrations, models
+
+
+def parse(text):
+    # Rows logged before the audit writer hold str(dict), later ones hold JSON
+    if not text:
+        return None
+    for loads in (json.loads, ast.literal_eval):
+        try:
+            return loads(text)
+        except (ValueError, SyntaxError):
+            continue
+    return {'text': text}
+
+
+def convert_payloads(apps, schema_editor):
+    Transaction = apps.get_model('base', 'Transaction')
+    batch = []
+    for transaction in Transaction.objects.only('id', 'legacy_request', 'legacy_response').iterator(chunk_size=2000):
+        transaction.request = utils.compact_json.clean_payload(parse(transaction.legacy_request))
+        transaction.response = utils.compact_json.clean_payload(parse(transaction.legacy_response))
+        if isinstance(transaction.response, dict) and transaction.response.get('code'):
+            transaction.response_code = str(transaction.response['code'])[:20]
+        batch.append(transaction)
+        if len(batch) >= 2000:
+            Transaction.objects.bulk_update(batch, ['request', 'response', 'response_code'])
+            batch = []
+    if batch:
+        Transaction.objects.bulk_update(batch, ['request', 'response', 'response_code'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0005_audit_partitions'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='transaction',
+            old_name='request',
+            new_name='legacy_request',
+        ),
+        migrations.RenameField(
+            model_name='transaction',
+            old_name='response',
+            new_name='legacy_response',
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='request',
+            field=utils.compact_json.CompactJSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='response',
+            field=utils.compact_json.CompactJSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='response_code',
+            field=models.CharField(blank=True, max_length=20, null=True),
+        ),
+        migrations.RunPython(convert_payloads, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='transaction',
+            name='legacy_request',
+        ),
+        migrations.RemoveField(
+            model_name='transaction',
+            name='legacy_response',
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['response_code', '-date_created'], name='transaction_response_code_idx'),
+        ),
+    ]
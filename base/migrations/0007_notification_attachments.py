@@ -0,0 +1,19 @@
+# Generated by Django 5.0.4 on 2026-10-18 18:40
+
+import utils.compact_json
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0006_compact_transaction_payloads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='attachments',
+            field=utils.compact_json.CompactJSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.0.4 on 2026-10-18 18:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0007_notification_attachments'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notificationtype',
+            index=models.Index(fields=['name'], name='notificationtype_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='state',
+            index=models.Index(fields=['name'], name='state_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transactiontype',
+            index=models.Index(fields=['name'], name='transactiontype_name_idx'),
+        ),
+    ]
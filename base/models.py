@@ -2,6 +2,10 @@ import logging
 import uuid
 
 from django.db import models
+from django.utils import timezone
+
+from utils.compact_json import CompactJSONField
+from utils.registry import ModelRegistry
 
 lgr = logging.getLogger(__name__)
 lgr.propagate = False
@@ -23,16 +27,21 @@ class GenericBaseModel(BaseModel):
         abstract = True
 
 class State(GenericBaseModel):
+    HOT_QUERIES = (('name',),)
+
     def __str__(self):
         return self.name
 
     class Meta:
         ordering = ('-date_created',)
+        indexes = [
+            models.Index(fields=['name'], name='state_name_idx'),
+        ]
 
     @classmethod
     def active(cls):
         try:
-            state, created = cls.objects.get_or_create(name="Active")
+            state = state_registry.get("Active")
             return state
         except Exception as e:
             lgr.exception("State model - active exception: %s" % e)
@@ -41,7 +50,7 @@ class State(GenericBaseModel):
     @classmethod
     def inactive(cls):
         try:
-            state, created = cls.objects.get_or_create(name="Inactive")
+            state = state_registry.get("Inactive")
             return state
         except Exception as e:
             lgr.exception("State model - inactive exception: %s" % e)
@@ -50,7 +59,7 @@ class State(GenericBaseModel):
     @classmethod
     def deleted(cls):
         try:
-            state, created = cls.objects.get_or_create(name="Deleted")
+            state = state_registry.get("Deleted")
             return state
         except Exception as e:
             lgr.exception("State model - deleted exception: %s" % e)
@@ -59,7 +68,7 @@ class State(GenericBaseModel):
     @classmethod
     def expired(cls):
         try:
-            state, created = cls.objects.get_or_create(name="Expired")
+            state = state_registry.get("Expired")
             return state
         except Exception as e:
             lgr.exception("State model - expired exception: %s" % e)
@@ -68,7 +77,7 @@ class State(GenericBaseModel):
     @classmethod
     def activation_pending(cls):
         try:
-            state, created = cls.objects.get_or_create(name="Activation Pending")
+            state = state_registry.get("Activation Pending")
             return state
         except Exception as e:
             lgr.exception("State model - activation_pending exception: %s" % e)
@@ -77,7 +86,7 @@ class State(GenericBaseModel):
     @classmethod
     def completed(cls):
         try:
-            state, created = cls.objects.get_or_create(name="Completed")
+            state = state_registry.get("Completed")
             return state
         except Exception as e:
             lgr.exception("State model - completed exception: %s" % e)
@@ -86,7 +95,7 @@ class State(GenericBaseModel):
     @classmethod
     def failed(cls):
         try:
-            state, created = cls.objects.get_or_create(name="Failed")
+            state = state_registry.get("Failed")
             return state
         except Exception as e:
             lgr.exception("State model - failed exception: %s" % e)
@@ -95,16 +104,25 @@ class State(GenericBaseModel):
     @classmethod
     def sent(cls):
         try:
-            state, created = cls.objects.get_or_create(name="Sent")
+            state = state_registry.get("Sent")
             return state
         except Exception as e:
             lgr.exception("State model - sent exception: %s" % e)
             return None
 
+    @classmethod
+    def pending(cls):
+        try:
+            state = state_registry.get("Pending")
+            return state
+        except Exception as e:
+            lgr.exception("State model - pending exception: %s" % e)
+            return None
+
     @classmethod
     def issued(cls):
         try:
-            state, created = cls.objects.get_or_create(name="Issued")
+            state = state_registry.get("Issued")
             return state
         except Exception as e:
             lgr.exception("State model - issued exception: %s" % e)
@@ -113,7 +131,7 @@ class State(GenericBaseModel):
     @classmethod
     def idle(cls):
         try:
-            state, created = cls.objects.get_or_create(name="Idle")
+            state = state_registry.get("Idle")
             return state
         except Exception as e:
             lgr.exception("State model - idle exception: %s" % e)
@@ -122,61 +140,99 @@ class State(GenericBaseModel):
     @classmethod
     def returned(cls):
         try:
-            state, created = cls.objects.get_or_create(name="Returned")
+            state = state_registry.get("Returned")
             return state
         except Exception as e:
             lgr.exception("State model - returned exception: %s" % e)
             return None
 
+state_registry = ModelRegistry(State)
+
 class TransactionType(GenericBaseModel):
     state = models.ForeignKey(State, null=True, blank=True, default=State.active, on_delete=models.CASCADE)
 
+    HOT_QUERIES = (('name',),)
+
     def __str__(self):
         return self.name
 
     class Meta:
         ordering = ('-date_created',)
+        indexes = [
+            models.Index(fields=['name'], name='transactiontype_name_idx'),
+        ]
+
+transaction_type_registry = ModelRegistry(TransactionType)
 
 class Transaction(BaseModel):
+    # Set when the row is built rather than inserted: it is the partition key and the audit writer inserts late
+    date_created = models.DateTimeField(default=timezone.now, editable=False)
     transaction_type = models.ForeignKey(TransactionType, on_delete=models.CASCADE)
     reference = models.CharField(max_length=100, null=True, blank=True)
     source_ip = models.CharField(max_length=30, null=True, blank=True)
-    request = models.TextField(null=True, blank=True)
-    response = models.TextField(null=True, blank=True)
+    request = CompactJSONField(null=True, blank=True)
+    response = CompactJSONField(null=True, blank=True)
+    response_code = models.CharField(max_length=20, null=True, blank=True)
     notification_response = models.TextField(null=True, blank=True)
     state = models.ForeignKey(State, null=True, blank=True, default=State.active, on_delete=models.CASCADE)
 
     SYNC_MODEL = False
+    HOT_QUERIES = (('-date_created',), ('response_code', '-date_created'))
 
     def __str__(self):
         return self.transaction_type.name
 
     class Meta:
         ordering = ('-date_created',)
+        indexes = [
+            models.Index(fields=['-date_created'], name='transaction_created_idx'),
+            models.Index(fields=['response_code', '-date_created'], name='transaction_response_code_idx'),
+        ]
 
 class NotificationType(GenericBaseModel):
     state = models.ForeignKey(State, null=True, blank=True, default=State.active, on_delete=models.CASCADE)
 
+    HOT_QUERIES = (('name',),)
+
     def __str__(self):
         return self.name
 
     class Meta:
         ordering = ('-date_created',)
+        indexes = [
+            models.Index(fields=['name'], name='notificationtype_name_idx'),
+        ]
+
+notification_type_registry = ModelRegistry(NotificationType)
 
 class Notification(BaseModel):
+    date_created = models.DateTimeField(default=timezone.now, editable=False)
     notification_type = models.ForeignKey(NotificationType, on_delete=models.CASCADE)
     title = models.CharField(max_length=50)
     message = models.TextField(max_length=500)
     destination = models.CharField(max_length=100)
+    # Transactions are written in batches by the audit writer, possibly after the notifications queued against them
+    transaction = models.ForeignKey(
+        Transaction, null=True, blank=True, on_delete=models.SET_NULL, db_constraint=False)
+    # Files sent along with the message, as encoded by utils.notification_bus.encode_files
+    attachments = CompactJSONField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    response = models.TextField(null=True, blank=True)
     state = models.ForeignKey(State, on_delete=models.CASCADE)
 
     SYNC_MODEL = False
+    HOT_QUERIES = (('state', 'next_attempt_at'), ('-date_created',))
 
     def __str__(self):
         return '%s - %s' % (self.notification_type, self.destination)
 
     class Meta:
         ordering = ('-date_created',)
+        indexes = [
+            models.Index(fields=['state', 'next_attempt_at'], name='notification_outbox_idx'),
+            models.Index(fields=['-date_created'], name='notification_created_idx'),
+        ]
 
 class School(GenericBaseModel):
     code = models.CharField(max_length=20, unique=True)
@@ -201,20 +257,31 @@ class Classroom(GenericBaseModel):
     school = models.ForeignKey(School, on_delete=models.CASCADE)
     state = models.ForeignKey(State, default=State.active, on_delete=models.CASCADE)
 
+    HOT_QUERIES = (('school', 'state'), ('school', 'state', 'name'))
+
     def __str__(self):
         return "%s-%s" % (self.name, self.school)
     
     class Meta:
         ordering = ('-date_created',)
+        indexes = [
+            models.Index(fields=['school', 'state', 'name'], name='classroom_school_state_idx'),
+        ]
 
 class Subject(GenericBaseModel):
     state = models.ForeignKey(State, default=State.active, on_delete=models.CASCADE)
 
+    HOT_QUERIES = (('name', 'state'), ('state', '-date_created'))
+
     def __str__(self):
         return self.name
 
     class Meta:
         ordering = ('-date_created',)
+        indexes = [
+            models.Index(fields=['name', 'state'], name='subject_name_state_idx'),
+            models.Index(fields=['state', '-date_created'], name='subject_state_created_idx'),
+        ]
 
     @classmethod
     def default(cls):
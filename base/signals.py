@@ -0,0 +1,35 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from base.models import State, state_registry, TransactionType, transaction_type_registry, NotificationType, \
+    notification_type_registry
+
+
+@receiver(post_save, sender=State)
+@receiver(post_delete, sender=State)
+def clear_state_registry(sender, created=False, **kwargs):
+    """
+    Drops the cached states whenever a State row is changed or deleted so the registry reloads on the next lookup.
+    """
+    if not created:
+        state_registry.clear()
+
+
+@receiver(post_save, sender=TransactionType)
+@receiver(post_delete, sender=TransactionType)
+def clear_transaction_type_registry(sender, created=False, **kwargs):
+    """
+    Drops the cached transaction types whenever a TransactionType row is changed or deleted.
+    """
+    if not created:
+        transaction_type_registry.clear()
+
+
+@receiver(post_save, sender=NotificationType)
+@receiver(post_delete, sender=NotificationType)
+def clear_notification_type_registry(sender, created=False, **kwargs):
+    """
+    Drops the cached notification types whenever a NotificationType row is changed or deleted.
+    """
+    if not created:
+        notification_type_registry.clear()
@@ -1,3 +1,910 @@
-from django.test import TestCase
+import atexit
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import zlib
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipIf, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db import models
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext, isolate_apps
+from django.urls import reverse
+from django.utils import timezone
+
+from base.backend.audit_archive import AuditArchiver, add_months, month_start
+from base.backend.audit_writer import AuditWriter
+from base.backend.benchmark import EndpointBenchmark
+from base.backend.notification_worker import NotificationWorker
+from base.backend.query_metrics import assert_within_query_budget, query_metrics, query_shape
+from base.backend.synthetic_data import SyntheticSchoolData
+from base.checks import check_hot_query_indexes
+from base.models import State, Notification, NotificationType, School, Transaction, TransactionType, \
+    notification_type_registry, state_registry, transaction_type_registry
+from books.models import Author, Book, BookCategory, Publisher, UserBook
+from identities.models import Identity
+from users.models import Role, User
+from utils.common import create_notification_detail
+from utils.compact_json import CompactJSONField, clean_payload
+from utils.notification_bus import NotificationBusClient, NotificationBusError, decode_files, encode_files
+from utils.registry import ModelRegistry
+from utils.testing import SchoolTestCase, SchoolTransactionTestCase
+from utils.transaction_log_base import TransactionLogBase
+
+
+@override_settings(AUDIT_REDACTED_KEYS=("password", "token"), AUDIT_COMPRESS_BYTES=64)
+class CompactJSONFieldTests(TestCase):
+
+    def setUp(self):
+        for registry in (state_registry, transaction_type_registry):
+            registry.clear()
+
+    def test_small_values_are_stored_plain(self):
+        value = {"username": "jdoe", "roles": ["student"], "active": True}
+        data = CompactJSONField.encode(value)
+        self.assertTrue(data.startswith(CompactJSONField.PLAIN))
+        self.assertEqual(CompactJSONField.decode(data), value)
+
+    def test_large_values_are_compressed(self):
+        value = {"books": [{"number": "B%03d" % n, "title": "The River Between"} for n in range(20)]}
+        data = CompactJSONField.encode(value)
+        self.assertTrue(data.startswith(CompactJSONField.COMPRESSED))
+        self.assertEqual(CompactJSONField.decode(data), value)
+        self.assertEqual(CompactJSONField.decode(memoryview(data)), value)
+
+    def test_corrupt_values_decode_to_none(self):
+        with self.assertLogs("utils.compact_json", "ERROR"):
+            self.assertIsNone(CompactJSONField.decode(CompactJSONField.COMPRESSED + b"not zlib"))
+        self.assertIsNone(CompactJSONField.decode(None))
+        self.assertEqual(CompactJSONField.decode(CompactJSONField.COMPRESSED + zlib.compress(b"[1,2]")), [1, 2])
+
+    def test_redaction_at_any_depth(self):
+        cleaned = clean_payload({
+            "username": "jdoe", "Password": "secret",
+            "users": [{"username": "asmith", "password": "secret", "profile": {"TOKEN": "abc", "phone": "0700"}}],
+            "error": ValueError("Book not found")})
+        self.assertEqual(cleaned, {
+            "username": "jdoe", "users": [{"username": "asmith", "profile": {"phone": "0700"}}],
+            "error": "Book not found"})
+        self.assertIsNone(clean_payload(None))
+
+    def test_transaction_round_trip(self):
+        transaction_type = TransactionType.objects.create(name="Login", state=State.active())
+        request = {"username": "jdoe", "password": "secret", "books": ["B%03d" % n for n in range(30)]}
+        response = {"code": "100.000.000", "data": {"token": "abc", "user": "jdoe"}}
+        transaction = Transaction.objects.create(
+            transaction_type=transaction_type,
+            **TransactionLogBase.clean_payloads({"request": request, "response": response}))
+        stored = Transaction.objects.get(id=transaction.id)
+        self.assertEqual(stored.request, {"username": "jdoe", "books": request["books"]})
+        self.assertEqual(stored.response, {"code": "100.000.000", "data": {"user": "jdoe"}})
+        self.assertEqual(stored.response_code, "100.000.000")
+        self.assertTrue(CompactJSONField.encode(stored.request).startswith(CompactJSONField.COMPRESSED))
+        self.assertEqual(
+            list(Transaction.objects.filter(id=transaction.id).values_list("request", flat=True)), [stored.request])
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class ModelRegistryTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        for registry in (state_registry, transaction_type_registry):
+            registry.clear()
+        self.registry = ModelRegistry(TransactionType)
+        self.login = TransactionType.objects.create(name="Login", state=State.active())
+
+    def test_warm_loads_every_row(self):
+        TransactionType.objects.create(name="Logout", state=State.active())
+        self.assertEqual(self.registry.warm(), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.registry.get("Login"), self.login)
+            self.assertEqual(self.registry.get("Logout").name, "Logout")
+
+    def test_missing_rows_are_created_and_registered_on_commit(self):
+        self.registry.warm()
+        with self.captureOnCommitCallbacks() as callbacks:
+            created = self.registry.get("Verify")
+        self.assertEqual(TransactionType.objects.get(name="Verify"), created)
+        self.assertNotIn("Verify", self.registry._entries)
+        for callback in callbacks:
+            callback()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.registry.get("Verify"), created)
+
+    def test_cold_lookups_inside_a_transaction_read_one_row(self):
+        self.registry.get("Login")
+        # The table is only introspected until it is found
+        with self.assertNumQueries(1):
+            self.assertEqual(self.registry.get("Login"), self.login)
+        self.assertFalse(self.registry._warm)
+
+    def test_new_rows_keep_the_registry_warm(self):
+        state_registry.warm()
+        State.objects.create(name="Archived")
+        self.assertTrue(state_registry._warm)
+        state = State.objects.get(name="Archived")
+        state.description = "Moved out of the database"
+        state.save()
+        self.assertFalse(state_registry._warm)
+
+    @override_settings(CACHE_VERSION_CHECK_SECONDS=0)
+    def test_clearing_reaches_other_workers(self):
+        other = ModelRegistry(TransactionType)
+        self.registry.warm()
+        other.warm()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.registry.clear()
+        # The other worker sees the bumped version and reads the row again rather than trusting its copy
+        with self.assertNumQueries(1):
+            self.assertEqual(other.get("Login"), self.login)
+        self.assertNotEqual(other._loaded_version, other._version.get())
+
+    def test_registry_is_skipped_before_migrate(self):
+        with mock.patch.object(connection.introspection, "table_names", return_value=[]):
+            self.assertEqual(self.registry.warm(), 0)
+            self.assertIsNone(self.registry.get("Login"))
+        self.assertFalse(self.registry._warm)
+        self.assertEqual(self.registry.warm(), 1)
+
+
+@override_settings(SEND_NOTIFICATIONS=True)
+class TypeRegistryTests(SchoolTransactionTestCase):
+    """
+    Audit logging resolves transaction and notification types through their registries, outside any transaction
+    as a request would.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.login_type = TransactionType.objects.create(name="Login", state=State.active())
+        self.email_type = NotificationType.objects.create(name="EMAIL", state=State.active())
+        transaction_type_registry.warm()
+        notification_type_registry.warm()
+
+    def type_queries(self, table, call):
+        with CaptureQueriesContext(connection) as queries:
+            call()
+        return [query["sql"] for query in queries.captured_queries if table in query["sql"].split("WHERE")[0]]
+
+    def test_logging_reads_no_types(self):
+        self.assertEqual(self.type_queries(
+            "base_transactiontype", lambda: TransactionLogBase.log_transaction("Login", reference="REF1")), [])
+        self.assertEqual(Transaction.objects.get(reference="REF1").transaction_type, self.login_type)
+        self.assertEqual(self.type_queries("base_notificationtype", lambda: TransactionLogBase.send_notification(
+            create_notification_detail(
+                message_code="SC0009", message_type="2", message="Hello", destination="a@school.example"))), [])
+        self.assertEqual(Notification.objects.get().notification_type, self.email_type)
+
+    def test_new_types_are_created_once(self):
+        TransactionLogBase.log_transaction("ResetPassword")
+        self.assertEqual(self.type_queries(
+            "base_transactiontype", lambda: TransactionLogBase.log_transaction("ResetPassword")), [])
+        self.assertEqual(TransactionType.objects.filter(name="ResetPassword").count(), 1)
+
+    def test_changes_clear_only_their_registry(self):
+        self.login_type.description = "Signed in"
+        self.login_type.save()
+        self.assertFalse(transaction_type_registry._warm)
+        self.assertTrue(notification_type_registry._warm)
+        self.assertEqual(transaction_type_registry.get("Login").description, "Signed in")
+        self.email_type.delete()
+        self.assertFalse(notification_type_registry._warm)
+        self.assertTrue(transaction_type_registry._warm)
+        self.assertNotEqual(notification_type_registry.get("EMAIL").id, self.email_type.id)
+
+
+@override_settings(AUDIT_BUFFERED=True)
+class AuditWriterTests(TestCase):
+
+    def setUp(self):
+        journal_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(journal_dir.cleanup)
+        self.journal_dir = journal_dir.name
+        # Flushed by the tests only, never by the writer's thread
+        self.writer = AuditWriter(batch_size=100, flush_seconds=3600, journal_dir=self.journal_dir)
+        self.addCleanup(self.stop_writer)
+        self.transaction_type = TransactionType.objects.create(name="Login", state=State.active())
+
+    def stop_writer(self):
+        # Its test database and journal directory are gone by exit
+        atexit.unregister(self.writer.flush)
+        if self.writer._journal is not None:
+            self.writer._journal.close()
+
+    def new_transaction(self, **kwargs):
+        return Transaction(transaction_type=self.transaction_type, **kwargs)
+
+    def journals(self):
+        return sorted(os.listdir(self.journal_dir))
+
+    def test_tests_write_through_by_default(self):
+        from school_management_system import settings as project_settings
+        self.assertTrue(project_settings.TESTING)
+        self.assertFalse(project_settings.AUDIT_BUFFERED)
+
+    def test_writes_are_upserted_with_their_latest_values(self):
+        transaction = self.writer.write(self.new_transaction(response_code="100.000.000"))
+        self.assertFalse(Transaction.objects.exists())
+        transaction.reference = "first"
+        self.writer.write(transaction)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.writer.flush(), 1)
+        self.assertEqual(Transaction.objects.get().reference, "first")
+        transaction.state = State.completed()
+        transaction.notification_response = "Sent"
+        self.writer.write(transaction)
+        self.assertEqual(self.writer.flush(), 1)
+        stored = Transaction.objects.get()
+        self.assertEqual((stored.state, stored.notification_response), (State.completed(), "Sent"))
+        self.assertEqual(self.writer.flush(), 0)
+
+    def test_each_flush_starts_a_new_journal(self):
+        pid = os.getpid()
+        self.writer.write(self.new_transaction())
+        self.assertEqual(self.journals(), ["audit-%s-0.jsonl" % pid])
+        self.writer.flush()
+        self.assertEqual(self.journals(), ["audit-%s-1.jsonl" % pid])
+        transaction = self.writer.write(self.new_transaction())
+        with open(os.path.join(self.journal_dir, "audit-%s-1.jsonl" % pid)) as f:
+            self.assertEqual(AuditWriter.decode(f.readline()).id, transaction.id)
+
+    def test_failed_flush_keeps_the_journal(self):
+        pid = os.getpid()
+        self.writer.write(self.new_transaction())
+        with mock.patch.object(self.writer, "_save", side_effect=Exception("database down")), \
+                self.assertLogs("base.backend.audit_writer", "ERROR"):
+            self.assertEqual(self.writer.flush(), 0)
+        self.assertEqual(self.journals(), ["audit-%s-0.jsonl" % pid, "audit-%s-1.jsonl" % pid])
+        self.assertEqual(self.writer.flush(), 1)
+        self.assertEqual(self.journals(), ["audit-%s-2.jsonl" % pid])
+
+    def dead_journal(self, pid, *transactions):
+        path = os.path.join(self.journal_dir, "audit-%s-0.jsonl" % pid)
+        with open(path, "w") as f:
+            for transaction in transactions:
+                f.write(AuditWriter.encode(transaction) + "\n")
+            # Cut short as its process died
+            f.write(AuditWriter.encode(self.new_transaction())[:20])
+        return path
+
+    def test_journals_of_dead_processes_are_replayed(self):
+        first = self.new_transaction(reference="first")
+        self.dead_journal(999991, first)
+        with mock.patch.object(AuditWriter, "_alive", side_effect=lambda pid: pid == os.getpid()), \
+                self.assertLogs("base.backend.audit_writer", "WARNING"):
+            self.assertEqual(self.writer.flush(), 1)
+            # A worker dying after this process's first flush is picked up by a later one
+            second = self.new_transaction(reference="second")
+            self.dead_journal(999992, second)
+            self.assertEqual(self.writer.flush(), 1)
+        self.assertEqual(
+            set(Transaction.objects.values_list("id", flat=True)), {first.id, second.id})
+        self.assertEqual(self.journals(), [])
+
+    def test_journals_of_live_processes_are_left_alone(self):
+        path = self.dead_journal(999993, self.new_transaction())
+        with mock.patch.object(AuditWriter, "_alive", return_value=True):
+            self.assertEqual(self.writer.flush(), 0)
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(Transaction.objects.exists())
+
+
+class HotQueryIndexCheckTests(SimpleTestCase):
+
+    def test_query_shapes(self):
+        keyset = str(Book.objects.filter(school_id=1, date_created__lt=timezone.now()).order_by(
+            "-date_created", "-id")[:20].query)
+        self.assertEqual(query_shape(keyset), ("books_book", ("school_id",), (), ("-date_created", "-id")))
+        # Unsliced, so the database sorts what the filters return whatever the indexes
+        unsliced = str(Book.objects.filter(school_id=1, loan_started_at__gte=timezone.now()).query)
+        self.assertEqual(query_shape(unsliced), ("books_book", ("school_id",), ("loan_started_at",), ()))
+        searched = str(Book.objects.filter(
+            school_id=1, search_document__contains="river", author__name="Ngugi").order_by("title")[:5].query)
+        self.assertEqual(query_shape(searched), ("books_book", ("school_id",), (), ("title",)))
+        nested = str(Book.objects.filter(id__in=Book.objects.filter(title="The River Between").values("id")).query)
+        self.assertEqual(query_shape(nested), ("books_book", ("id",), (), ()))
+        self.assertIsNone(query_shape(str(Book.objects.all().query)))
+        self.assertIsNone(query_shape("SAVEPOINT \"s1\""))
+
+    def test_declared_and_recorded_shapes_are_indexed(self):
+        self.assertEqual(check_hot_query_indexes(shapes={}), [])
+        shapes = {
+            ("books_book", ("school_id",), (), ("-date_created", "-id")): {"books:filter-books"},
+            ("books_book", ("id",), (), ()): {"books:return-book"},
+            ("identities_identity", ("state_id", "user_id"), ("expires_at",), ("-date_created",)): {"identities:login"},
+            ("books_userbook", ("book_id", "returned_at"), (), ()): {"books:return-book"},
+        }
+        self.assertEqual(check_hot_query_indexes(shapes=shapes), [])
+
+    def test_unindexed_recorded_shape_fails(self):
+        shapes = {("books_book", ("school_id",), (), ("title",)): {"books:filter-books"}}
+        errors = check_hot_query_indexes(shapes=shapes)
+        self.assertEqual([error.id for error in errors], ["base.E002"])
+        self.assertIs(errors[0].obj, Book)
+        self.assertIn("from books:filter-books", errors[0].msg)
+
+    @isolate_apps("base", kwarg_name="apps")
+    def test_unindexed_declared_shape_fails(self, apps):
+        class Report(models.Model):
+            school_id = models.IntegerField()
+            title = models.CharField(max_length=50)
+
+            HOT_QUERIES = (("school_id", "title"),)
+
+            class Meta:
+                app_label = "base"
+                indexes = [models.Index(fields=["school_id"], name="report_school_idx")]
+
+        errors = check_hot_query_indexes(app_configs=[apps.get_app_config("base")], shapes={})
+        self.assertEqual([(error.id, error.obj) for error in errors], [("base.E001", Report)])
+        shapes = {("base_report", ("school_id",), (), ("title",)): {"base:reports"}}
+        errors = check_hot_query_indexes(app_configs=[apps.get_app_config("base")], shapes=shapes)
+        self.assertEqual([error.id for error in errors], ["base.E001", "base.E002"])
+
+
+@override_settings(QUERY_SHAPES_RECORDED=True)
+class QueryBudgetTests(SchoolTransactionTestCase):
+    """
+    Holds every view in QUERY_BUDGETS to its budget through the test client. Each view is called once to warm the
+    worker's caches first, as the budgets are for a running worker. Audit rows are written within the request, the
+    most a view can cost. Every query the views run must also have an index to serve it.
+    """
+
+    def setUp(self):
+        super().setUp()
+        query_metrics.reset()
+        self.admin = self.make_user("librarian", role=Role.admin())
+        self.admin.set_password("Library-2024")
+        self.admin.save()
+        self.token = self.login(self.admin)
+        category = BookCategory.objects.create(name="Textbook", state=State.active())
+        author = Author.objects.create(name="Ngugi wa Thiong'o", state=State.active())
+        publisher = Publisher.objects.create(name="Heinemann", state=State.active())
+        self.books = [
+            Book.objects.create(
+                number="B%03d" % n, title="The River Between", school=self.school, author=author,
+                publisher=publisher, category=category, subject=self.subject, state=State.idle())
+            for n in range(1, 9)]
+        self.issued = []
+
+    def student(self):
+        return str(self.students[len(self.issued) % len(self.students)].id)
+
+    def issue_book(self):
+        book_id = str(self.books[len(self.issued)].id)
+        self.issued.append(book_id)
+        return {"user_id": self.student(), "book_id": book_id}
+
+    def calls(self):
+        school = {"school_id": str(self.school.id)}
+        usernames = iter("student%s" % n for n in range(10, 20))
+        return {
+            "identities:login": lambda: {"token": "", "username": "librarian", "password": "Library-2024"},
+            "base:get-schools": lambda: {},
+            "books:filter-books": lambda: school,
+            "books:search-books": lambda: dict(school, search_word="river"),
+            "books:issue-book": self.issue_book,
+            "books:return-book": lambda: {"book_id": self.issued.pop(0)},
+            "books:issue-books": lambda: dict(school, loans=[self.issue_book(), self.issue_book()]),
+            "books:return-books": lambda: dict(school, book_ids=[self.issued.pop(0), self.issued.pop(0)]),
+            "books:library-stats": lambda: school,
+            "users:filter-users": lambda: school,
+            "users:search-users": lambda: dict(school, search_word="student"),
+            "users:create-student": lambda: dict(
+                school, classroom_id=str(self.classroom.id), username=next(usernames), first_name="New",
+                last_name="Student", email="new@school.example", phone_number="0700000000"),
+        }
+
+    def test_views_stay_within_their_budgets(self):
+        calls = self.calls()
+        self.assertEqual(set(calls), set(settings.QUERY_BUDGETS))
+        for name, data in calls.items():
+            with self.subTest(view=name):
+                with self.settings(QUERY_BUDGETS={}):
+                    response = self.call(name, **dict({"token": self.token}, **data()))
+                self.assertEqual(response.json()["code"], "100.000.000", response.content)
+                response = self.call(name, **dict({"token": self.token}, **data()))
+                self.assertEqual(response.json()["code"], "100.000.000", response.content)
+                assert_within_query_budget(response)
+        self.assertEqual(check_hot_query_indexes(shapes=query_metrics.shapes()), [])
+
+    def test_over_budget_responses_fail(self):
+        response = self.call("base:get-schools", token=self.token)
+        self.assertLessEqual(response.query_stats["queries"], settings.QUERY_BUDGETS["base:get-schools"])
+        with self.assertRaisesMessage(AssertionError, "base:get-schools ran"):
+            assert_within_query_budget(response, budget=0)
+
+
+class QueryMetricsViewTests(SchoolTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.token = self.login(self.make_user("librarian", role=Role.admin()))
+
+    def get_metrics(self, token=None, **extra):
+        return self.client.post(
+            reverse("base:query-metrics"), data=json.dumps({"token": token or self.token}),
+            content_type="application/json", **extra)
+
+    @override_settings(QUERY_METRICS_ALLOWED_IPS=["10.0.0.5"], QUERY_METRICS_TRUSTED_PROXIES=[])
+    def test_only_allowed_addresses_are_served(self):
+        self.assertEqual(self.get_metrics(REMOTE_ADDR="10.0.0.5").status_code, 200)
+        self.assertEqual(self.get_metrics(REMOTE_ADDR="10.0.0.6").status_code, 403)
+        # Without a trusted proxy the forwarded address is ignored
+        self.assertEqual(self.get_metrics(REMOTE_ADDR="10.0.0.6", HTTP_X_FORWARDED_FOR="10.0.0.5").status_code, 403)
+
+    @override_settings(QUERY_METRICS_ALLOWED_IPS=["10.0.0.5"], QUERY_METRICS_TRUSTED_PROXIES=["10.0.0.1"])
+    def test_forwarded_address_is_read_through_trusted_proxies(self):
+        self.assertEqual(self.get_metrics(REMOTE_ADDR="10.0.0.1", HTTP_X_FORWARDED_FOR="10.0.0.5").status_code, 200)
+        # A client cannot prepend the allowed address to the header the proxy appends to
+        response = self.get_metrics(REMOTE_ADDR="10.0.0.1", HTTP_X_FORWARDED_FOR="10.0.0.5, 192.168.1.20")
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.get_metrics(REMOTE_ADDR="10.0.0.1").status_code, 403)
+
+    @override_settings(QUERY_METRICS_ALLOWED_IPS=["127.0.0.1"])
+    def test_metrics_need_an_admin(self):
+        response = self.get_metrics(token=self.login(self.students[0]))
+        self.assertEqual(response.json()["code"], "888.888.001")
+        response = self.get_metrics()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("school_management_requests_total", response.content.decode())
+
+
+class StubBus(object):
+    """
+    A local Notifications Bus answering on a free port. It records the messages it accepts and the client port of
+    every request, and rejects messages sent to REJECTED destinations. Tokens last expires_in seconds, or as long as
+    the client's default when it is None, and are refused while issue_tokens is False.
+    """
+    REJECTED = "rejected@school.example"
+
+    def __init__(self):
+        self.token_requests = 0
+        self.expires_in = 3600
+        self.issue_tokens = True
+        self.messages = []
+        self.ports = set()
+        bus = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                bus.ports.add(self.client_address[1])
+                if self.path == "/api/get_access_token/":
+                    bus.token_requests += 1
+                    reply = {"data": {"token": "bus-token-%s" % bus.token_requests, "expires_in": bus.expires_in}}
+                    if not bus.issue_tokens:
+                        reply = {"data": {}, "message": "Invalid client"}
+                elif bus.REJECTED.encode() in body or b"rejected%40school.example" in body:
+                    reply = {"data": {}, "message": "Rejected"}
+                else:
+                    bus.messages.append(body)
+                    reply = {"data": {"confirmation_code": "CONF-%s" % len(bus.messages)}}
+                data = json.dumps(reply).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%s" % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class NotificationBusClientTests(SimpleTestCase):
+
+    def setUp(self):
+        self.bus = StubBus().__enter__()
+        self.addCleanup(self.bus.__exit__)
+        self.settings_override = self.settings(BUS_URL=self.bus.url)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.client_ = NotificationBusClient(pool_size=2)
+        self.addCleanup(self.client_.session.close)
+
+    @staticmethod
+    def message(destination="parent@school.example"):
+        return create_notification_detail(
+            message_code="SC0009", message_type="2", message="Hello", destination=destination)[0]
+
+    def test_token_and_connection_are_reused(self):
+        codes = [self.client_.send(self.message()) for _ in range(5)]
+        self.assertEqual(codes, ["CONF-%s" % n for n in range(1, 6)])
+        self.assertEqual(self.bus.token_requests, 1)
+        self.assertEqual(len(self.bus.ports), 1)
+        self.assertIn(b"bus-token-1", self.bus.messages[-1])
+
+    def test_rejection_renews_the_token(self):
+        with self.assertRaises(NotificationBusError):
+            self.client_.send(self.message(StubBus.REJECTED))
+        self.client_.send(self.message())
+        self.assertEqual(self.bus.token_requests, 2)
+
+    def test_token_is_renewed_before_it_expires(self):
+        self.bus.expires_in = 600
+        now = time.monotonic()
+        with mock.patch("utils.notification_bus.time.monotonic", return_value=now):
+            self.client_.send(self.message())
+        with mock.patch("utils.notification_bus.time.monotonic", return_value=now + 569):
+            self.client_.send(self.message())
+        self.assertEqual(self.bus.token_requests, 1)
+        # Renewed 30 seconds early
+        with mock.patch("utils.notification_bus.time.monotonic", return_value=now + 570):
+            self.client_.send(self.message())
+        self.assertEqual(self.bus.token_requests, 2)
+
+    @override_settings(BUS_TOKEN_TTL_SECONDS=100)
+    def test_token_lifetime_defaults_to_the_ttl(self):
+        self.bus.expires_in = None
+        now = time.monotonic()
+        with mock.patch("utils.notification_bus.time.monotonic", return_value=now):
+            self.client_.send(self.message())
+        with mock.patch("utils.notification_bus.time.monotonic", return_value=now + 70):
+            self.client_.send(self.message())
+        self.assertEqual(self.bus.token_requests, 2)
+
+    def test_send_many_reports_each_message(self):
+        # Sent in order, so the last message goes out after the rejection dropped the token
+        results = self.client_.send_many(
+            [self.message(), self.message(StubBus.REJECTED), self.message()], threads=1)
+        self.assertEqual([code is not None for code, error in results], [True, False, True])
+        self.assertIsInstance(results[1][1], NotificationBusError)
+        self.assertEqual(self.bus.token_requests, 2)
+        self.assertIn(b"bus-token-2", self.bus.messages[-1])
+
+    def test_send_many_stays_within_the_pool(self):
+        results = self.client_.send_many([self.message() for _ in range(20)], threads=8)
+        self.assertEqual(sorted(code for code, error in results), sorted("CONF-%s" % n for n in range(1, 21)))
+        self.assertEqual(self.bus.token_requests, 1)
+        self.assertLessEqual(len(self.bus.ports), 2)
+
+    def test_batch_fails_without_a_token(self):
+        self.bus.issue_tokens = False
+        with self.assertLogs("utils.notification_bus", "WARNING"):
+            results = self.client_.send_many([self.message(), self.message()])
+        self.assertEqual([code for code, error in results], [None, None])
+        self.assertIsInstance(results[0][1], NotificationBusError)
+        self.assertEqual((self.bus.token_requests, self.bus.messages), (1, []))
+
+    def test_files_are_uploaded(self):
+        files = decode_files(encode_files({"attachment": ("report.csv", b"name,score\nwanjiru,80\n", "text/csv")}))
+        self.assertEqual(files, [("attachment", ("report.csv", b"name,score\nwanjiru,80\n", "text/csv"))])
+        self.client_.send(dict(self.message(), files=files))
+        self.assertIn(b'filename="report.csv"', self.bus.messages[0])
+        self.assertIn(b"wanjiru,80", self.bus.messages[0])
+
+
+@override_settings(SEND_NOTIFICATIONS=True, NOTIFICATION_MAX_ATTEMPTS=3, NOTIFICATION_RETRY_BACKOFF_SECONDS=30)
+class NotificationOutboxTests(SchoolTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.bus = StubBus().__enter__()
+        self.addCleanup(self.bus.__exit__)
+        self.settings_override = self.settings(BUS_URL=self.bus.url)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.bus_client = NotificationBusClient(pool_size=2)
+        self.addCleanup(self.bus_client.session.close)
+        self.worker = NotificationWorker(batch_size=10, threads=2, client=self.bus_client)
+
+    @staticmethod
+    def queue(*destinations, **extra):
+        notifications = []
+        for destination in destinations:
+            notifications += create_notification_detail(
+                message_code="SC0009", message_type="2", message="Hello", destination=destination)
+        for notification in notifications:
+            notification.update(extra)
+        return TransactionLogBase.send_notification(notifications)
+
+    def test_notifications_are_queued_not_sent(self):
+        self.assertEqual(self.queue("a@school.example", "b@school.example"), "success")
+        self.assertEqual(Notification.objects.filter(state=State.pending()).count(), 2)
+        self.assertEqual(self.bus.messages, [])
+
+    def test_worker_sends_and_records_the_confirmation(self):
+        # The transaction is still in the audit writer's buffer, so it is not in the database yet
+        transaction = Transaction(transaction_type=TransactionType.objects.create(name="Login"))
+        TransactionLogBase.send_notification(create_notification_detail(
+            message_code="SC0009", message_type="2", message="Hello", destination="a@school.example"), transaction)
+        self.assertEqual(self.worker.run_once(), 1)
+        notification = Notification.objects.get()
+        self.assertEqual((notification.state, notification.response), (State.sent(), "CONF-1"))
+        self.assertIsNone(notification.next_attempt_at)
+        self.assertEqual(self.worker.run_once(), 0)
+
+    def test_a_batch_shares_one_token(self):
+        self.queue(*["%s@school.example" % n for n in range(6)])
+        self.assertEqual(self.worker.run_once(), 6)
+        self.assertEqual(Notification.objects.filter(state=State.sent()).count(), 6)
+        self.assertEqual(self.bus.token_requests, 1)
+        self.assertLessEqual(len(self.bus.ports), 2)
+
+    def test_claim_leases_a_batch(self):
+        self.queue("a@school.example", "b@school.example")
+        claimed = self.worker.claim()
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual(self.worker.claim(), [])
+        lease_until = timezone.now() + timedelta(seconds=settings.NOTIFICATION_LEASE_SECONDS)
+        for notification in Notification.objects.all():
+            self.assertAlmostEqual(notification.next_attempt_at, lease_until, delta=timedelta(seconds=5))
+        # A lease that is never settled runs out and the notification is picked up again
+        Notification.objects.update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(len(self.worker.claim()), 2)
+
+    def test_failures_back_off_then_fail(self):
+        self.queue(StubBus.REJECTED)
+        with self.assertLogs("base.backend.notification_worker", "WARNING"):
+            self.worker.run_once()
+        notification = Notification.objects.get()
+        self.assertEqual((notification.state, notification.attempts), (State.pending(), 1))
+        self.assertAlmostEqual(
+            notification.next_attempt_at, timezone.now() + timedelta(seconds=30), delta=timedelta(seconds=5))
+        Notification.objects.update(next_attempt_at=timezone.now())
+        with self.assertLogs("base.backend.notification_worker", "WARNING"):
+            self.worker.run_once()
+        notification.refresh_from_db()
+        self.assertAlmostEqual(
+            notification.next_attempt_at, timezone.now() + timedelta(seconds=60), delta=timedelta(seconds=5))
+        Notification.objects.update(next_attempt_at=timezone.now())
+        with self.assertLogs("base.backend.notification_worker", "WARNING"):
+            self.worker.run_once()
+        notification.refresh_from_db()
+        self.assertEqual((notification.state, notification.attempts), (State.failed(), 3))
+        self.assertIsNone(notification.next_attempt_at)
+
+    def test_attachments_go_through_the_outbox(self):
+        self.queue("a@school.example", files={"attachment": ("timetable.txt", "Monday: English", "text/plain")})
+        notification = Notification.objects.get()
+        self.assertEqual(notification.state, State.pending())
+        self.assertEqual(notification.attachments[0][:2], ["attachment", "timetable.txt"])
+        self.assertEqual(self.bus.messages, [])
+        self.worker.run_once()
+        self.assertIn(b'filename="timetable.txt"', self.bus.messages[0])
+        self.assertIn(b"Monday: English", self.bus.messages[0])
+        self.assertEqual(Notification.objects.get().state, State.sent())
+
+
+class AuditArchiverTests(SchoolTestCase):
+    """
+    Runs against whichever database is configured. On PostgreSQL the closed months are partitions that are detached,
+    written out and dropped; elsewhere they are plain rows that are written out and deleted. Either way the
+    database ends up holding only the retained months and every archived row is in its month's file.
+    """
+
+    def setUp(self):
+        super().setUp()
+        archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_dir.cleanup)
+        self.archive_dir = archive_dir.name
+        self.archiver = AuditArchiver(archive_dir=self.archive_dir, retention_months=3, chunk_size=2)
+        self.this_month = month_start(timezone.now())
+        self.months = {
+            "closed": add_months(self.this_month, -5), "older": add_months(self.this_month, -4),
+            "retained": add_months(self.this_month, -1), "current": self.this_month}
+        self.transaction_type = TransactionType.objects.create(name="Login", state=State.active())
+        self.notification_type = NotificationType.objects.create(name="EMAIL", state=State.active())
+        self.transactions = {
+            name: [self.log(start + timedelta(days=day)) for day in (1, 2, 3)] for name, start in self.months.items()}
+
+    def log(self, date_created):
+        return Transaction.objects.create(
+            transaction_type=self.transaction_type, date_created=date_created, response_code="100.000.000")
+
+    def notify(self, date_created, state):
+        return Notification.objects.create(
+            notification_type=self.notification_type, title="SC0009", message="Hello",
+            destination="parent@school.example", state=state, date_created=date_created)
+
+    def archived(self, table, start):
+        with gzip.open(os.path.join(self.archive_dir, table, "%s.jsonl.gz" % start.strftime("%Y-%m"))) as f:
+            return [json.loads(line) for line in f]
+
+    def test_closed_months_are_archived_and_removed(self):
+        self.notify(self.months["closed"] + timedelta(days=1), State.sent())
+        self.notify(self.months["current"], State.sent())
+        report = self.archiver.archive()
+        self.assertEqual(
+            [(period["period"], period["rows"]) for period in report["base_transaction"]],
+            [(self.months["closed"].strftime("%Y-%m"), 3), (self.months["older"].strftime("%Y-%m"), 3)])
+        self.assertEqual([period["rows"] for period in report["base_notification"]], [1])
+        for name in ("closed", "older"):
+            rows = self.archived("base_transaction", self.months[name])
+            self.assertEqual(
+                [row["id"] for row in rows], [str(transaction.id) for transaction in self.transactions[name]])
+            self.assertEqual(rows[0]["response_code"], "100.000.000")
+        self.assertEqual(
+            set(Transaction.objects.values_list("id", flat=True)),
+            {transaction.id for name in ("retained", "current") for transaction in self.transactions[name]})
+        self.assertEqual(Notification.objects.count(), 1)
+        self.assertEqual(self.archiver.archive(), {"base_transaction": [], "base_notification": []})
+
+    def test_months_with_pending_notifications_are_held_back(self):
+        self.notify(self.months["closed"] + timedelta(days=1), State.pending())
+        with self.assertLogs("base.backend.audit_archive", "WARNING"):
+            report = self.archiver.archive()
+        self.assertEqual(report["base_notification"], [])
+        self.assertEqual(Notification.objects.count(), 1)
+
+    def test_a_month_archived_again_gets_another_file(self):
+        self.archiver.archive()
+        # Flushed late from a dead worker's journal
+        self.log(self.months["closed"] + timedelta(days=4))
+        report = self.archiver.archive()
+        self.assertEqual(report["base_transaction"][0]["rows"], 1)
+        self.assertEqual(len(os.listdir(os.path.join(self.archive_dir, "base_transaction"))), 3)
+
+    @skipIf(connection.vendor == "postgresql", "Partitions are detached before they are written out")
+    def test_rows_arriving_while_a_month_is_written_are_kept(self):
+        write = self.archiver.write
+        late = []
+
+        def write_then_log(model, start, rows):
+            written = write(model, start, rows)
+            if model is Transaction and not late:
+                late.append(self.log(start + timedelta(days=5)))
+            return written
+
+        with mock.patch.object(self.archiver, "write", side_effect=write_then_log):
+            self.archiver.archive()
+        self.assertEqual(list(Transaction.objects.filter(date_created__lt=self.months["retained"])), late)
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command("archive_audit_logs", "--archive-dir", self.archive_dir, "--retention-months", "3", stdout=out)
+        self.assertIn(
+            "base_transaction %s: archived 3 rows to" % self.months["closed"].strftime("%Y-%m"), out.getvalue())
+
+    def test_admin_lists_this_month_by_default(self):
+        admin_user = self.make_user("auditor", role=Role.admin(), is_staff=True, is_superuser=True)
+        self.client.force_login(admin_user)
+        response = self.client.get(reverse("admin:base_transaction_changelist"))
+        self.assertEqual(
+            {row.id for row in response.context["cl"].result_list},
+            {transaction.id for transaction in self.transactions["current"]})
+        response = self.client.get(reverse("admin:base_transaction_changelist"), {"period": "previous"})
+        self.assertEqual(
+            {row.id for row in response.context["cl"].result_list},
+            {transaction.id for transaction in self.transactions["retained"]})
+
+    @skipIf(connection.vendor == "postgresql", "Covered by test_tables_are_partitioned_by_month")
+    def test_plain_tables_have_no_partitions(self):
+        self.assertFalse(self.archiver.partitioned(Transaction))
+        self.assertEqual(self.archiver.ensure_partitions(), [])
+
+    @skipUnless(connection.vendor == "postgresql", "Partitions need PostgreSQL")
+    def test_tables_are_partitioned_by_month(self):
+        for model in (Transaction, Notification):
+            self.assertTrue(self.archiver.partitioned(model))
+            partitions = self.archiver.partitions(model)
+            self.assertIn("%s_default" % model._meta.db_table, partitions)
+            self.assertIn(self.archiver.partition_name(model, self.this_month), partitions)
+        ahead = add_months(self.this_month, settings.AUDIT_PARTITION_MONTHS_AHEAD + 2)
+        self.archiver.ensure_partitions(months_ahead=settings.AUDIT_PARTITION_MONTHS_AHEAD + 2)
+        self.assertIn(self.archiver.partition_name(Transaction, ahead), self.archiver.partitions(Transaction))
+        # The closed month predates the migration, so its rows sit in the default partition until it gets its own
+        closed = self.archiver.partition_name(Transaction, self.months["closed"])
+        with mock.patch("base.backend.audit_archive.timezone.now", return_value=self.months["closed"]):
+            self.assertIn(closed, self.archiver.ensure_partitions(months_ahead=0))
+        report = self.archiver.archive()
+        self.assertEqual(report["base_transaction"][0]["rows"], 3)
+        self.assertEqual(len(self.archived("base_transaction", self.months["closed"])), 3)
+        self.assertNotIn(closed, self.archiver.partitions(Transaction))
+        self.assertEqual(self.archiver.detached_partitions(Transaction), [])
+
+
+# Hashed with a fast hasher, as the generator and login only need some password to check
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class SyntheticDataTests(SchoolTestCase):
+    SIZES = {
+        "classrooms": 2, "students": 3, "teachers": 2, "clerks": 1, "admins": 1, "authors": 5, "publishers": 2,
+        "books": 20, "loans": 30}
+
+    def generate(self, seed=7):
+        with self.captureOnCommitCallbacks(execute=True):
+            return SyntheticSchoolData(seed=seed).generate(**self.SIZES)
+
+    def rows(self):
+        return {model.__name__: set(model.objects.filter(**{lookup: "bench7"}).values_list("id", flat=True))
+                for model, lookup in ((School, "code__startswith"), (User, "username__startswith"),
+                                      (Book, "number__startswith"), (UserBook, "book__number__startswith"))}
+
+    def test_counts(self):
+        counts = self.generate()
+        self.assertEqual(counts, {
+            "Author": 5, "Publisher": 2, "School": 1, "Classroom": 2, "User": 10, "Book": 20, "UserBook": 30})
+        school = School.objects.get(code="bench7-1")
+        self.assertEqual(User.objects.filter(school=school, role=Role.student(), classroom__isnull=False).count(), 6)
+
+    def test_same_seed_same_rows(self):
+        self.generate()
+        rows = self.rows()
+        self.assertGreater(SyntheticSchoolData(seed=7).flush(), sum(len(ids) for ids in rows.values()))
+        self.assertFalse(Author.objects.filter(name__startswith="bench7 ").exists())
+        self.assertEqual(self.rows(), {name: set() for name in rows})
+        self.generate()
+        self.assertEqual(self.rows(), rows)
+
+    def test_open_loans_match_the_books(self):
+        self.generate()
+        open_loans = UserBook.objects.filter(book__number__startswith="bench7", returned_at__isnull=True)
+        self.assertEqual(
+            set(open_loans.values_list("book_id", "id")),
+            set(Book.objects.filter(state=State.issued()).values_list("id", "current_loan_id")))
+        self.assertEqual(open_loans.count(), open_loans.values("book").distinct().count())
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command(
+            "generate_school_data", "--seed", "7", "--classrooms", "1", "--students", "2", "--books", "3",
+            "--loans", "2", "--authors", "1", "--publishers", "1", stdout=out)
+        self.assertIn("Book: 3", out.getvalue())
+        call_command("generate_school_data", "--seed", "7", "--flush", "--books", "0", "--loans", "0", stdout=out)
+        self.assertEqual(Book.objects.filter(number__startswith="bench7").count(), 0)
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class EndpointBenchmarkTests(SchoolTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            SyntheticSchoolData(seed=7).generate(
+                classrooms=1, students=5, teachers=1, clerks=1, admins=1, authors=3, publishers=1, books=30, loans=5)
+        self.school = EndpointBenchmark.find_school()
+
+    def counts(self):
+        return [model.objects.count() for model in (Identity, UserBook, Transaction, Notification)]
+
+    def test_run_reports_every_endpoint_and_leaves_nothing_behind(self):
+        before = self.counts()
+        results = EndpointBenchmark(self.school, iterations=3, warmup=1).run()
+        self.assertEqual(results["school"], "bench7-1")
+        self.assertEqual(list(results["endpoints"]), list(EndpointBenchmark.ENDPOINTS))
+        for endpoint, stats in results["endpoints"].items():
+            self.assertEqual(stats["errors"], 0, endpoint)
+            self.assertLessEqual(stats["p50_ms"], stats["p99_ms"])
+            self.assertGreater(stats["queries_mean"], 0)
+        self.assertEqual(self.counts(), before)
+
+    def test_percentiles(self):
+        self.assertEqual(EndpointBenchmark.percentile([4, 1, 3, 2], 50), 2.5)
+        self.assertEqual(EndpointBenchmark.percentile([1, 2, 3, 4, 5], 95), 4.8)
+        self.assertIsNone(EndpointBenchmark.percentile([], 50))
+
+    def test_command_checks_the_indexes(self):
+        output = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+        output.close()
+        self.addCleanup(os.remove, output.name)
+        out = io.StringIO()
+        call_command(
+            "benchmark_endpoints", "--iterations", "2", "--warmup", "0", "--endpoint", "filter_books",
+            "--endpoint", "issue_book", "--check-indexes", "--output", output.name, stdout=out)
+        self.assertIn("Every query the endpoints ran has an index", out.getvalue())
+        with open(output.name) as f:
+            self.assertEqual(list(json.load(f)["endpoints"]), ["filter_books", "issue_book"])
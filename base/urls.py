@@ -2,11 +2,14 @@ from django.urls import re_path
 
 from base.views import BaseAdministration
 
+app_name = 'base'
+
 urlpatterns = [
-    re_path(r'create-classroom/$', BaseAdministration().create_classroom),
-    re_path(r'edit-classroom/$', BaseAdministration().edit_classroom),
-    re_path(r'delete-classroom/$', BaseAdministration().delete_classroom),
-    re_path(r'get-classrooms/$', BaseAdministration().get_classrooms),
-    re_path(r'get-schools/$', BaseAdministration().get_schools),
-    re_path(r'get-subjects/$', BaseAdministration().get_subjects),
-]
\ No newline at end of file
+    re_path(r'create-classroom/$', BaseAdministration().create_classroom, name='create-classroom'),
+    re_path(r'edit-classroom/$', BaseAdministration().edit_classroom, name='edit-classroom'),
+    re_path(r'delete-classroom/$', BaseAdministration().delete_classroom, name='delete-classroom'),
+    re_path(r'get-classrooms/$', BaseAdministration().get_classrooms, name='get-classrooms'),
+    re_path(r'get-schools/$', BaseAdministration().get_schools, name='get-schools'),
+    re_path(r'get-subjects/$', BaseAdministration().get_subjects, name='get-subjects'),
+    re_path(r'query-metrics/$', BaseAdministration().query_metrics, name='query-metrics'),
+]
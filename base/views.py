@@ -1,12 +1,15 @@
 import logging
 
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import JsonResponse, HttpResponse, HttpResponseForbidden
 from django.views.decorators.csrf import csrf_exempt
 
+from base.backend.query_metrics import query_metrics
 from base.backend.services import ClassroomService, SchoolService, SubjectService
 from base.models import State
-from users.backend.decorators import user_login_required
+from users.backend.decorators import user_login_required, admin
 from users.backend.services import UserService
+from utils.common import get_peer_ip
 from utils.get_request_data import get_request_data
 
 lgr = logging.getLogger(__name__)
@@ -160,3 +163,17 @@ class BaseAdministration(object):
             lgr.exception("Get subjects exception: %s" % e)
             return JsonResponse({"code": "999.999.999", "message": "Get subjects failed with an exception", "error": e})
 
+    @csrf_exempt
+    @user_login_required
+    @admin
+    def query_metrics(self, request):
+        """
+        Exposes the per view query and latency totals of this process to Prometheus
+        @param: WSGI Request from an admin, only served to the addresses in QUERY_METRICS_ALLOWED_IPS as seen through
+        the proxies in QUERY_METRICS_TRUSTED_PROXIES
+        @return: The metrics in the Prometheus text format
+        @rtype: HttpResponse
+        """
+        if get_peer_ip(request, settings.QUERY_METRICS_TRUSTED_PROXIES) not in settings.QUERY_METRICS_ALLOWED_IPS:
+            return HttpResponseForbidden()
+        return HttpResponse(query_metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from books.models import Author, Publisher, BookCategory, Book, UserBook
+from books.models import Author, Publisher, BookCategory, Book, UserBook, LoanPolicy, LibraryStat
 
 
 @admin.register(Author)
@@ -31,9 +31,20 @@ class BookAdmin(admin.ModelAdmin):
 
 @admin.register(UserBook)
 class UserBookAdmin(admin.ModelAdmin):
-	list_display = ('user', 'book', 'state', 'date_modified', 'date_created')
+	list_display = ('user', 'book', 'state', 'due_at', 'returned_at', 'date_modified', 'date_created')
 	search_fields = (
         'user__id', 'user__id_no', 'user__reg_no', 'user__first_name', 'user__last_name', 'book__title',
 		'book__author__name', 'book__publisher__name', 'book__category__name', 'book__publication_year',
 		'book__school__name', 'book__school__code', 'state__name'
     )
+
+@admin.register(LoanPolicy)
+class LoanPolicyAdmin(admin.ModelAdmin):
+	list_display = ('school', 'category', 'loan_days', 'state', 'date_modified', 'date_created')
+	search_fields = ('school__name', 'school__code', 'category__name', 'state__name')
+
+@admin.register(LibraryStat)
+class LibraryStatAdmin(admin.ModelAdmin):
+	list_display = ('school', 'kind', 'key', 'label', 'count', 'date_modified')
+	list_filter = ('kind',)
+	search_fields = ('school__name', 'school__code', 'key', 'label')
@@ -0,0 +1,208 @@
+import logging
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import IntegrityError, models, transaction as trx
+from django.db.models import Case, Count, F, Q, Value, When
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from base.models import State, School
+from books.models import Book, UserBook, LibraryStat
+
+lgr = logging.getLogger(__name__)
+
+
+class LibraryStats(object):
+    """
+    Keeps each school's library dashboard in the LibraryStat summary table so reading it never aggregates over Book
+    or UserBook. Issuing and returning books move the counts once the loan has committed, and adding or removing a
+    book does the same through the Book signals, so the few rows every loan touches are never held locked for the
+    length of a loan's transaction. Each change is one insert of any missing rows and one UPDATE adding every delta.
+    recompute rebuilds a school's counts from the source tables and is run nightly to correct drift from writes that
+    bypass LoanEngine and the signals, such as edits, bulk imports and deletions, and from changes lost when a
+    process died between a commit and its counts.
+    """
+    SUMMARY_KINDS = (LibraryStat.BOOKS_BY_STATE, LibraryStat.BOOKS_BY_CATEGORY, LibraryStat.LOANS_BY_MONTH)
+
+    @staticmethod
+    def month(value):
+        return timezone.localtime(value).strftime("%Y-%m")
+
+    @staticmethod
+    def full_name(first_name, last_name):
+        return " ".join(name for name in (first_name, last_name) if name)
+
+    def record(self, school_id, changes):
+        """
+        Adds the given deltas to a school's counts once the current transaction commits, or at once outside one.
+        The deltas are dropped if the transaction rolls back.
+        @param school_id: The id of the school.
+        @type school_id: str
+        @param changes: The (label, delta) to apply to each (kind, key).
+        @type changes: dict
+        """
+        changes = {(kind, str(key)[:255]): change for (kind, key), change in changes.items() if change[1]}
+        if changes:
+            trx.on_commit(lambda: self.apply(school_id, changes))
+
+    def apply(self, school_id, changes):
+        """
+        Writes deltas to a school's counts, creating the rows they are missing. Failures are logged rather than
+        raised, as the change they count has already been committed; the next recompute puts the counts right.
+        @param school_id: The id of the school.
+        @type school_id: str
+        @param changes: The (label, delta) to apply to each (kind, key).
+        @type changes: dict
+        """
+        keys = {}
+        for kind, key in changes:
+            keys.setdefault(kind, []).append(key)
+        try:
+            with trx.atomic():
+                # Decrements create rows too, so one arriving before its row exists is not lost
+                LibraryStat.objects.bulk_create([
+                    LibraryStat(school_id=school_id, kind=kind, key=key, label=(label or "")[:255] or None, count=0)
+                    for (kind, key), (label, delta) in changes.items()], ignore_conflicts=True)
+                LibraryStat.objects.filter(
+                    reduce(or_, [Q(kind=kind, key__in=kind_keys) for kind, kind_keys in keys.items()]),
+                    school_id=school_id).update(
+                    count=F("count") + Case(
+                        *[When(kind=kind, key=key, then=Value(delta))
+                          for (kind, key), (label, delta) in changes.items()],
+                        default=Value(0), output_field=models.BigIntegerField()),
+                    date_modified=timezone.now())
+        except IntegrityError as e:
+            # The school was deleted along with its books
+            if School.objects.filter(id=school_id).exists():
+                lgr.exception("LibraryStats apply exception: %s" % e)
+        except Exception as e:
+            lgr.exception("LibraryStats apply exception: %s" % e)
+
+    def issued(self, school_id, loans):
+        """
+        Counts books lent out.
+        @param school_id: The id of the books' school.
+        @type school_id: str
+        @param loans: The (user_id, borrower's name, book title) of each loan.
+        @type loans: list
+        """
+        if not loans:
+            return
+        issued, idle = State.issued().name, State.idle().name
+        changes = {
+            (LibraryStat.BOOKS_BY_STATE, issued): [issued, len(loans)],
+            (LibraryStat.BOOKS_BY_STATE, idle): [idle, -len(loans)],
+            (LibraryStat.LOANS_BY_MONTH, self.month(timezone.now())): [None, len(loans)],
+        }
+        for user_id, name, title in loans:
+            changes.setdefault((LibraryStat.BORROWERS, str(user_id)), [name, 0])[1] += 1
+            changes.setdefault((LibraryStat.TITLES, title), [title, 0])[1] += 1
+        self.record(school_id, {key: tuple(change) for key, change in changes.items()})
+
+    def returned(self, school_id, count):
+        """
+        Counts books brought back.
+        @param school_id: The id of the books' school.
+        @type school_id: str
+        @param count: The number of books returned.
+        @type count: int
+        """
+        idle, issued = State.idle().name, State.issued().name
+        self.record(school_id, {
+            (LibraryStat.BOOKS_BY_STATE, idle): (idle, count),
+            (LibraryStat.BOOKS_BY_STATE, issued): (issued, -count)})
+
+    def book_changed(self, book, delta):
+        """
+        Counts a book added to (delta 1) or removed from (delta -1) a school's catalogue.
+        @type book: Book
+        @type delta: int
+        """
+        self.record(book.school_id, {
+            (LibraryStat.BOOKS_BY_STATE, book.state.name): (book.state.name, delta),
+            (LibraryStat.BOOKS_BY_CATEGORY, book.category_id): (book.category.name, delta)})
+
+    def recompute(self, school):
+        """
+        Rebuilds a school's counts from Book and UserBook.
+        @param school: The school.
+        @type school: School
+        @return: The number of summary rows written.
+        @rtype: int
+        """
+        books = Book.objects.filter(school=school).order_by()
+        loans = UserBook.objects.filter(book__school=school).order_by()
+        rows = []
+        for name, count in books.values_list("state__name").annotate(count=Count("id")):
+            rows.append(LibraryStat(kind=LibraryStat.BOOKS_BY_STATE, key=name, label=name, count=count))
+        for category_id, name, count in books.values_list("category_id", "category__name").annotate(
+                count=Count("id")):
+            rows.append(LibraryStat(kind=LibraryStat.BOOKS_BY_CATEGORY, key=category_id, label=name, count=count))
+        for month, count in loans.annotate(month=TruncMonth("date_created")).values_list("month").annotate(
+                count=Count("id")):
+            rows.append(LibraryStat(kind=LibraryStat.LOANS_BY_MONTH, key=self.month(month), count=count))
+        for user_id, first_name, last_name, count in loans.values_list(
+                "user_id", "user__first_name", "user__last_name").annotate(count=Count("id")):
+            rows.append(LibraryStat(
+                kind=LibraryStat.BORROWERS, key=user_id, label=self.full_name(first_name, last_name), count=count))
+        for title, count in loans.values_list("book__title").annotate(count=Count("id")):
+            rows.append(LibraryStat(kind=LibraryStat.TITLES, key=title, label=title, count=count))
+        for row in rows:
+            row.school = school
+            row.key = str(row.key)[:255]
+            row.label = row.label[:255] if row.label else None
+        with trx.atomic():
+            LibraryStat.objects.filter(school=school).delete()
+            LibraryStat.objects.bulk_create(rows, batch_size=settings.LIBRARY_STATS_BATCH_SIZE)
+        return len(rows)
+
+    def recompute_all(self):
+        """
+        Rebuilds the counts of every active school, one school per transaction.
+        @return: The number of summary rows written per school code.
+        @rtype: dict
+        """
+        written = {}
+        for school in School.objects.filter(state=State.active()).order_by("code"):
+            try:
+                written[school.code] = self.recompute(school)
+            except Exception as e:
+                lgr.exception("LibraryStats recompute %s exception: %s" % (school.code, e))
+        return written
+
+    def summary(self, school, top=None):
+        """
+        Reads a school's dashboard from the summary table.
+        @param school: The school.
+        @type school: School
+        @param top: How many top borrowers and titles to list, defaults to LIBRARY_STATS_TOP_SIZE.
+        @type top: int | None
+        @rtype: dict
+        """
+        top = max(min(int(top or settings.LIBRARY_STATS_TOP_SIZE), settings.LIBRARY_STATS_MAX_TOP_SIZE), 1)
+        stats = LibraryStat.objects.filter(school=school, count__gt=0)
+        summary = {kind: [] for kind in self.SUMMARY_KINDS}
+        for kind, key, label, count in stats.filter(kind__in=self.SUMMARY_KINDS).values_list(
+                "kind", "key", "label", "count"):
+            summary[kind].append((key, label, count))
+        return {
+            "books_by_state": {label or key: count for key, label, count in summary[LibraryStat.BOOKS_BY_STATE]},
+            "books_by_category": [
+                {"category_id": key, "category_name": label, "count": count}
+                for key, label, count in sorted(summary[LibraryStat.BOOKS_BY_CATEGORY], key=lambda row: -row[2])],
+            "loans_by_month": [
+                {"month": key, "count": count} for key, label, count in sorted(summary[LibraryStat.LOANS_BY_MONTH])],
+            "top_borrowers": [
+                {"user_id": key, "name": label, "count": count}
+                for key, label, count in stats.filter(kind=LibraryStat.BORROWERS).order_by("-count").values_list(
+                    "key", "label", "count")[:top]],
+            "most_borrowed_titles": [
+                {"title": label or key, "count": count}
+                for key, label, count in stats.filter(kind=LibraryStat.TITLES).order_by("-count").values_list(
+                    "key", "label", "count")[:top]],
+        }
+
+
+library_stats = LibraryStats()
@@ -0,0 +1,74 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+
+from base.models import State
+from books.models import LoanPolicy
+
+lgr = logging.getLogger(__name__)
+
+
+class LoanPolicyCache(object):
+    """
+    The loan period of each school's books, by category. A school's policies are read in one query and kept in the
+    Django cache so every worker shares them; saving or deleting a policy drops its school's entry.
+    Books of a category without a policy use the school's default policy, and LOAN_DEFAULT_DAYS without one.
+    """
+
+    @staticmethod
+    def key(school_id):
+        return "books:loan_policy:%s" % school_id
+
+    def policies(self, school_id):
+        """
+        Fetches a school's active loan periods.
+        @param school_id: The id of the school.
+        @type school_id: str
+        @return: The loan days by category id, with the school's default under None.
+        @rtype: dict
+        """
+        key = self.key(school_id)
+        policies = cache.get(key)
+        if policies is None:
+            policies = {
+                str(category_id) if category_id else None: loan_days
+                for category_id, loan_days in LoanPolicy.objects.filter(
+                    school_id=school_id, state=State.active()).values_list("category_id", "loan_days")}
+            cache.set(key, policies, timeout=settings.LOAN_POLICY_CACHE_SECONDS)
+        return policies
+
+    def by_category(self, school_id):
+        """
+        @return: Whether any of the school's policies is for a single category, i.e. whether the due date of a loan
+        depends on its book's category.
+        @rtype: bool
+        """
+        return any(category_id is not None for category_id in self.policies(school_id))
+
+    def due_at(self, school_id, category_id, start):
+        """
+        Works out when a loan is due back.
+        @param school_id: The id of the book's school.
+        @type school_id: str
+        @param category_id: The id of the book's category, if known.
+        @type category_id: str | None
+        @param start: When the loan started.
+        @type start: datetime
+        @rtype: datetime
+        """
+        policies = self.policies(school_id)
+        loan_days = policies.get(str(category_id) if category_id else None)
+        if loan_days is None:
+            loan_days = policies.get(None, settings.LOAN_DEFAULT_DAYS)
+        return start + timedelta(days=loan_days)
+
+    def invalidate(self, school_id):
+        try:
+            cache.delete(self.key(school_id))
+        except Exception as e:
+            lgr.exception("LoanPolicyCache invalidate exception: %s" % e)
+
+
+loan_policies = LoanPolicyCache()
@@ -0,0 +1,279 @@
+import logging
+import uuid
+
+from django.db import IntegrityError, connection, models, transaction as trx
+from django.db.models import Case, Value, When
+from django.utils import timezone
+
+from base.models import State
+from books.backend.library_stats import library_stats
+from books.backend.loan_policy import loan_policies
+from books.models import Book, UserBook
+from users.models import User
+
+lgr = logging.getLogger(__name__)
+
+
+class LoanEngine(object):
+    """
+    Issues and returns books without read-then-write races.
+    A copy is claimed with a single conditional UPDATE that only matches while it is idle, so of two desks issuing
+    the same copy at once exactly one gets it. The open loan is the UserBook row without returned_at, and the
+    userbook_one_open_loan constraint keeps it to one per book whatever writes the table. The same UPDATE points the
+    book at its borrower and loan (current_borrower, current_loan, loan_started_at), and returning clears them.
+    Loans are due back after the loan period of the book's school and category, see LoanPolicyCache. Every issue
+    and return also moves the school's LibraryStat counts once it has committed.
+    """
+    CLAIM_ATTEMPTS = 3
+
+    @staticmethod
+    def issue(user, book_id):
+        """
+        Lends a book to a user.
+        @param user: The borrower.
+        @type user: User
+        @param book_id: The id of the book, which has to be idle and belong to the borrower's school.
+        @type book_id: str
+        @return: The open loan.
+        @rtype: UserBook
+        """
+        now = timezone.now()
+        # The loan's id is known up front so the claim can point the book at it
+        loan_id = uuid.uuid4()
+        book = Book.objects.filter(id=book_id, school_id=user.school_id).values_list("title", "category_id").first()
+        if book is None:
+            raise LoanError("Book not found")
+        title, category_id = book
+        due_at = loan_policies.due_at(user.school_id, category_id, now)
+        try:
+            with trx.atomic():
+                claimed = Book.objects.filter(id=book_id, school_id=user.school_id, state=State.idle()).update(
+                    state=State.issued(), current_borrower=user, current_loan_id=loan_id, loan_started_at=now,
+                    date_modified=now)
+                if not claimed:
+                    raise LoanError(LoanEngine.unavailable(user, book_id))
+                loan = UserBook.objects.create(
+                    id=loan_id, user=user, book_id=book_id, state=State.active(), due_at=due_at)
+                library_stats.issued(
+                    user.school_id, [(user.id, library_stats.full_name(user.first_name, user.last_name), title)])
+                return loan
+        except IntegrityError:
+            raise LoanError("Book already issued")
+
+    @staticmethod
+    def give_back(book_id):
+        """
+        Closes a book's open loan and makes the book available again. Earlier loans of the book are left as they are.
+        @param book_id: The id of the book.
+        @type book_id: str
+        @return: The number of loans closed, always 1.
+        @rtype: int
+        """
+        now = timezone.now()
+        school_id = Book.objects.filter(id=book_id).values_list("school_id", flat=True).first()
+        if school_id is None:
+            raise LoanError("Book not found")
+        # Looked up before the transaction, where a cold registry can warm instead of reading a row per lookup
+        returned, idle = State.returned(), State.idle()
+        with trx.atomic():
+            closed = UserBook.objects.filter(book_id=book_id, returned_at__isnull=True).update(
+                state=returned, returned_at=now, date_modified=now)
+            if not closed:
+                raise LoanError("Book not issued")
+            Book.objects.filter(id=book_id).update(
+                state=idle, current_borrower=None, current_loan=None, loan_started_at=None, date_modified=now)
+            library_stats.returned(school_id, closed)
+        return closed
+
+    def issue_many(self, school, pairs):
+        """
+        Lends many books at once, e.g. a classroom's textbooks at the start of term. The borrowers are checked in one
+        query, the idle copies claimed with one locking read and one UPDATE and the loans inserted with one
+        bulk_create, all in a single transaction. A pair that cannot be issued does not stop the others.
+        @param school: The school the borrowers and books belong to.
+        @type school: School
+        @param pairs: The (user_id, book_id) pairs to issue.
+        @type pairs: list
+        @return: The result of each pair, in the order given.
+        @rtype: list
+        """
+        pairs = [(str(user_id), str(book_id)) for user_id, book_id in pairs]
+        results = [{"user_id": user_id, "book_id": book_id} for user_id, book_id in pairs]
+        users = {
+            str(user_id): library_stats.full_name(first_name, last_name)
+            for user_id, first_name, last_name in User.objects.filter(
+                id__in={user_id for user_id, book_id in pairs if self.valid_id(user_id)}, school=school,
+                state=State.active()).values_list("id", "first_name", "last_name")}
+        wanted, seen = {}, set()
+        for index, (user_id, book_id) in enumerate(pairs):
+            if not self.valid_id(book_id):
+                results[index]["error"] = "Book not found"
+            elif user_id not in users:
+                results[index]["error"] = "User not found"
+            elif book_id in seen:
+                results[index]["error"] = "Book listed more than once"
+            else:
+                wanted[book_id] = index
+            seen.add(book_id)
+        loans = {book_id: (pairs[index][0], uuid.uuid4()) for book_id, index in wanted.items()}
+        refused = {}
+        attempt = 0
+        while True:
+            try:
+                with trx.atomic():
+                    claimed = self.claim(school, loans)
+                    now = timezone.now()
+                    UserBook.objects.bulk_create([
+                        UserBook(id=loans[book_id][1], user_id=loans[book_id][0], book_id=book_id,
+                                 state=State.active(), due_at=loan_policies.due_at(school.id, category_id, now))
+                        for book_id, (category_id, title) in claimed.items()])
+                    library_stats.issued(school.id, [
+                        (loans[book_id][0], users[loans[book_id][0]], title)
+                        for book_id, (category_id, title) in claimed.items()])
+                break
+            except LoanConflict:
+                # Another desk claimed one of the copies between our read and our write; start over
+                attempt += 1
+                if attempt == self.CLAIM_ATTEMPTS:
+                    raise LoanError("Books are being issued elsewhere, try again")
+            except IntegrityError:
+                # An idle copy that still has an open loan, e.g. written outside the engine, fails the same way every
+                # time, so leave those copies out and issue the rest
+                open_loans = self.open_loans(list(loans))
+                if not open_loans:
+                    raise
+                for book_id in open_loans:
+                    loans.pop(book_id)
+                    refused[book_id] = "Book already has an open loan"
+        unavailable = self.unavailable_many(
+            school, [book_id for book_id in wanted if book_id not in claimed and book_id not in refused])
+        for book_id, index in wanted.items():
+            if book_id in claimed:
+                results[index]["issued"] = True
+            else:
+                results[index]["error"] = refused.get(book_id) or unavailable[book_id]
+        for result in results:
+            result.setdefault("issued", False)
+        return results
+
+    def give_back_many(self, school, book_ids):
+        """
+        Closes the open loans of many books in one transaction.
+        @param school: The school the books belong to.
+        @type school: School
+        @param book_ids: The ids of the books.
+        @type book_ids: list
+        @return: The result of each book, in the order given.
+        @rtype: list
+        """
+        book_ids = list(dict.fromkeys(str(book_id) for book_id in book_ids))
+        now = timezone.now()
+        with trx.atomic():
+            loans = UserBook.objects.filter(
+                book_id__in=[book_id for book_id in book_ids if self.valid_id(book_id)], book__school=school,
+                returned_at__isnull=True)
+            if connection.features.has_select_for_update_skip_locked:
+                loans = loans.select_for_update(skip_locked=True, of=("self",))
+            loans = dict(loans.values_list("book_id", "id"))
+            UserBook.objects.filter(id__in=list(loans.values()), returned_at__isnull=True).update(
+                state=State.returned(), returned_at=now, date_modified=now)
+            Book.objects.filter(id__in=list(loans)).update(
+                state=State.idle(), current_borrower=None, current_loan=None, loan_started_at=None, date_modified=now)
+            library_stats.returned(school.id, len(loans))
+        returned = {str(book_id) for book_id in loans}
+        return [
+            {"book_id": book_id, "returned": True} if book_id in returned else
+            {"book_id": book_id, "returned": False, "error": "Book not issued"} for book_id in book_ids]
+
+    @staticmethod
+    def claim(school, loans):
+        """
+        Marks the idle books among the loans' books as issued to their borrowers, in one UPDATE.
+        On databases with SKIP LOCKED, copies another transaction is claiming are passed over instead of waited on.
+        @param loans: The (user_id, loan_id) to issue each book under, by book id.
+        @type loans: dict
+        @return: The category id and title of the books claimed, by book id.
+        @rtype: dict
+        """
+        if not loans:
+            return {}
+        books = Book.objects.filter(id__in=list(loans), school=school, state=State.idle())
+        if connection.features.has_select_for_update_skip_locked:
+            books = books.select_for_update(skip_locked=True)
+        claimed = {
+            str(book_id): (category_id, title)
+            for book_id, category_id, title in books.values_list("id", "category_id", "title")}
+        if not claimed:
+            return claimed
+        now = timezone.now()
+        updated = Book.objects.filter(id__in=list(claimed), state=State.idle()).update(
+            state=State.issued(),
+            current_borrower_id=Case(
+                *[When(id=book_id, then=Value(loans[book_id][0], output_field=models.UUIDField()))
+                  for book_id in claimed],
+                output_field=models.UUIDField()),
+            current_loan_id=Case(
+                *[When(id=book_id, then=Value(loans[book_id][1], output_field=models.UUIDField()))
+                  for book_id in claimed],
+                output_field=models.UUIDField()),
+            loan_started_at=now, date_modified=now)
+        if updated != len(claimed):
+            raise LoanConflict()
+        return claimed
+
+    @staticmethod
+    def open_loans(book_ids):
+        """
+        @return: The ids of the given books that have an open loan.
+        @rtype: set
+        """
+        return {
+            str(book_id) for book_id in UserBook.objects.filter(
+                book_id__in=book_ids, returned_at__isnull=True).values_list("book_id", flat=True)}
+
+    @staticmethod
+    def unavailable_many(school, book_ids):
+        """
+        Works out why each of the given books could not be claimed.
+        @rtype: dict
+        """
+        states = {
+            str(book_id): state_id for book_id, state_id in Book.objects.filter(
+                id__in=book_ids, school=school).values_list("id", "state_id")} if book_ids else {}
+        issued = State.issued().id
+        return {
+            book_id: "Book not found" if book_id not in states else
+            "Book already issued" if states[book_id] == issued else "Book not available"
+            for book_id in book_ids}
+
+    @staticmethod
+    def valid_id(value):
+        try:
+            uuid.UUID(str(value))
+            return True
+        except ValueError:
+            return False
+
+    @staticmethod
+    def unavailable(user, book_id):
+        """
+        Works out why a book could not be claimed; only runs when the claim failed.
+        @rtype: str
+        """
+        book = Book.objects.filter(id=book_id, school_id=user.school_id).values_list("state_id", flat=True).first()
+        if book is None:
+            return "Book not found"
+        if book == State.issued().id:
+            return "Book already issued"
+        return "Book not available"
+
+
+class LoanError(Exception):
+    pass
+
+
+class LoanConflict(Exception):
+    pass
+
+
+loan_engine = LoanEngine()
@@ -0,0 +1,87 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction as trx
+from django.db.models import Q
+from django.utils import timezone
+
+from base.models import State
+from books.models import UserBook
+from utils.common import create_notification_detail
+from utils.transaction_log_base import TransactionLogBase
+
+lgr = logging.getLogger(__name__)
+
+
+class OverdueScanner(object):
+    """
+    Reminds borrowers of overdue books. Open loans past their due_at are read a page at a time in (state, due_at)
+    index order, using the last due_at and id of a page as the cursor for the next, so a scan never counts or offsets
+    its way through the active loans. Each page's reminders are queued in one insert and the reminded loans stamped
+    with reminded_at in the same transaction, so a loan is reminded again only after OVERDUE_REMINDER_INTERVAL_HOURS
+    and a page whose reminders could not be queued is left as it was. Loans whose borrower has no email are not
+    stamped. Nothing is scanned while SEND_NOTIFICATIONS is off, since no reminder would be queued.
+    """
+    MESSAGE_CODE = "SC0010"
+
+    def __init__(self, batch_size=None, interval_hours=None):
+        self.batch_size = batch_size or settings.OVERDUE_SCAN_BATCH_SIZE
+        self.interval_hours = interval_hours if interval_hours is not None else \
+            settings.OVERDUE_REMINDER_INTERVAL_HOURS
+
+    def scan(self, now=None):
+        """
+        Queues a reminder for every overdue loan not reminded within the interval.
+        @param now: The time to scan as of, defaults to now.
+        @type now: datetime | None
+        @return: The number of loans found overdue, reminded and skipped for having no email to send to.
+        @rtype: dict
+        @raise OverdueScanError: When a page's reminders could not be queued. Earlier pages stay reminded.
+        """
+        counts = {"overdue": 0, "reminded": 0, "skipped": 0}
+        if not settings.SEND_NOTIFICATIONS:
+            lgr.warning("OverdueScanner - SEND_NOTIFICATIONS is off, no reminders queued")
+            return counts
+        now = now or timezone.now()
+        remind_before = now - timedelta(hours=self.interval_hours)
+        overdue = UserBook.objects.filter(state=State.active(), due_at__lt=now).filter(
+            Q(reminded_at__isnull=True) | Q(reminded_at__lt=remind_before)).order_by("due_at", "id")
+        cursor = None
+        while True:
+            page = overdue
+            if cursor is not None:
+                page = page.filter(Q(due_at__gt=cursor[0]) | Q(due_at=cursor[0], id__gt=cursor[1]))
+            page = list(page.values(
+                "id", "due_at", "user__email", "user__first_name", "book__title", "book__number")[:self.batch_size])
+            if not page:
+                return counts
+            cursor = (page[-1]["due_at"], page[-1]["id"])
+            notifications, reminded = [], []
+            for loan in page:
+                if loan["user__email"]:
+                    notifications += create_notification_detail(
+                        message_code=self.MESSAGE_CODE, message_type="2", message=self.message(loan),
+                        destination=loan["user__email"])
+                    reminded.append(loan["id"])
+            if notifications:
+                with trx.atomic():
+                    # send_notification logs and swallows its own errors, so they are kept to a savepoint
+                    with trx.atomic():
+                        result = TransactionLogBase.send_notification(notifications)
+                    if result != "success":
+                        raise OverdueScanError("Reminders not queued: %s" % result)
+                    UserBook.objects.filter(id__in=reminded).update(reminded_at=now)
+            counts["overdue"] += len(page)
+            counts["reminded"] += len(notifications)
+            counts["skipped"] += len(page) - len(notifications)
+
+    @staticmethod
+    def message(loan):
+        return "Dear %s, %s (%s) was due back on %s. Please return it to the library." % (
+            loan["user__first_name"] or "borrower", loan["book__title"], loan["book__number"],
+            timezone.localtime(loan["due_at"]).strftime("%Y-%m-%d"))
+
+
+class OverdueScanError(Exception):
+    pass
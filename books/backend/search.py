@@ -0,0 +1,122 @@
+import logging
+from collections import Counter
+
+from django.db import connection
+from django.db.models import Count, F, Q
+
+from books.backend.services import BookService
+from utils.pagination import KeysetPaginator, page_number
+from utils.search_index import PrefixIndex, SchoolSearchIndexes
+
+lgr = logging.getLogger(__name__)
+
+
+class BookSearch(object):
+    """
+    Type-ahead search of a school's catalogue over Book.search_document (number, title, author and publisher names),
+    returning counts of the matches by category, subject and state alongside the page of books.
+    Every word of the query must start a word of the document. On PostgreSQL the document has a pg_trgm GIN index
+    that serves these LIKE lookups; other databases use an in-memory prefix index per school, rebuilt when the
+    school's catalogue changes. Facet counts always come from the database so the state counts are current, in one
+    grouped query over the matches however many there are.
+    """
+    FIELDS = (
+        "id", "number", "title", "school_id", "author_name", "publisher_name", "category_name", "subject_name",
+        "publication_year", "state_name")
+    FACETS = {"category": "category__name", "subject": "subject__name", "state": "state__name"}
+    # Matches found in memory are looked up by id up to this many, within SQLite's bound parameter limit
+    ID_LOOKUP_LIMIT = 900
+
+    def __init__(self):
+        self.indexes = SchoolSearchIndexes("books:search", self.build_index)
+
+    def invalidate(self, school_id):
+        """
+        Marks the school's catalogue as changed so every worker rebuilds its index on the next search.
+        @param school_id: The school whose books changed.
+        """
+        self.indexes.invalidate(school_id)
+
+    def search(self, school, query, filters=None, page=None, page_size=None):
+        """
+        Searches a school's books, best matches first.
+        @param school: The school whose books we are searching.
+        @type school: School
+        @param query: The search text. An empty query matches the whole catalogue, newest books first.
+        @type query: str
+        @param filters: Exact matches narrowing the search, e.g. {"category__name": "Fiction"}.
+        @type filters: dict
+        @param page: The 1-based page number.
+        @type page: int | str | None
+        @param page_size: The number of books per page.
+        @type page_size: int | str | None
+        @return: The books of the page, the facet counts of all the matches and the number of the next page.
+        @rtype: dict
+        """
+        terms = sorted(set(str(query or "").lower().split()))
+        page_size = KeysetPaginator.page_size(page_size)
+        page = page_number(page)
+        offset = (page - 1) * page_size
+        queryset = BookService().filter(school=school, **(filters or {}))
+        if not terms:
+            queryset = queryset.order_by("-date_created", "-id")
+            rows = list(self._values(queryset)[offset:offset + page_size + 1])
+            facets = self._facets(queryset)
+        elif connection.vendor == "postgresql":
+            rows, facets = self._search_postgresql(queryset, terms, offset, page_size + 1)
+        else:
+            rows, facets = self._search_index(school, queryset, terms, bool(filters), offset, page_size + 1)
+        next_page = page + 1 if len(rows) > page_size else None
+        return {"data": rows[:page_size], "facets": facets, "next_page": next_page}
+
+    def _values(self, queryset):
+        return queryset.annotate(
+            author_name=F("author__name"), publisher_name=F("publisher__name"), category_name=F("category__name"),
+            subject_name=F("subject__name"), state_name=F("state__name")).values(*self.FIELDS)
+
+    def _facets(self, queryset):
+        # One grouped query over the matches, split into the three facets here
+        counts = {facet: Counter() for facet in self.FACETS}
+        for row in queryset.order_by().values(*self.FACETS.values()).annotate(count=Count("id")):
+            for facet, field in self.FACETS.items():
+                counts[facet][row[field]] += row["count"]
+        return {
+            facet: [{"name": name, "count": count} for name, count in counts[facet].most_common()]
+            for facet in self.FACETS}
+
+    @staticmethod
+    def _matching(queryset, terms):
+        for term in terms:
+            queryset = queryset.filter(Q(search_document__startswith=term) | Q(search_document__contains=" " + term))
+        return queryset
+
+    def _search_postgresql(self, queryset, terms, offset, limit):
+        from django.contrib.postgres.search import TrigramWordSimilarity
+        queryset = self._matching(queryset, terms)
+        ranked = queryset.annotate(rank=TrigramWordSimilarity(" ".join(terms), "search_document")).order_by(
+            "-rank", "-date_created", "-id")
+        return list(self._values(ranked)[offset:offset + limit]), self._facets(queryset)
+
+    def _search_index(self, school, queryset, terms, filtered, offset, limit):
+        ids = [book_id for book_id, score in self.indexes.get(school.id).search(" ".join(terms))]
+        if len(ids) <= self.ID_LOOKUP_LIMIT:
+            matches = queryset.filter(id__in=ids)
+        else:
+            # Too many ids for one IN (...), so the database matches the same word prefixes itself
+            matches = self._matching(queryset, terms)
+        if not filtered:
+            page_ids = ids[offset:offset + limit]
+        else:
+            # Filters can drop matches, so the page is taken from the matches that pass them
+            matching = set(matches.values_list("id", flat=True))
+            page_ids = [book_id for book_id in ids if book_id in matching][offset:offset + limit]
+        rows = {row["id"]: row for row in self._values(queryset.filter(id__in=page_ids))}
+        return [rows[book_id] for book_id in page_ids if book_id in rows], self._facets(matches)
+
+    @staticmethod
+    def build_index(school_id):
+        return PrefixIndex(
+            BookService().filter(school_id=school_id).values_list("id", "search_document").iterator(chunk_size=2000))
+
+
+book_search = BookSearch()
@@ -1,4 +1,4 @@
-from books.models import Author, Publisher, BookCategory, Book, UserBook
+from books.models import Author, Publisher, BookCategory, Book, UserBook, LoanPolicy, LibraryStat
 from utils.ServiceBase import ServiceBase
 
 
@@ -15,4 +15,10 @@ class BookService(ServiceBase):
     manager = Book.objects
 
 class UserBookService(ServiceBase):
-    manager = UserBook.objects
\ No newline at end of file
+    manager = UserBook.objects
+
+class LoanPolicyService(ServiceBase):
+    manager = LoanPolicy.objects
+
+class LibraryStatService(ServiceBase):
+    manager = LibraryStat.objects
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from base.models import School
+from books.backend.library_stats import library_stats
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the library statistics of every active school, or of one school, from the books and loans."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--school", help="Code of the only school to rebuild.")
+
+    def handle(self, *args, **options):
+        if options["school"]:
+            school = School.objects.filter(code=options["school"]).first()
+            if not school:
+                raise CommandError("School %s not found" % options["school"])
+            written = {school.code: library_stats.recompute(school)}
+        else:
+            written = library_stats.recompute_all()
+        for code, rows in written.items():
+            self.stdout.write("%s: %s summary rows" % (code, rows))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from books.backend.overdue import OverdueScanner, OverdueScanError
+
+
+class Command(BaseCommand):
+    help = "Queues reminders to the borrowers of overdue books."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, help="Overdue loans read and reminded per page.")
+        parser.add_argument("--interval-hours", type=int, help="Hours before a reminded loan is reminded again.")
+
+    def handle(self, *args, **options):
+        try:
+            counts = OverdueScanner(
+                batch_size=options["batch_size"], interval_hours=options["interval_hours"]).scan()
+        except OverdueScanError as e:
+            raise CommandError(str(e))
+        self.stdout.write(
+            "%(overdue)s overdue loans, %(reminded)s reminders queued, %(skipped)s without an email" % counts)
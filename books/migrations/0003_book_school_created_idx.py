@@ -0,0 +1,18 @@
+# Generated by Django 5.0.4 on 2026-10-18 17:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0002_notification_outbox'),
+        ('books', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['school', '-date_created', '-id'], name='book_school_created_idx'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.0.4 on 2026-10-18 17:40
+
+from django.db import migrations, models
+
+
+def backfill_search_document(apps, schema_editor):
+    Book = apps.get_model('books', 'Book')
+    batch = []
+    books = Book.objects.select_related('author', 'publisher').only(
+        'id', 'number', 'title', 'author__name', 'publisher__name')
+    for book in books.iterator(chunk_size=2000):
+        book.search_document = ' '.join(
+            str(value).strip().lower() for value in (book.number, book.title, book.author.name, book.publisher.name)
+            if str(value or '').strip())
+        batch.append(book)
+        if len(batch) >= 2000:
+            Book.objects.bulk_update(batch, ['search_document'])
+            batch = []
+    if batch:
+        Book.objects.bulk_update(batch, ['search_document'])
+
+
+def create_trigram_index(apps, schema_editor):
+    # The trigram index is PostgreSQL only; other databases search through the in-memory prefix index
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS book_search_document_trgm_idx ON books_book USING gin (search_document gin_trgm_ops)')
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS book_search_document_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0003_book_school_created_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='search_document',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_search_document, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.0.4 on 2026-10-18 17:42
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0003_hot_query_indexes'),
+        ('books', '0004_book_search_document'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='author',
+            index=models.Index(fields=['name', 'state'], name='author_name_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='author',
+            index=models.Index(fields=['state', '-date_created'], name='author_state_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['school', 'state'], name='book_school_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bookcategory',
+            index=models.Index(fields=['name', 'state'], name='bookcategory_name_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bookcategory',
+            index=models.Index(fields=['state', '-date_created'], name='bookcategory_state_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='publisher',
+            index=models.Index(fields=['name', 'state'], name='publisher_name_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='publisher',
+            index=models.Index(fields=['state', '-date_created'], name='publisher_state_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userbook',
+            index=models.Index(fields=['book', 'state'], name='userbook_book_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userbook',
+            index=models.Index(fields=['user', '-date_created'], name='userbook_user_created_idx'),
+        ),
+    ]
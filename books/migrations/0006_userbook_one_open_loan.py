@@ -0,0 +1,41 @@
+# Generated by Django 5.0.4 on 2026-10-18 17:54
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_returned_at(apps, schema_editor):
+    State = apps.get_model('base', 'State')
+    UserBook = apps.get_model('books', 'UserBook')
+    active = State.objects.filter(name='Active').first()
+    returned = State.objects.filter(name='Returned').first()
+    UserBook.objects.exclude(state=active).update(returned_at=models.F('date_modified'))
+    # Issuing used to race, so a book can have more than one open loan; only its latest one stays open
+    duplicated = UserBook.objects.filter(state=active).values('book').annotate(
+        loans=models.Count('id')).filter(loans__gt=1).values_list('book', flat=True)
+    for book_id in list(duplicated):
+        stale = UserBook.objects.filter(book_id=book_id, state=active).order_by('-date_created').values_list(
+            'id', flat=True)[1:]
+        UserBook.objects.filter(id__in=list(stale)).update(state=returned, returned_at=models.F('date_modified'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0006_compact_transaction_payloads'),
+        ('books', '0005_hot_query_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userbook',
+            name='returned_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_returned_at, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='userbook',
+            constraint=models.UniqueConstraint(condition=models.Q(('returned_at__isnull', True)), fields=('book',), name='userbook_one_open_loan'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.0.4 on 2026-10-18 17:57
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_current_loan(apps, schema_editor):
+    Book = apps.get_model('books', 'Book')
+    UserBook = apps.get_model('books', 'UserBook')
+    loans = UserBook.objects.filter(returned_at__isnull=True).values_list('id', 'book_id', 'user_id', 'date_created')
+    books = []
+    for loan_id, book_id, user_id, date_created in loans.iterator(chunk_size=2000):
+        books.append(Book(id=book_id, current_loan_id=loan_id, current_borrower_id=user_id, loan_started_at=date_created))
+        if len(books) >= 2000:
+            Book.objects.bulk_update(books, ['current_loan', 'current_borrower', 'loan_started_at'])
+            books = []
+    if books:
+        Book.objects.bulk_update(books, ['current_loan', 'current_borrower', 'loan_started_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0006_compact_transaction_payloads'),
+        ('books', '0006_userbook_one_open_loan'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='current_borrower',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='borrowed_books', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='current_loan',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='books.userbook'),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='loan_started_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_current_loan, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['current_borrower', '-loan_started_at'], name='book_borrower_started_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['school', '-loan_started_at'], name='book_school_loan_started_idx'),
+        ),
+    ]
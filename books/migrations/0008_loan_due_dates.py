@@ -0,0 +1,66 @@
+# Generated by Django 5.0.4 on 2026-10-18 18:00
+
+import base.models
+import datetime
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_due_at(apps, schema_editor):
+    UserBook = apps.get_model('books', 'UserBook')
+    UserBook.objects.filter(due_at__isnull=True).update(
+        due_at=models.F('date_created') + datetime.timedelta(days=settings.LOAN_DEFAULT_DAYS))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0006_compact_transaction_payloads'),
+        ('books', '0007_book_current_loan'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoanPolicy',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, unique=True)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_modified', models.DateTimeField(auto_now=True)),
+                ('loan_days', models.PositiveIntegerField()),
+                ('category', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='books.bookcategory')),
+                ('school', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.school')),
+                ('state', models.ForeignKey(default=base.models.State.active, on_delete=django.db.models.deletion.CASCADE, to='base.state')),
+            ],
+            options={
+                'verbose_name': 'Loan Policy',
+                'verbose_name_plural': 'Loan Policies',
+                'ordering': ('-date_created',),
+            },
+        ),
+        migrations.AddField(
+            model_name='userbook',
+            name='due_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userbook',
+            name='reminded_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='userbook',
+            index=models.Index(fields=['state', 'due_at'], name='userbook_state_due_idx'),
+        ),
+        migrations.RunPython(backfill_due_at, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='loanpolicy',
+            constraint=models.UniqueConstraint(fields=('school', 'category'), name='loanpolicy_school_category'),
+        ),
+        migrations.AddConstraint(
+            model_name='loanpolicy',
+            constraint=models.UniqueConstraint(condition=models.Q(('category__isnull', True)), fields=('school',), name='loanpolicy_school_default'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.0.4 on 2026-10-18 18:03
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0006_compact_transaction_payloads'),
+        ('books', '0008_loan_due_dates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LibraryStat',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False, unique=True)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_modified', models.DateTimeField(auto_now=True)),
+                ('kind', models.CharField(max_length=30)),
+                ('key', models.CharField(max_length=255)),
+                ('label', models.CharField(blank=True, max_length=255, null=True)),
+                ('count', models.BigIntegerField(default=0)),
+                ('school', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.school')),
+            ],
+            options={
+                'verbose_name': 'Library Stat',
+                'verbose_name_plural': 'Library Stats',
+                'ordering': ('-count',),
+                'indexes': [models.Index(fields=['school', 'kind', '-count'], name='librarystat_school_kind_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='librarystat',
+            constraint=models.UniqueConstraint(fields=('school', 'kind', 'key'), name='librarystat_school_kind_key'),
+        ),
+    ]
@@ -7,11 +7,17 @@ from users.models import User
 class Author(GenericBaseModel):
     state = models.ForeignKey(State, default=State.active, on_delete=models.CASCADE)
 
+    HOT_QUERIES = (('name', 'state'), ('state', '-date_created'))
+
     def __str__(self):
         return self.name
 
     class Meta:
         ordering = ('-date_created',)
+        indexes = [
+            models.Index(fields=['name', 'state'], name='author_name_state_idx'),
+            models.Index(fields=['state', '-date_created'], name='author_state_created_idx'),
+        ]
 
 class Publisher(GenericBaseModel):
     address = models.CharField(max_length=255, null=True, blank=True)
@@ -19,20 +25,32 @@ class Publisher(GenericBaseModel):
     email = models.EmailField(null=True, blank=True)
     state = models.ForeignKey(State, default=State.active, on_delete=models.CASCADE)
 
+    HOT_QUERIES = (('name', 'state'), ('state', '-date_created'))
+
     def __str__(self):
         return self.name
 
     class Meta:
         ordering = ('-date_created',)
+        indexes = [
+            models.Index(fields=['name', 'state'], name='publisher_name_state_idx'),
+            models.Index(fields=['state', '-date_created'], name='publisher_state_created_idx'),
+        ]
 
 class BookCategory(GenericBaseModel):
     state = models.ForeignKey(State, default=State.active, on_delete=models.CASCADE)
 
+    HOT_QUERIES = (('name', 'state'), ('state', '-date_created'))
+
     def __str__(self):
         return self.name
 
     class Meta:
         ordering = ('-date_created',)
+        indexes = [
+            models.Index(fields=['name', 'state'], name='bookcategory_name_state_idx'),
+            models.Index(fields=['state', '-date_created'], name='bookcategory_state_created_idx'),
+        ]
         verbose_name = "Book Category"
         verbose_name_plural = "Book Categories"
 
@@ -46,22 +64,121 @@ class Book(BaseModel):
     subject = models.ForeignKey(Subject, on_delete=models.CASCADE)
     publication_year = models.IntegerField(null=True, blank=True)
     state = models.ForeignKey(State, default=State.idle, on_delete=models.CASCADE)
+    search_document = models.TextField(null=True, blank=True, editable=False)
+    # The open loan, kept in step with UserBook by LoanEngine so who holds a book is read off the book itself
+    current_borrower = models.ForeignKey(
+        User, null=True, blank=True, editable=False, related_name='borrowed_books', on_delete=models.SET_NULL)
+    current_loan = models.ForeignKey(
+        'UserBook', null=True, blank=True, editable=False, related_name='+', on_delete=models.SET_NULL)
+    loan_started_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    HOT_QUERIES = (
+        ('school', 'state'), ('school', '-date_created', '-id'), ('current_borrower', '-loan_started_at'),
+        ('school', '-loan_started_at'))
 
     def __str__(self):
         return "%s - %s" % (self.title, self.author)
 
+    @staticmethod
+    def make_search_document(number, title, author_name, publisher_name):
+        """
+        Builds the text search_books matches against.
+        @return: The book number, title, author name and publisher name lower cased and joined by spaces.
+        @rtype: str
+        """
+        return " ".join(
+            str(value).strip().lower() for value in (number, title, author_name, publisher_name)
+            if str(value or "").strip())
+
+    def save(self, *args, **kwargs):
+        self.search_document = self.make_search_document(
+            self.number, self.title, self.author.name if self.author_id else None,
+            self.publisher.name if self.publisher_id else None)
+        super(Book, self).save(*args, **kwargs)
+
     class Meta:
         ordering = ('-date_created',)
+        indexes = [
+            models.Index(fields=['school', '-date_created', '-id'], name='book_school_created_idx'),
+            models.Index(fields=['school', 'state'], name='book_school_state_idx'),
+            models.Index(fields=['current_borrower', '-loan_started_at'], name='book_borrower_started_idx'),
+            models.Index(fields=['school', '-loan_started_at'], name='book_school_loan_started_idx'),
+        ]
 
 class UserBook(BaseModel):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
     state = models.ForeignKey(State, default=State.active, on_delete=models.CASCADE)
+    returned_at = models.DateTimeField(null=True, blank=True)
+    due_at = models.DateTimeField(null=True, blank=True)
+    reminded_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    HOT_QUERIES = (('book', 'state'), ('user', '-date_created'), ('state', 'due_at'))
 
     def __str__(self):
         return "%s: %s" % (self.user, self.book)
 
     class Meta:
         ordering = ('-date_created',)
+        indexes = [
+            models.Index(fields=['book', 'state'], name='userbook_book_state_idx'),
+            models.Index(fields=['user', '-date_created'], name='userbook_user_created_idx'),
+            models.Index(fields=['state', 'due_at'], name='userbook_state_due_idx'),
+        ]
+        constraints = [
+            # A book has at most one open loan; LoanEngine relies on this when two desks issue the same copy
+            models.UniqueConstraint(
+                fields=['book'], condition=models.Q(returned_at__isnull=True), name='userbook_one_open_loan'),
+        ]
         verbose_name = "User Book"
         verbose_name_plural = "User Book"
+
+class LoanPolicy(BaseModel):
+    school = models.ForeignKey(School, on_delete=models.CASCADE)
+    # A policy without a category is the school's default loan period
+    category = models.ForeignKey(BookCategory, null=True, blank=True, on_delete=models.CASCADE)
+    loan_days = models.PositiveIntegerField()
+    state = models.ForeignKey(State, default=State.active, on_delete=models.CASCADE)
+
+    def __str__(self):
+        return "%s: %s days" % (self.category or self.school, self.loan_days)
+
+    class Meta:
+        ordering = ('-date_created',)
+        constraints = [
+            models.UniqueConstraint(fields=['school', 'category'], name='loanpolicy_school_category'),
+            models.UniqueConstraint(
+                fields=['school'], condition=models.Q(category__isnull=True), name='loanpolicy_school_default'),
+        ]
+        verbose_name = "Loan Policy"
+        verbose_name_plural = "Loan Policies"
+
+class LibraryStat(BaseModel):
+    # Maintained by LibraryStats: incremented as books are added, issued and returned and rebuilt nightly
+    BOOKS_BY_STATE = 'books_by_state'
+    BOOKS_BY_CATEGORY = 'books_by_category'
+    LOANS_BY_MONTH = 'loans_by_month'
+    BORROWERS = 'borrowers'
+    TITLES = 'titles'
+
+    school = models.ForeignKey(School, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=30)
+    key = models.CharField(max_length=255)
+    label = models.CharField(max_length=255, null=True, blank=True)
+    count = models.BigIntegerField(default=0)
+
+    HOT_QUERIES = (('school', 'kind', '-count'),)
+
+    def __str__(self):
+        return "%s %s: %s" % (self.kind, self.label or self.key, self.count)
+
+    class Meta:
+        ordering = ('-count',)
+        indexes = [
+            models.Index(fields=['school', 'kind', '-count'], name='librarystat_school_kind_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['school', 'kind', 'key'], name='librarystat_school_kind_key'),
+        ]
+        verbose_name = "Library Stat"
+        verbose_name_plural = "Library Stats"
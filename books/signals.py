@@ -0,0 +1,75 @@
+import logging
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from books.backend.library_stats import library_stats
+from books.backend.loan_policy import loan_policies
+from books.backend.search import book_search
+from books.models import Author, Publisher, Book, LoanPolicy
+
+lgr = logging.getLogger(__name__)
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def invalidate_book_search(sender, instance, **kwargs):
+    """
+    Has every worker rebuild the school's book search index once the change is committed.
+    """
+    school_id = instance.school_id
+    transaction.on_commit(lambda: book_search.invalidate(school_id))
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Publisher)
+def refresh_book_search_documents(sender, instance, created, **kwargs):
+    """
+    Rewrites the search documents of the books of a renamed author or publisher.
+    """
+    if created:
+        return
+    books = list(Book.objects.filter(**{sender.__name__.lower(): instance}).select_related("author", "publisher"))
+    for book in books:
+        book.search_document = Book.make_search_document(
+            book.number, book.title, book.author.name, book.publisher.name)
+    Book.objects.bulk_update(books, ["search_document"], batch_size=500)
+    for school_id in {book.school_id for book in books}:
+        transaction.on_commit(lambda school_id=school_id: book_search.invalidate(school_id))
+
+
+@receiver(post_save, sender=LoanPolicy)
+@receiver(post_delete, sender=LoanPolicy)
+def invalidate_loan_policies(sender, instance, **kwargs):
+    """
+    Has every worker reload the school's loan periods once the change is committed.
+    """
+    school_id = instance.school_id
+    transaction.on_commit(lambda: loan_policies.invalidate(school_id))
+
+
+@receiver(post_save, sender=Book)
+def count_added_book(sender, instance, created, **kwargs):
+    """
+    Adds a new book to its school's LibraryStat counts. Edits are left to the nightly recompute.
+    """
+    if created:
+        count_library_book(instance, 1)
+
+
+@receiver(post_delete, sender=Book)
+def count_deleted_book(sender, instance, **kwargs):
+    """
+    Takes a deleted book off its school's LibraryStat counts.
+    """
+    count_library_book(instance, -1)
+
+
+def count_library_book(book, delta):
+    try:
+        # In a savepoint so a failed count does not break the caller's transaction
+        with transaction.atomic():
+            library_stats.book_changed(book, delta)
+    except Exception as e:
+        lgr.exception("Count library book exception: %s" % e)
@@ -1,3 +1,429 @@
-from django.test import TestCase
+import csv
+import io
+import json
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.db import IntegrityError, connection, transaction as trx
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from base.models import State, Notification
+from books.backend.library_stats import library_stats
+from books.backend.loans import loan_engine, LoanError
+from books.backend.overdue import OverdueScanner, OverdueScanError
+from books.backend.search import book_search
+from books.models import Author, Publisher, BookCategory, Book, UserBook, LibraryStat
+from books.views import book_export, book_paginator
+from utils.pagination import KeysetPaginator
+from users.models import Role
+from utils.testing import SchoolTestCase
+
+
+class LibraryTestCase(SchoolTestCase):
+    """
+    Adds a few idle books to the school.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.category = BookCategory.objects.create(name="Textbook", state=State.active())
+        self.author = Author.objects.create(name="Ngugi wa Thiong'o", state=State.active())
+        self.publisher = Publisher.objects.create(name="Heinemann", state=State.active())
+        self.books = [self.make_book(n) for n in range(1, 6)]
+
+    def make_book(self, number, title="The River Between"):
+        return Book.objects.create(
+            number="B%03d" % number, title=title, school=self.school, author=self.author, publisher=self.publisher,
+            category=self.category, subject=self.subject, state=State.idle())
+
+    def open_loans(self):
+        return UserBook.objects.filter(returned_at__isnull=True)
+
+
+class LoanEngineTests(LibraryTestCase):
+
+    def test_issue_claims_the_book(self):
+        loan = loan_engine.issue(self.students[0], self.books[0].id)
+        book = Book.objects.get(id=self.books[0].id)
+        self.assertEqual(book.state_id, State.issued().id)
+        self.assertEqual(book.current_borrower_id, self.students[0].id)
+        self.assertEqual(book.current_loan_id, loan.id)
+        self.assertIsNotNone(loan.due_at)
+
+    def test_issue_twice_is_refused(self):
+        loan_engine.issue(self.students[0], self.books[0].id)
+        with self.assertRaisesMessage(LoanError, "Book already issued"):
+            loan_engine.issue(self.students[1], self.books[0].id)
+        self.assertEqual(self.open_loans().count(), 1)
+
+    def test_issue_unknown_book(self):
+        with self.assertRaisesMessage(LoanError, "Book not found"):
+            loan_engine.issue(self.students[0], self.students[0].id)
+
+    def test_one_open_loan_per_book(self):
+        UserBook.objects.create(user=self.students[0], book=self.books[0], state=State.active())
+        with self.assertRaises(IntegrityError), trx.atomic():
+            UserBook.objects.create(user=self.students[1], book=self.books[0], state=State.active())
+
+    def test_issue_refused_by_open_loan_constraint(self):
+        # An idle copy with an open loan, as left by a write that bypassed the engine
+        UserBook.objects.create(user=self.students[0], book=self.books[0], state=State.active())
+        with self.assertRaisesMessage(LoanError, "Book already issued"):
+            loan_engine.issue(self.students[1], self.books[0].id)
+        self.assertEqual(Book.objects.get(id=self.books[0].id).state_id, State.idle().id)
+
+    def test_give_back_releases_the_book(self):
+        loan = loan_engine.issue(self.students[0], self.books[0].id)
+        self.assertEqual(loan_engine.give_back(self.books[0].id), 1)
+        loan.refresh_from_db()
+        book = Book.objects.get(id=self.books[0].id)
+        self.assertEqual(loan.state_id, State.returned().id)
+        self.assertIsNotNone(loan.returned_at)
+        self.assertEqual(book.state_id, State.idle().id)
+        self.assertIsNone(book.current_borrower_id)
+        self.assertIsNone(book.current_loan_id)
+        loan_engine.issue(self.students[1], self.books[0].id)
+
+    def test_give_back_without_a_loan(self):
+        with self.assertRaisesMessage(LoanError, "Book not issued"):
+            loan_engine.give_back(self.books[0].id)
+
+
+class BatchLoanTests(LibraryTestCase):
+
+    def test_issue_many(self):
+        results = loan_engine.issue_many(self.school, [
+            (self.students[0].id, self.books[0].id), (self.students[1].id, self.books[1].id)])
+        self.assertEqual([result["issued"] for result in results], [True, True])
+        self.assertEqual(self.open_loans().count(), 2)
+        self.assertEqual(
+            Book.objects.get(id=self.books[1].id).current_borrower_id, self.students[1].id)
+
+    def test_issue_many_reports_each_pair(self):
+        loan_engine.issue(self.students[0], self.books[0].id)
+        results = loan_engine.issue_many(self.school, [
+            (self.students[1].id, self.books[0].id), (self.students[1].id, self.books[1].id),
+            (self.students[2].id, self.books[1].id), (self.students[2].id, "not-a-book"),
+            (self.books[2].id, self.books[2].id)])
+        self.assertEqual([result.get("error") for result in results], [
+            "Book already issued", None, "Book listed more than once", "Book not found", "User not found"])
+        self.assertEqual(self.open_loans().count(), 2)
+
+    def test_issue_many_skips_books_with_an_open_loan(self):
+        # An idle copy with an open loan fails the constraint every time, so it must not sink the batch
+        UserBook.objects.create(user=self.students[0], book=self.books[0], state=State.active())
+        results = loan_engine.issue_many(self.school, [
+            (self.students[1].id, self.books[0].id), (self.students[1].id, self.books[1].id)])
+        self.assertEqual(results[0]["error"], "Book already has an open loan")
+        self.assertTrue(results[1]["issued"])
+        self.assertEqual(Book.objects.get(id=self.books[0].id).state_id, State.idle().id)
+
+    def test_give_back_many(self):
+        loan_engine.issue_many(self.school, [(self.students[0].id, book.id) for book in self.books[:2]])
+        results = loan_engine.give_back_many(self.school, [self.books[0].id, self.books[1].id, self.books[2].id])
+        self.assertEqual([result["returned"] for result in results], [True, True, False])
+        self.assertEqual(results[2]["error"], "Book not issued")
+        self.assertFalse(self.open_loans().exists())
+        self.assertFalse(Book.objects.filter(state=State.issued()).exists())
+
+
+@override_settings(SEND_NOTIFICATIONS=True)
+class OverdueScannerTests(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.now = timezone.now()
+        self.students.append(self.make_user("noemail", email=""))
+        # Five overdue loans sharing two due dates, so pages have to break ties on id
+        self.loans = [
+            UserBook.objects.create(
+                user=self.students[n % len(self.students)], book=book, state=State.active(),
+                due_at=self.now - timedelta(days=1 + n % 2))
+            for n, book in enumerate(self.books)]
+        self.books.append(self.make_book(6))
+        UserBook.objects.create(
+            user=self.students[0], book=self.books[-1], state=State.active(), due_at=self.now + timedelta(days=1))
+
+    def reminded(self):
+        return set(UserBook.objects.filter(reminded_at__isnull=False).values_list("id", flat=True))
+
+    def test_scan_reads_every_page_once(self):
+        with CaptureQueriesContext(trx.get_connection()) as captured:
+            counts = OverdueScanner(batch_size=2).scan(now=self.now)
+        no_email = [loan.id for loan in self.loans if not loan.user.email]
+        self.assertEqual(counts, {"overdue": 5, "reminded": 5 - len(no_email), "skipped": len(no_email)})
+        self.assertEqual(self.reminded(), {loan.id for loan in self.loans} - set(no_email))
+        self.assertEqual(Notification.objects.filter(title=OverdueScanner.MESSAGE_CODE).count(), counts["reminded"])
+        pages = [query for query in captured.captured_queries if 'FROM "books_userbook"' in query["sql"]]
+        self.assertEqual(len(pages), 4)
+
+    def test_scan_waits_for_the_interval(self):
+        OverdueScanner(batch_size=2).scan(now=self.now)
+        again = OverdueScanner(batch_size=2, interval_hours=24).scan(now=self.now + timedelta(hours=1))
+        self.assertEqual(again["reminded"], 0)
+        # The loan due tomorrow is overdue by then too
+        later = OverdueScanner(batch_size=2, interval_hours=24).scan(now=self.now + timedelta(hours=25))
+        self.assertEqual(later, {"overdue": 6, "reminded": 5, "skipped": 1})
+
+    def test_scan_leaves_loans_unstamped_when_reminders_are_not_queued(self):
+        with self.settings(SEND_NOTIFICATIONS=False), self.assertLogs("books.backend.overdue", "WARNING"):
+            self.assertEqual(OverdueScanner().scan(now=self.now)["reminded"], 0)
+        self.assertEqual(self.reminded(), set())
+        Notification.objects.bulk_create, bulk_create = self.fail_bulk_create, Notification.objects.bulk_create
+        try:
+            with self.assertRaises(OverdueScanError), self.assertLogs("utils.ServiceBase", "ERROR"):
+                OverdueScanner(batch_size=2).scan(now=self.now)
+        finally:
+            Notification.objects.bulk_create = bulk_create
+        self.assertEqual(self.reminded(), set())
+        self.assertFalse(Notification.objects.exists())
+
+    @staticmethod
+    def fail_bulk_create(*args, **kwargs):
+        raise IntegrityError("Outbox unavailable")
+
+
+class LibraryStatsTests(LibraryTestCase):
+
+    def counts(self):
+        return {
+            (kind, key): count for kind, key, count in LibraryStat.objects.filter(
+                school=self.school, count__gt=0).values_list("kind", "key", "count")}
+
+    def test_recorded_counts_match_recompute(self):
+        library_stats.recompute(self.school)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.books.append(self.make_book(6, title="Blossoms of the Savannah"))
+        for user, book in ((self.students[0], self.books[0]), (self.students[1], self.books[5])):
+            with self.captureOnCommitCallbacks(execute=True):
+                loan_engine.issue(user, book.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            loan_engine.issue_many(self.school, [(self.students[2].id, self.books[1].id)])
+        with self.captureOnCommitCallbacks(execute=True):
+            loan_engine.give_back(self.books[0].id)
+        with self.captureOnCommitCallbacks(execute=True):
+            loan_engine.give_back_many(self.school, [self.books[1].id])
+        recorded = self.counts()
+        library_stats.recompute(self.school)
+        self.assertEqual(recorded, self.counts())
+        self.assertEqual(recorded[(LibraryStat.BOOKS_BY_STATE, State.idle().name)], 5)
+        self.assertEqual(recorded[(LibraryStat.BORROWERS, str(self.students[0].id))], 1)
+
+    def test_counts_wait_for_the_commit(self):
+        library_stats.recompute(self.school)
+        before = self.counts()
+        with self.captureOnCommitCallbacks() as callbacks:
+            loan_engine.issue(self.students[0], self.books[0].id)
+        self.assertEqual(self.counts(), before)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.counts()[(LibraryStat.BOOKS_BY_STATE, State.issued().name)], 1)
+
+    def test_decrement_before_its_row_exists(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            library_stats.returned(self.school.id, 2)
+            library_stats.record(self.school.id, {(LibraryStat.BOOKS_BY_STATE, State.issued().name): ("Issued", 2)})
+        self.assertEqual(
+            LibraryStat.objects.get(school=self.school, kind=LibraryStat.BOOKS_BY_STATE, key=State.issued().name).count,
+            0)
+
+    def test_summary_reads_the_counts(self):
+        library_stats.recompute(self.school)
+        summary = library_stats.summary(self.school)
+        self.assertEqual(summary["books_by_state"], {State.idle().name: 5})
+        self.assertEqual(summary["books_by_category"], [
+            {"category_id": str(self.category.id), "category_name": self.category.name, "count": 5}])
+
+
+class FilterBooksTests(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.token = self.login(self.students[0])
+
+    def filter_books(self, **data):
+        return self.post("books:filter-books", token=self.token, school_id=str(self.school.id), **data)
+
+    def read_all(self, page_size):
+        ids, cursor = [], None
+        while True:
+            response = self.filter_books(cursor=cursor, page_size=page_size, fields="id,title")
+            self.assertEqual(response["code"], "100.000.000")
+            ids += [row["id"] for row in response["data"]]
+            cursor = response["next_cursor"]
+            if cursor is None:
+                return ids
+
+    def test_cursor_round_trip(self):
+        book = Book.objects.get(id=self.books[0].id)
+        cursor = KeysetPaginator.encode(book.date_created, book.id)
+        self.assertEqual(KeysetPaginator.decode(cursor), (book.date_created, str(book.id)))
+
+    def test_pages_cover_every_book_once(self):
+        ids = self.read_all(page_size=2)
+        expected = list(Book.objects.order_by("-date_created", "-id").values_list("id", flat=True))
+        self.assertEqual(ids, [str(book_id) for book_id in expected])
+
+    def test_ties_on_date_created_are_broken_by_id(self):
+        Book.objects.update(date_created=timezone.now())
+        ids = self.read_all(page_size=2)
+        self.assertEqual(ids, sorted((str(book.id) for book in self.books), reverse=True))
+
+    def test_last_page_has_no_cursor(self):
+        response = self.filter_books(page_size=5)
+        self.assertEqual(len(response["data"]), 5)
+        self.assertIsNone(response["next_cursor"])
+        self.assertEqual(set(response["data"][0]), set(book_paginator.fields))
+
+    def test_invalid_requests_are_reported(self):
+        cursor = self.filter_books(page_size=2)["next_cursor"]
+        tampered = cursor[:-4] + ("AAAA" if cursor[-4:] != "AAAA" else "BBBB")
+        with self.assertLogs("books.views", "ERROR"):
+            for data, error in (
+                    ({"cursor": tampered}, "Invalid cursor"), ({"cursor": "not a cursor"}, "Invalid cursor"),
+                    ({"page_size": "ten"}, "Invalid page size"), ({"fields": "id,password"}, "Unknown fields: password")):
+                response = self.filter_books(**data)
+                self.assertEqual(response["code"], "999.999.999")
+                self.assertEqual(response["error"], error)
+
+
+class BookSearchTests(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.fiction = BookCategory.objects.create(name="Fiction", state=State.active())
+        self.novels = [
+            Book.objects.create(
+                number="N%03d" % n, title=title, school=self.school, author=self.author, publisher=self.publisher,
+                category=self.fiction, subject=self.subject, state=State.idle())
+            for n, title in enumerate(("The River and the Source", "Blossoms of the Savannah", "Weep Not, Child"))]
+        loan_engine.issue(self.students[0], self.books[0].id)
+
+    @staticmethod
+    def facet(results, name):
+        return {row["name"]: row["count"] for row in results["facets"][name]}
+
+    def test_every_term_must_start_a_word(self):
+        results = book_search.search(self.school, "riv bet")
+        self.assertEqual({row["id"] for row in results["data"]}, {book.id for book in self.books})
+        results = book_search.search(self.school, "RIVER")
+        self.assertEqual(len(results["data"]), 6)
+        self.assertEqual(book_search.search(self.school, "iver")["data"], [])
+
+    def test_facets_count_every_match(self):
+        results = book_search.search(self.school, "river", page_size=2)
+        self.assertEqual(len(results["data"]), 2)
+        self.assertEqual(results["next_page"], 2)
+        self.assertEqual(self.facet(results, "category"), {"Textbook": 5, "Fiction": 1})
+        self.assertEqual(self.facet(results, "state"), {State.idle().name: 5, State.issued().name: 1})
+        self.assertEqual(self.facet(results, "subject"), {"English": 6})
+
+    def test_filters_narrow_the_page_and_the_facets(self):
+        results = book_search.search(self.school, "the", filters={"category__name": "Fiction"})
+        self.assertEqual({row["id"] for row in results["data"]}, {self.novels[0].id, self.novels[1].id})
+        self.assertEqual(self.facet(results, "category"), {"Fiction": 2})
+        self.assertIsNone(results["next_page"])
+
+    def test_facets_take_one_query(self):
+        book_search.search(self.school, "river")
+        with self.assertNumQueries(2):
+            book_search.search(self.school, "river")
+        with self.assertNumQueries(2):
+            book_search.search(self.school, "")
+
+    def test_many_matches_fall_back_to_the_document_filter(self):
+        expected = book_search.search(self.school, "river", filters={"state__name": State.idle().name})
+        with mock.patch.object(book_search, "ID_LOOKUP_LIMIT", 2):
+            results = book_search.search(self.school, "river", filters={"state__name": State.idle().name})
+        self.assertEqual(results, expected)
+        self.assertEqual(len(results["data"]), 5)
+
+    def test_index_follows_catalogue_changes(self):
+        self.assertEqual(book_search.search(self.school, "petals")["data"], [])
+        with self.captureOnCommitCallbacks(execute=True):
+            book = self.make_book(6, title="Petals of Blood")
+        self.assertEqual([row["id"] for row in book_search.search(self.school, "petals")["data"]], [book.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            book.delete()
+        self.assertEqual(book_search.search(self.school, "petals")["data"], [])
+
+    @skipUnless(connection.vendor == "postgresql", "The trigram ranking needs PostgreSQL")
+    def test_trigram_ranking(self):
+        results = book_search.search(self.school, "river")
+        self.assertEqual(results["data"][0]["id"], self.novels[0].id)
+        self.assertEqual(len(results["data"]), 6)
+
+    def test_invalid_requests_are_reported(self):
+        token = self.login(self.students[0])
+        with self.assertLogs("books.views", "ERROR"):
+            response = self.post("books:search-books", token=token, school_id=str(self.school.id), page="first")
+        self.assertEqual((response["code"], response["error"]), ("999.999.999", "Invalid page"))
+        response = self.post("books:search-books", token=token, school_id=str(self.school.id), search_word="weep")
+        self.assertEqual([row["title"] for row in response["data"]], ["Weep Not, Child"])
+
+
+class ExportTests(LibraryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.token = self.login(self.make_user("librarian", role=Role.admin()))
+        for student, book in zip(self.students, self.books):
+            loan_engine.issue(student, book.id)
+        loan_engine.give_back(self.books[0].id)
+
+    def export(self, name, **data):
+        response = self.call(name, token=self.token, school_id=str(self.school.id), **data)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    @staticmethod
+    def content(response):
+        return b"".join(response.streaming_content).decode()
+
+    def test_books_as_csv(self):
+        response = self.export("books:export-books")
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertRegex(response["Content-Disposition"], r'attachment; filename="books-test-school-\d{14}\.csv"')
+        rows = list(csv.reader(io.StringIO(self.content(response))))
+        self.assertEqual(tuple(rows[0]), book_paginator.fields)
+        self.assertEqual(
+            [row[0] for row in rows[1:]],
+            [str(book_id) for book_id in Book.objects.order_by("-date_created", "-id").values_list("id", flat=True)])
+
+    def test_books_as_ndjson_with_chosen_fields(self):
+        response = self.export("books:export-books", format="ndjson", fields="number,state_name")
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in self.content(response).splitlines()]
+        self.assertEqual(sorted(row["number"] for row in rows), ["B001", "B002", "B003", "B004", "B005"])
+        self.assertEqual(set(rows[0]), {"number", "state_name"})
+        self.assertEqual([row["state_name"] for row in rows].count("Issued"), 2)
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_rows_are_streamed_in_chunks(self):
+        with self.assertNumQueries(0):
+            response = book_export.response(Book.objects.filter(school=self.school))
+        chunks = list(response.streaming_content)
+        # The header and two rows, two rows, then the last row
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(len(b"".join(chunks).decode().splitlines()), 6)
+
+    def test_loans_filtered_by_borrower(self):
+        response = self.export("books:export-loans", format="ndjson", borrower_id=str(self.students[0].id))
+        rows = [json.loads(line) for line in self.content(response).splitlines()]
+        self.assertEqual([(row["username"], row["number"]) for row in rows], [("student1", "B001")])
+        self.assertIsNotNone(rows[0]["to_date"])
+        response = self.export("books:export-loans", state_name="Active", fields="number,classroom_name")
+        rows = list(csv.reader(io.StringIO(self.content(response))))
+        self.assertEqual(sorted(rows[1:]), [["B002", "Form 1A"], ["B003", "Form 1A"]])
+
+    def test_invalid_exports_are_reported(self):
+        with self.assertLogs("books.views", "ERROR"):
+            response = self.export("books:export-books", format="xlsx").json()
+        self.assertEqual(response["error"], "Unsupported export format xlsx")
+        with self.assertLogs("books.views", "ERROR"):
+            response = self.export("books:export-loans", fields="number,password").json()
+        self.assertEqual(response["error"], "Unknown fields: password")
+        response = self.post("books:export-loans", token=self.login(self.students[0]), school_id=str(self.school.id))
+        self.assertEqual(response["code"], "888.888.001")
@@ -2,16 +2,25 @@ from django.urls import re_path
 
 from books.views import BooksAdministration
 
+app_name = 'books'
+
 urlpatterns = [
-    re_path(r'create-book/$', BooksAdministration().create_book),
-    re_path(r'edit-book/$', BooksAdministration().edit_book),
-    re_path(r'delete-book/$', BooksAdministration().delete_book),
-    re_path(r'issue-book/$', BooksAdministration().issue_book),
-    re_path(r'return-book/$', BooksAdministration().return_book),
-    re_path(r'get-book/$', BooksAdministration().get_book),
-    re_path(r'filter-books/$', BooksAdministration().filter_books),
-    re_path(r'user-borrowing-history/$', BooksAdministration().get_user_borrowing_history),
-    re_path(r'get-authors/$', BooksAdministration().get_authors),
-    re_path(r'get-publishers/$', BooksAdministration().get_publishers),
-    re_path(r'get-book-categories/$', BooksAdministration().get_book_categories),
-]
\ No newline at end of file
+    re_path(r'create-book/$', BooksAdministration().create_book, name='create-book'),
+    re_path(r'edit-book/$', BooksAdministration().edit_book, name='edit-book'),
+    re_path(r'delete-book/$', BooksAdministration().delete_book, name='delete-book'),
+    re_path(r'issue-book/$', BooksAdministration().issue_book, name='issue-book'),
+    re_path(r'return-book/$', BooksAdministration().return_book, name='return-book'),
+    re_path(r'issue-books/$', BooksAdministration().issue_books, name='issue-books'),
+    re_path(r'return-books/$', BooksAdministration().return_books, name='return-books'),
+    re_path(r'set-loan-policy/$', BooksAdministration().set_loan_policy, name='set-loan-policy'),
+    re_path(r'library-stats/$', BooksAdministration().get_library_stats, name='library-stats'),
+    re_path(r'get-book/$', BooksAdministration().get_book, name='get-book'),
+    re_path(r'filter-books/$', BooksAdministration().filter_books, name='filter-books'),
+    re_path(r'search-books/$', BooksAdministration().search_books, name='search-books'),
+    re_path(r'export-books/$', BooksAdministration().export_books, name='export-books'),
+    re_path(r'export-loans/$', BooksAdministration().export_loans, name='export-loans'),
+    re_path(r'user-borrowing-history/$', BooksAdministration().get_user_borrowing_history, name='user-borrowing-history'),
+    re_path(r'get-authors/$', BooksAdministration().get_authors, name='get-authors'),
+    re_path(r'get-publishers/$', BooksAdministration().get_publishers, name='get-publishers'),
+    re_path(r'get-book-categories/$', BooksAdministration().get_book_categories, name='get-book-categories'),
+]
@@ -1,19 +1,47 @@
 import logging
 
+from django.conf import settings
 from django.db import transaction as trx
 from django.db.models import F
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 
-from base.backend.services import SchoolService, SubjectService, StateService
+from base.backend.services import SchoolService, SubjectService, StateService, ClassroomService
 from base.models import State
-from books.backend.services import AuthorService, PublisherService, BookCategoryService, BookService, UserBookService
-from users.backend.decorators import user_login_required
+from books.backend.library_stats import library_stats
+from books.backend.loans import loan_engine
+from books.backend.search import book_search
+from books.backend.services import AuthorService, PublisherService, BookCategoryService, BookService, \
+    UserBookService, LoanPolicyService
+from books.models import Book
+from users.backend.decorators import user_login_required, admin
 from users.backend.services import UserService
+from users.models import Role
+from utils.export import StreamingExport
 from utils.get_request_data import get_request_data
+from utils.pagination import KeysetPaginator
 
 lgr = logging.getLogger(__name__)
 
+book_paginator = KeysetPaginator(
+    fields=(
+        "id", "number", "title", "school_id", "author_name", "publisher_name", "category_name", "subject_name",
+        "publication_year", "state_name", "current_borrower_id", "loan_started_at"),
+    annotations={
+        "author_name": F("author__name"), "publisher_name": F("publisher__name"),
+        "category_name": F("category__name"), "subject_name": F("subject__name"), "state_name": F("state__name")})
+book_export = StreamingExport("books", fields=book_paginator.fields, annotations=book_paginator.annotations)
+loan_export = StreamingExport(
+    "loans",
+    fields=(
+        "id", "user_id", "username", "first_name", "last_name", "reg_no", "classroom_name", "book_id", "number",
+        "title", "state_name", "from_date", "due_at", "to_date"),
+    annotations={
+        "username": F("user__username"), "first_name": F("user__first_name"), "last_name": F("user__last_name"),
+        "reg_no": F("user__reg_no"), "classroom_name": F("user__classroom__name"), "number": F("book__number"),
+        "title": F("book__title"), "state_name": F("state__name"), "from_date": F("date_created"),
+        "to_date": F("date_modified")})
+
 class BooksAdministration(object):
     @csrf_exempt
     @user_login_required
@@ -111,10 +139,12 @@ class BooksAdministration(object):
                 raise Exception("Subject name not provided")
             subject = SubjectService().get_or_create(name=subject_name, state=State.active())
             k = {"number": number, "title": title, "publication_year": publication_year, "school": school,
-                 "author": author, "publisher": publisher, "category": category, "subject": subject}
-            book = BookService().update(pk=book.id, **k)
-            if not book:
+                 "author": author, "publisher": publisher, "category": category, "subject": subject,
+                 "search_document": Book.make_search_document(number, title, author.name, publisher.name)}
+            if not BookService().update(pk=book.id, **k):
                 raise Exception("Book not edited")
+            for school_id in {book.school_id, school.id}:
+                trx.on_commit(lambda school_id=school_id: book_search.invalidate(school_id))
             return JsonResponse({"code": "100.000.000", "message": "Book edited successfully"})
         except Exception as e:
             lgr.exception("Edit book exception: %s" % e)
@@ -143,7 +173,6 @@ class BooksAdministration(object):
 
     @csrf_exempt
     @user_login_required
-    @trx.atomic
     def issue_book(self, request):
         """
         Issues a book
@@ -158,23 +187,18 @@ class BooksAdministration(object):
             if not user:
                 raise Exception("User not found")
             book_id = data.get("book_id", "")
-            book = BookService().get(id=book_id)
-            if not book:
-                raise Exception("Book not found")
-            if book.state == State.issued():
-                raise Exception("Book already issued")
-            if not UserBookService().create(user=user, book=book):
-                raise Exception("Book not issued")
-            if not BookService().update(pk=book.id, state=State.issued()):
-                raise Exception("Book state not updated")
-            return JsonResponse({"code": "100.000.000", "message": "Book issued successfully"})
+            if not book_id:
+                raise Exception("Book id not provided")
+            loan = loan_engine.issue(user, book_id)
+            return JsonResponse({
+                "code": "100.000.000", "message": "Book issued successfully", "data": {"due_at": loan.due_at}})
         except Exception as e:
             lgr.exception("Issue book exception: %s" % e)
-            return JsonResponse({"code": "999.999.999", "message": "Issue book failed with an exception", "error": e})
+            return JsonResponse({
+                "code": "999.999.999", "message": "Issue book failed with an exception", "error": str(e)})
 
     @csrf_exempt
     @user_login_required
-    @trx.atomic
     def return_book(self, request):
         """
         Returns a book
@@ -185,17 +209,99 @@ class BooksAdministration(object):
         try:
             data = get_request_data(request)
             book_id = data.get("book_id", "")
-            book = BookService().get(id=book_id)
-            if not book:
-                raise Exception("Book not found")
-            if not UserBookService().filter(book=book).update(state=State.returned()):
-                raise Exception("Book not returned")
-            if not BookService().update(pk=book.id, state=State.idle()):
-                raise Exception("Book state not updated")
+            if not book_id:
+                raise Exception("Book id not provided")
+            loan_engine.give_back(book_id)
             return JsonResponse({"code": "100.000.000", "message": "Book returned successfully"})
         except Exception as e:
             lgr.exception("Return book exception: %s" % e)
-            return JsonResponse({"code": "999.999.999", "message": "Return book failed with an exception", "error": e})
+            return JsonResponse({
+                "code": "999.999.999", "message": "Return book failed with an exception", "error": str(e)})
+
+    @csrf_exempt
+    @user_login_required
+    def issue_books(self, request):
+        """
+        Issues many books at once, either the given loans or one book to each student of a classroom
+        @params: WSGI request with the school_id and either loans, a list of {user_id, book_id}, or a classroom_id and
+        the book_ids to hand out to its students
+        @return: Success message and the result of each loan or error message
+        @rtype: JsonResponse
+        """
+        try:
+            data = get_request_data(request)
+            school_id = data.get("school_id", "")
+            if not school_id:
+                raise Exception("School id not provided")
+            school = SchoolService().get(id=school_id, state=State.active())
+            if not school:
+                raise Exception("School not found")
+            results = []
+            if data.get("classroom_id", ""):
+                classroom = ClassroomService().get(id=data.get("classroom_id"), school=school, state=State.active())
+                if not classroom:
+                    raise Exception("Classroom not found")
+                book_ids = list(data.get("book_ids", []) or [])
+                students = [str(user_id) for user_id in UserService().filter(
+                    classroom=classroom, role=Role.student(), state=State.active()).order_by(
+                    "last_name", "first_name", "id").values_list("id", flat=True)]
+                pairs = list(zip(students, book_ids))
+                results += [{"user_id": user_id, "issued": False, "error": "No book left for the student"}
+                            for user_id in students[len(book_ids):]]
+                results += [{"book_id": book_id, "issued": False, "error": "No student left for the book"}
+                            for book_id in book_ids[len(students):]]
+            else:
+                pairs = [(loan.get("user_id", ""), loan.get("book_id", "")) for loan in data.get("loans", []) or []]
+            if not pairs:
+                raise Exception("Loans not provided")
+            if len(pairs) > settings.LOAN_BATCH_MAX_SIZE:
+                raise Exception("At most %s books can be issued at once" % settings.LOAN_BATCH_MAX_SIZE)
+            results = loan_engine.issue_many(school, pairs) + results
+            return JsonResponse({
+                "code": "100.000.000", "message": "Books issued", "issued": sum(1 for r in results if r["issued"]),
+                "data": results})
+        except Exception as e:
+            lgr.exception("Issue books exception: %s" % e)
+            return JsonResponse({
+                "code": "999.999.999", "message": "Issue books failed with an exception", "error": str(e)})
+
+    @csrf_exempt
+    @user_login_required
+    def return_books(self, request):
+        """
+        Returns many books at once, either the given books or every book a classroom's students have out
+        @params: WSGI request with the school_id and either book_ids or a classroom_id
+        @return: Success message and the result of each book or error message
+        @rtype: JsonResponse
+        """
+        try:
+            data = get_request_data(request)
+            school_id = data.get("school_id", "")
+            if not school_id:
+                raise Exception("School id not provided")
+            school = SchoolService().get(id=school_id, state=State.active())
+            if not school:
+                raise Exception("School not found")
+            if data.get("classroom_id", ""):
+                classroom = ClassroomService().get(id=data.get("classroom_id"), school=school, state=State.active())
+                if not classroom:
+                    raise Exception("Classroom not found")
+                book_ids = list(BookService().filter(
+                    school=school, current_borrower__classroom=classroom).values_list("id", flat=True))
+            else:
+                book_ids = list(data.get("book_ids", []) or [])
+            if not book_ids:
+                raise Exception("Books not provided")
+            if len(book_ids) > settings.LOAN_BATCH_MAX_SIZE:
+                raise Exception("At most %s books can be returned at once" % settings.LOAN_BATCH_MAX_SIZE)
+            results = loan_engine.give_back_many(school, book_ids)
+            return JsonResponse({
+                "code": "100.000.000", "message": "Books returned",
+                "returned": sum(1 for r in results if r["returned"]), "data": results})
+        except Exception as e:
+            lgr.exception("Return books exception: %s" % e)
+            return JsonResponse({
+                "code": "999.999.999", "message": "Return books failed with an exception", "error": str(e)})
 
     @csrf_exempt
     @user_login_required
@@ -221,7 +327,7 @@ class BooksAdministration(object):
                 "book_id", "number", "title", "author_name", "publisher_name", "category_name", "subject_name",
                 "publication_year", "from_date", "to_date", "state_name")
             return JsonResponse({
-                "code": "100.000.000", "message": "Successfully fetched user borrowing history", "data": history})
+                "code": "100.000.000", "message": "Successfully fetched user borrowing history", "data": list(history)})
         except Exception as e:
             lgr.exception("Get user borrowing history exception: %s" % e)
             return JsonResponse({
@@ -244,9 +350,15 @@ class BooksAdministration(object):
                 raise Exception("Book not found")
             book_data = BookService().filter(id=book_id).annotate(author_name=F("author__name")) \
                 .annotate(publisher_name=F("publisher__name")).annotate(category_name=F("category__name")) \
-                .annotate(subject_name=F("subject__name")).annotate(state_name=F("state__name")).values(
+                .annotate(subject_name=F("subject__name")).annotate(state_name=F("state__name")) \
+                .annotate(first_name=F("current_borrower__first_name")) \
+                .annotate(last_name=F("current_borrower__last_name")) \
+                .annotate(other_name=F("current_borrower__other_name")) \
+                .annotate(classroom_name=F("current_borrower__classroom__name")) \
+                .annotate(due_at=F("current_loan__due_at")).values(
                 "id", "number", "title", "school_id", "author_name", "publisher_name", "category_name", "subject_name",
-                "publication_year", "state_name").first()
+                "publication_year", "state_name", "current_borrower_id", "first_name", "last_name", "other_name",
+                "classroom_name", "loan_started_at", "due_at").first()
             issue_history = UserBookService().filter(book=book, state=State.returned()) \
                 .annotate(first_name=F("user__first_name")).annotate(last_name=F("user__last_name")) \
                 .annotate(other_name=F("user__other_name")).annotate(classroom_name=F("user__classroom__name")) \
@@ -255,71 +367,181 @@ class BooksAdministration(object):
                 "user_id", "first_name", "last_name", "other_name", "classroom_name", "state_name",  "from_date",
                 "to_date")
             book_data["issue_history"] = list(issue_history)
-            if book_data.state == State.issued():
-                issued_to = UserBookService().filter(book=book, state=State.active()) \
-                    .annotate(first_name=F("user__first_name")).annotate(last_name=F("user__last_name")) \
-                    .annotate(other_name=F("user__other_name")).annotate(classroom_name=F("user__classroom__name")) \
-                    .annotate(state_name=F("state__name")).annotate(from_date=F("date_created")).values(
-                    "user_id", "first_name", "last_name", "other_name", "classroom_name", "state_name" "from_date") \
-                    .first()
-                book_data["issued_to"] = issued_to
+            borrower = {key: book_data.pop(key) for key in (
+                "current_borrower_id", "first_name", "last_name", "other_name", "classroom_name", "loan_started_at",
+                "due_at")}
+            if borrower["current_borrower_id"]:
+                book_data["issued_to"] = {
+                    "user_id": borrower["current_borrower_id"], "first_name": borrower["first_name"],
+                    "last_name": borrower["last_name"], "other_name": borrower["other_name"],
+                    "classroom_name": borrower["classroom_name"], "from_date": borrower["loan_started_at"],
+                    "due_at": borrower["due_at"]}
             return JsonResponse({
                 "code": "100.000.000", "message": "Successfully fetched book's details", "data": book_data})
         except Exception as e:
             lgr.exception("Get book exception: %s" % e)
-            return JsonResponse({"code": "999.999.999", "message": "Get book failed with an exception", "error": e})
+            return JsonResponse({
+                "code": "999.999.999", "message": "Get book failed with an exception", "error": str(e)})
 
     @csrf_exempt
     @user_login_required
     def filter_books(self, request):
         """
-        Filters books
-        @params: WSGI request
-        @return: Success message and filter results or error message
+        Filters books, a page at a time
+        @params: WSGI request, optionally with a cursor (the next_cursor of the previous page), page_size and fields
+        @return: Success message, a page of filter results and the next cursor or error message
         @rtype: JsonResponse
         """
         try:
             data = get_request_data(request)
             data.pop("user_id", "")
             data.pop("token", "")
-            school_id = data.pop("school_id", "")
+            cursor = data.pop("cursor", None)
+            fields = data.pop("fields", None)
+            page_size = data.pop("page_size", None)
+            data = self.book_filters(data)
+            page = book_paginator.page(
+                BookService().filter(**data), cursor=cursor, fields=fields, page_size=page_size)
+            return JsonResponse({
+                "code": "100.000.000", "message": "Successfully filtered books", "data": page["data"],
+                "next_cursor": page["next_cursor"]})
+        except Exception as e:
+            lgr.exception("Filter books exception: %s" % e)
+            return JsonResponse({
+                "code": "999.999.999", "message": "Filter books failed with an exception", "error": str(e)})
+
+    @csrf_exempt
+    @user_login_required
+    @admin
+    def export_books(self, request):
+        """
+        Streams a school's catalogue as CSV or JSON lines
+        @params: WSGI request with the same filters as filter_books, optionally with a format (csv or ndjson) and fields
+        @return: The export as an attachment or error message
+        @rtype: StreamingHttpResponse | JsonResponse
+        """
+        try:
+            data = get_request_data(request)
+            data.pop("user_id", "")
+            data.pop("token", "")
+            export_format = data.pop("format", None)
+            fields = data.pop("fields", None)
+            data = self.book_filters(data)
+            return book_export.response(
+                BookService().filter(**data), export_format=export_format, fields=fields, suffix=data["school"].code)
+        except Exception as e:
+            lgr.exception("Export books exception: %s" % e)
+            return JsonResponse({
+                "code": "999.999.999", "message": "Export books failed with an exception", "error": str(e)})
+
+    @csrf_exempt
+    @user_login_required
+    @admin
+    def export_loans(self, request):
+        """
+        Streams a school's borrowing history as CSV or JSON lines
+        @params: WSGI request with the school_id, optionally filtered by borrower_id, classroom_id and state_name,
+        and optionally with a format (csv or ndjson) and fields
+        @return: The export as an attachment or error message
+        @rtype: StreamingHttpResponse | JsonResponse
+        """
+        try:
+            data = get_request_data(request)
+            school_id = data.get("school_id", "")
             if not school_id:
                 raise Exception("School id not provided")
             school = SchoolService().get(id=school_id, state=State.active())
             if not school:
                 raise Exception("School not found")
-            data["school"] = school
-            if "author_name" in data:
-                author_name = data.pop("author_name")
-                author = AuthorService().get(name=author_name, state=State.active())
-                data["author"] = author
-            if "publisher_name" in data:
-                publisher_name = data.pop("publisher_name")
-                publisher = PublisherService().get(name=publisher_name, state=State.active())
-                data["publisher"] = publisher
-            if "category_name" in data:
-                category_name = data.pop("category_name")
-                category = BookCategoryService().get(name=category_name, state=State.active())
-                data["category"] = category
-            if "subject_name" in data:
-                subject_name = data.pop("subject_name")
-                subject = SubjectService().get(name=subject_name, state=State.active())
-                data["subject"] = subject
-            if "state_name" in data:
-                state_name = data.pop("state_name")
-                state = StateService().get(name=state_name)
-                data["state"] = state
-            filter_results = BookService().filter(**data).annotate(author_name=F("author__name")) \
-                .annotate(publisher_name=F("publisher__name")).annotate(category_name=F("category__name")) \
-                .annotate(subject_name=F("subject__name")).annotate(state_name=F("state__name")).values(
-                "id", "number", "title", "school_id", "author_name", "publisher_name", "category_name", "subject_name",
-                "publication_year", "state_name")
-            filter_results = list(filter_results)
+            filters = {"book__school": school}
+            if data.get("borrower_id", ""):
+                filters["user_id"] = data.get("borrower_id")
+            if data.get("classroom_id", ""):
+                filters["user__classroom_id"] = data.get("classroom_id")
+            if data.get("state_name", ""):
+                filters["state__name"] = data.get("state_name")
+            return loan_export.response(
+                UserBookService().filter(**filters), export_format=data.get("format", None),
+                fields=data.get("fields", None), suffix=school.code)
+        except Exception as e:
+            lgr.exception("Export loans exception: %s" % e)
             return JsonResponse({
-                "code": "100.000.000", "message": "Successfully filtered books", "data": filter_results})
+                "code": "999.999.999", "message": "Export loans failed with an exception", "error": str(e)})
+
+    @staticmethod
+    def book_filters(data):
+        """
+        Turns the filters sent to filter_books and export_books into queryset filters
+        @param data: The request data without the token and paging options.
+        @type data: dict
+        @return: The filters for BookService().filter
+        @rtype: dict
+        """
+        school_id = data.pop("school_id", "")
+        if not school_id:
+            raise Exception("School id not provided")
+        school = SchoolService().get(id=school_id, state=State.active())
+        if not school:
+            raise Exception("School not found")
+        data["school"] = school
+        if "author_name" in data:
+            author_name = data.pop("author_name")
+            author = AuthorService().get(name=author_name, state=State.active())
+            data["author"] = author
+        if "publisher_name" in data:
+            publisher_name = data.pop("publisher_name")
+            publisher = PublisherService().get(name=publisher_name, state=State.active())
+            data["publisher"] = publisher
+        if "category_name" in data:
+            category_name = data.pop("category_name")
+            category = BookCategoryService().get(name=category_name, state=State.active())
+            data["category"] = category
+        if "subject_name" in data:
+            subject_name = data.pop("subject_name")
+            subject = SubjectService().get(name=subject_name, state=State.active())
+            data["subject"] = subject
+        if "state_name" in data:
+            state_name = data.pop("state_name")
+            state = StateService().get(name=state_name)
+            data["state"] = state
+        if "borrower_id" in data:
+            data["current_borrower_id"] = data.pop("borrower_id")
+        if "classroom_id" in data:
+            data["current_borrower__classroom_id"] = data.pop("classroom_id")
+        return data
+
+    @csrf_exempt
+    @user_login_required
+    def search_books(self, request):
+        """
+        Searches a school's books as the user types, with the number of matches per category, subject and state
+        @params: WSGI request, optionally with category_name, subject_name and state_name filters, a page number and
+        page_size
+        @return: Success message, a page of books, the facet counts and the next page number or error message
+        @rtype: JsonResponse
+        """
+        try:
+            data = get_request_data(request)
+            school_id = data.get("school_id", "")
+            if not school_id:
+                raise Exception("School id not provided")
+            school = SchoolService().get(id=school_id, state=State.active())
+            if not school:
+                raise Exception("School not found")
+            filters = {}
+            for facet in ("category", "subject", "state"):
+                if data.get("%s_name" % facet, ""):
+                    filters["%s__name" % facet] = data.get("%s_name" % facet)
+            results = book_search.search(
+                school, data.get("search_word", ""), filters=filters, page=data.get("page", None),
+                page_size=data.get("page_size", None))
+            return JsonResponse({
+                "code": "100.000.000", "message": "Successfully searched books", "data": results["data"],
+                "facets": results["facets"], "next_page": results["next_page"]})
         except Exception as e:
-            lgr.exception("Filter books exception: %s" % e)
-            return JsonResponse({"code": "999.999.999", "message": "Filter books failed with an exception", "error": e})
+            lgr.exception("Search books exception: %s" % e)
+            return JsonResponse({
+                "code": "999.999.999", "message": "Search books failed with an exception", "error": str(e)})
 
     @csrf_exempt
     @user_login_required
@@ -355,6 +577,75 @@ class BooksAdministration(object):
             return JsonResponse({
                 "code": "999.999.999", "message": "Get publishers failed with an exception", "error": e})
 
+    @csrf_exempt
+    @user_login_required
+    @admin
+    def set_loan_policy(self, request):
+        """
+        Sets how many days a school's books are lent for, for all its books or the books of a category
+        @params: WSGI request with the school_id, loan_days and optionally a category_name
+        @return: Success or error message
+        @rtype: JsonResponse
+        """
+        try:
+            data = get_request_data(request)
+            school_id = data.get("school_id", "")
+            if not school_id:
+                raise Exception("School id not provided")
+            school = SchoolService().get(id=school_id, state=State.active())
+            if not school:
+                raise Exception("School not found")
+            try:
+                loan_days = int(data.get("loan_days", ""))
+            except (TypeError, ValueError):
+                raise Exception("Loan days not provided")
+            if loan_days < 1:
+                raise Exception("Loan days must be at least 1")
+            category = None
+            if data.get("category_name", ""):
+                category = BookCategoryService().get(name=data.get("category_name"), state=State.active())
+                if not category:
+                    raise Exception("Book category not found")
+            policy = LoanPolicyService().filter(school=school, category=category).first()
+            if policy:
+                # Saved rather than updated so the loan policy cache is invalidated
+                policy.loan_days, policy.state = loan_days, State.active()
+                policy.save()
+            elif not LoanPolicyService().create(school=school, category=category, loan_days=loan_days):
+                raise Exception("Loan policy not created")
+            return JsonResponse({"code": "100.000.000", "message": "Loan policy set successfully"})
+        except Exception as e:
+            lgr.exception("Set loan policy exception: %s" % e)
+            return JsonResponse({
+                "code": "999.999.999", "message": "Set loan policy failed with an exception", "error": str(e)})
+
+    @csrf_exempt
+    @user_login_required
+    @admin
+    def get_library_stats(self, request):
+        """
+        Fetches a school's library dashboard: books per state and category, loans per month, the top borrowers and
+        the most borrowed titles
+        @params: WSGI request with the school_id and optionally top, the number of borrowers and titles to list
+        @return: Success message and the statistics or error message
+        @rtype: JsonResponse
+        """
+        try:
+            data = get_request_data(request)
+            school_id = data.get("school_id", "")
+            if not school_id:
+                raise Exception("School id not provided")
+            school = SchoolService().get(id=school_id, state=State.active())
+            if not school:
+                raise Exception("School not found")
+            return JsonResponse({
+                "code": "100.000.000", "message": "Successfully fetched library statistics",
+                "data": library_stats.summary(school, top=data.get("top", None))})
+        except Exception as e:
+            lgr.exception("Get library stats exception: %s" % e)
+            return JsonResponse({
+                "code": "999.999.999", "message": "Get library stats failed with an exception", "error": str(e)})
+
     @csrf_exempt
     @user_login_required
     def get_book_categories(self, request):
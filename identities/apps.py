@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class IdentitiesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'identities'
+
+    def ready(self):
+        import identities.signals
@@ -0,0 +1,116 @@
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from base.models import State
+from identities.backend.services import IdentityService
+from utils.token_manager import hash_token, token_expiry
+
+lgr = logging.getLogger(__name__)
+
+
+class UserIdentity(object):
+    """
+    The authenticated caller of a request, as attached to request.user_identity.
+    """
+
+    def __init__(self, identity_id, user_id, role_id, user_state_id, expires_at):
+        self.identity_id = identity_id
+        self.user_id = user_id
+        self.role_id = role_id
+        self.user_state_id = user_state_id
+        self.expires_at = expires_at
+
+    def __repr__(self):
+        return "UserIdentity(user_id=%s, expires_at=%s)" % (self.user_id, self.expires_at)
+
+
+class IdentityCache(object):
+    """
+    Caches active access tokens as token -> (identity, user, expiry) so authenticated requests skip the identities table.
+    The sliding expiry is only written back once the remaining lifetime drops below TOKEN_EXTEND_THRESHOLD_SECONDS.
+    """
+
+    @staticmethod
+    def key(token):
+        return "identities:token:%s" % hash_token(token)
+
+    def authenticate(self, token):
+        """
+        Resolves an access token to the identity it belongs to, extending the token when it is due.
+        @param token: The access token sent by the client.
+        @type token: str
+        @return: The authenticated identity or None if the token is not active.
+        @rtype: UserIdentity | None
+        """
+        if not token:
+            return None
+        now = timezone.now()
+        user_identity = cache.get(self.key(token))
+        if user_identity is None or user_identity.expires_at <= now:
+            user_identity = self._load(token, now)
+            if user_identity is None:
+                return None
+        remaining = (user_identity.expires_at - now).total_seconds()
+        if remaining < settings.TOKEN_EXTEND_THRESHOLD_SECONDS:
+            user_identity = self._extend(token, user_identity)
+        return user_identity
+
+    def discard(self, *tokens):
+        """
+        Drops the given tokens from the cache.
+        @param tokens: The access tokens to drop.
+        """
+        cache.delete_many([self.key(token) for token in tokens])
+
+    def discard_user(self, user):
+        """
+        Drops every active token belonging to the user from the cache.
+        @param user: The user whose tokens we are dropping.
+        @type user: User
+        """
+        self.discard_users([user.id])
+
+    def discard_users(self, user_ids):
+        """
+        Drops every active token of the given users from the cache, e.g. after their role or state changed so the
+        next request reloads them.
+        @param user_ids: The ids of the users.
+        @type user_ids: list
+        """
+        tokens = list(IdentityService().filter(
+            user_id__in=list(user_ids), state=State.active()).values_list("token", flat=True))
+        if tokens:
+            self.discard(*tokens)
+
+    def _load(self, token, now):
+        oauth = IdentityService().filter(
+            token_hash=hash_token(token), expires_at__gt=now, state=State.active()).values(
+            "id", "user_id", "user__role_id", "user__state_id", "expires_at").first()
+        if not oauth:
+            return None
+        user_identity = UserIdentity(
+            identity_id=oauth["id"], user_id=oauth["user_id"], role_id=oauth["user__role_id"],
+            user_state_id=oauth["user__state_id"], expires_at=oauth["expires_at"])
+        self._store(token, user_identity, now)
+        return user_identity
+
+    def _extend(self, token, user_identity):
+        expires_at = token_expiry()
+        if not IdentityService().update(pk=user_identity.identity_id, expires_at=expires_at):
+            lgr.warning("IdentityCache - identity %s not extended" % user_identity.identity_id)
+            return user_identity
+        user_identity.expires_at = expires_at
+        self._store(token, user_identity, timezone.now())
+        return user_identity
+
+    def _store(self, token, user_identity, now):
+        lifetime = int((user_identity.expires_at - now).total_seconds())
+        timeout = min(lifetime, settings.IDENTITY_CACHE_SECONDS)
+        if timeout > 0:
+            cache.set(self.key(token), user_identity, timeout=timeout)
+
+
+identity_cache = IdentityCache()
@@ -0,0 +1,26 @@
+import logging
+
+from identities.backend.identity_cache import identity_cache
+from utils.get_request_data import get_request_data
+
+lgr = logging.getLogger(__name__)
+
+
+class TokenAuthenticationMiddleware(object):
+    """
+    Resolves the access token sent with the request and attaches the caller as request.user_identity.
+    Requests without a valid token get None; the user_login_required decorator decides whether that is allowed.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.user_identity = None
+        try:
+            token = get_request_data(request).get("token", "")
+            if token:
+                request.user_identity = identity_cache.authenticate(token)
+        except Exception as e:
+            lgr.exception("TokenAuthenticationMiddleware exception: %s" % e)
+        return self.get_response(request)
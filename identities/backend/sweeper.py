@@ -0,0 +1,65 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from base.models import State
+from identities.models import Identity
+
+lgr = logging.getLogger(__name__)
+
+
+class IdentitySweeper(object):
+    """
+    Expires lapsed identities and purges expired ones past the retention window in bounded batches so the
+    identities table only holds the hot set of live and recently expired tokens.
+    """
+
+    def __init__(self, batch_size=None, retention_days=None, max_batches=None):
+        self.batch_size = batch_size or settings.IDENTITY_SWEEP_BATCH_SIZE
+        self.retention_days = max(
+            retention_days if retention_days is not None else settings.IDENTITY_RETENTION_DAYS, 1)
+        self.max_batches = max_batches
+
+    def expire(self):
+        """
+        Marks identities whose expiry has passed as Expired.
+        @return: The number of identities expired.
+        @rtype: int
+        """
+        queryset = Identity.objects.filter(
+            state__in=[State.active(), State.activation_pending()], expires_at__lte=timezone.now())
+        return self._run(queryset, lambda batch: batch.update(state=State.expired()))
+
+    def purge(self):
+        """
+        Deletes expired identities whose expiry is older than the retention window.
+        The window is at least a day so the login OTP reuse lookup always finds today's identities.
+        @return: The number of identities deleted.
+        @rtype: int
+        """
+        cutoff = timezone.now() - timedelta(days=self.retention_days)
+        queryset = Identity.objects.filter(state=State.expired(), expires_at__lt=cutoff)
+        return self._run(queryset, lambda batch: batch.delete()[1].get(Identity._meta.label, 0))
+
+    def sweep(self):
+        """
+        Runs an expire pass followed by a purge pass.
+        @return: The number of identities expired and purged.
+        @rtype: dict
+        """
+        return {"expired": self.expire(), "purged": self.purge()}
+
+    def _run(self, queryset, action):
+        total = 0
+        batches = 0
+        while self.max_batches is None or batches < self.max_batches:
+            ids = list(queryset.order_by().values_list("id", flat=True)[:self.batch_size])
+            if not ids:
+                break
+            total += action(Identity.objects.filter(id__in=ids))
+            batches += 1
+            if len(ids) < self.batch_size:
+                break
+        return total
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from identities.backend.sweeper import IdentitySweeper
+
+
+class Command(BaseCommand):
+    help = "Expires lapsed identities and purges expired identities older than the retention window."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, help="Rows updated or deleted per statement.")
+        parser.add_argument("--retention-days", type=int, help="Days expired identities are kept for.")
+        parser.add_argument("--max-batches", type=int, help="Upper bound on batches per pass.")
+        parser.add_argument("--loop", action="store_true", help="Keep sweeping every --interval seconds.")
+        parser.add_argument("--interval", type=int, default=300, help="Seconds between passes with --loop.")
+
+    def handle(self, *args, **options):
+        sweeper = IdentitySweeper(
+            batch_size=options["batch_size"], retention_days=options["retention_days"],
+            max_batches=options["max_batches"])
+        while True:
+            result = sweeper.sweep()
+            self.stdout.write("Expired %(expired)s identities, purged %(purged)s identities" % result)
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
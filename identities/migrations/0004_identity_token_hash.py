@@ -0,0 +1,41 @@
+# Generated by Django 5.0.4 on 2026-10-18 17:13
+
+import hashlib
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_token_hash(apps, schema_editor):
+    Identity = apps.get_model('identities', 'Identity')
+    batch = []
+    for identity in Identity.objects.filter(token_hash__isnull=True).only('id', 'token').iterator(chunk_size=2000):
+        identity.token_hash = hashlib.sha256(str(identity.token).encode('utf-8')).hexdigest()
+        batch.append(identity)
+        if len(batch) >= 2000:
+            Identity.objects.bulk_update(batch, ['token_hash'])
+            batch = []
+    if batch:
+        Identity.objects.bulk_update(batch, ['token_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0001_initial'),
+        ('identities', '0003_alter_identity_options'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='identity',
+            name='token_hash',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.RunPython(backfill_token_hash, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='identity',
+            index=models.Index(fields=['state', 'expires_at'], name='identity_state_expires_idx'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.0.4 on 2026-10-18 17:42
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0003_hot_query_indexes'),
+        ('identities', '0004_identity_token_hash'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='identity',
+            index=models.Index(fields=['user', 'state', 'expires_at'], name='identity_user_state_idx'),
+        ),
+    ]
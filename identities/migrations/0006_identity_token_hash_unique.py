@@ -0,0 +1,18 @@
+# Generated by Django 5.0.4 on 2026-10-18 18:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identities', '0005_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='identity',
+            name='token_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+    ]
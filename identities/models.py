@@ -3,11 +3,12 @@ from django.db import models
 
 from base.models import BaseModel, State
 from users.models import User
-from utils.token_manager import token_expiry, generate_token
+from utils.token_manager import token_expiry, generate_token, hash_token
 
 
 class Identity(BaseModel):
 	token = models.CharField(default=generate_token, max_length=200)
+	token_hash = models.CharField(max_length=64, null=True, blank=True, unique=True, editable=False)
 	expires_at = models.DateTimeField(default=token_expiry)
 	user = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE)
 	source_ip = models.GenericIPAddressField(
@@ -17,6 +18,7 @@ class Identity(BaseModel):
 	state = models.ForeignKey(State, default=State.activation_pending, on_delete=models.CASCADE)
 
 	SYNC_MODEL = False
+	HOT_QUERIES = (('token_hash',), ('user', 'state', 'expires_at'), ('state', 'expires_at'))
 
 	def _str_(self):
 		return '%s - %s' % (self.user,  self.source_ip)
@@ -24,6 +26,17 @@ class Identity(BaseModel):
 	class Meta(object):
 		ordering = ('-date_created',)
 		verbose_name_plural = "Identities"
+		indexes = [
+			models.Index(fields=['state', 'expires_at'], name='identity_state_expires_idx'),
+			models.Index(fields=['user', 'state', 'expires_at'], name='identity_user_state_idx'),
+		]
+
+	def save(self, *args, **kwargs):
+		self.token_hash = hash_token(self.token)
+		update_fields = kwargs.get('update_fields')
+		if update_fields is not None and 'token' in update_fields:
+			kwargs['update_fields'] = set(update_fields) | {'token_hash'}
+		super(Identity, self).save(*args, **kwargs)
 
 	def extend(self):
 		"""
@@ -34,7 +47,7 @@ class Identity(BaseModel):
 		# noinspection PyBroadException
 		try:
 			self.expires_at = token_expiry()
-			self.save()
+			self.save(update_fields=["expires_at", "date_modified"])
 		except Exception:
 			pass
 		return self
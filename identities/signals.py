@@ -0,0 +1,14 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from identities.backend.identity_cache import identity_cache
+from identities.models import Identity
+
+
+@receiver(post_save, sender=Identity)
+@receiver(post_delete, sender=Identity)
+def discard_cached_identity(sender, instance, **kwargs):
+    """
+    Drops the cached copy of an identity whenever the row changes so the next request reloads it.
+    """
+    identity_cache.discard(instance.token)
@@ -1,3 +1,171 @@
-from django.test import TestCase
+import importlib
+import io
+import json
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.core.management import call_command
+from django.test import RequestFactory
+from django.utils import timezone
+
+from base.models import State
+from identities.backend.identity_cache import identity_cache
+from identities.backend.middleware import TokenAuthenticationMiddleware
+from identities.backend.sweeper import IdentitySweeper
+from identities.models import Identity
+from users.models import Role
+from utils.get_request_data import get_request_data
+from utils.testing import SchoolTestCase
+from utils.token_manager import hash_token
+
+
+class IdentityCacheTests(SchoolTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.student = self.students[0]
+        self.token = self.login(self.student)
+
+    def test_tokens_are_looked_up_by_digest(self):
+        identity = Identity.objects.get(user=self.student)
+        self.assertEqual(identity.token_hash, hash_token(self.token))
+        user_identity = identity_cache.authenticate(self.token)
+        self.assertEqual(
+            (user_identity.identity_id, user_identity.user_id, user_identity.role_id),
+            (identity.id, self.student.id, self.student.role_id))
+        with self.assertNumQueries(0):
+            self.assertEqual(identity_cache.authenticate(self.token).identity_id, identity.id)
+        self.assertIsNone(identity_cache.authenticate("b'not-a-token'"))
+        self.assertIsNone(identity_cache.authenticate(""))
+
+    def test_logout_evicts_cached_tokens(self):
+        identity_cache.authenticate(self.token)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.post("identities:logout", user_id=str(self.student.id))
+        self.assertEqual(response["code"], "100.000.000")
+        self.assertEqual(Identity.objects.get(user=self.student).state, State.expired())
+        self.assertIsNone(identity_cache.authenticate(self.token))
+
+    def test_expired_tokens_are_not_served_from_the_cache(self):
+        identity_cache.authenticate(self.token)
+        identity = Identity.objects.get(user=self.student)
+        identity.state = State.expired()
+        identity.save()
+        self.assertIsNone(identity_cache.authenticate(self.token))
+
+    def test_cached_tokens_expire(self):
+        identity_cache.authenticate(self.token)
+        later = Identity.objects.get(user=self.student).expires_at + timedelta(seconds=1)
+        with mock.patch("identities.backend.identity_cache.timezone.now", return_value=later):
+            self.assertIsNone(identity_cache.authenticate(self.token))
+
+    def test_tokens_due_for_extension_are_extended(self):
+        Identity.objects.filter(user=self.student).update(expires_at=timezone.now() + timedelta(seconds=60))
+        with self.settings(TOKEN_EXTEND_THRESHOLD_SECONDS=120):
+            user_identity = identity_cache.authenticate(self.token)
+        expires_at = Identity.objects.get(user=self.student).expires_at
+        self.assertGreater(expires_at, timezone.now() + timedelta(seconds=120))
+        self.assertEqual(user_identity.expires_at, expires_at)
+
+    def test_role_changes_reach_cached_tokens(self):
+        identity_cache.authenticate(self.token)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.student.classroom = None
+            self.student.role = Role.clerk()
+            self.student.save()
+        self.assertEqual(identity_cache.authenticate(self.token).role_id, self.student.role_id)
+
+
+class TokenAuthenticationMiddlewareTests(SchoolTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.middleware = TokenAuthenticationMiddleware(lambda request: request.user_identity)
+
+    def request(self, **data):
+        return RequestFactory().post("/", data=json.dumps(data), content_type="application/json")
+
+    def test_attaches_the_caller(self):
+        token = self.login(self.students[0])
+        self.assertEqual(self.middleware(self.request(token=token)).user_id, self.students[0].id)
+        self.assertIsNone(self.middleware(self.request(token="b'unknown'")))
+        self.assertIsNone(self.middleware(self.request()))
+
+    def test_request_data_is_parsed_once(self):
+        request = self.request(token="b'unknown'", school_id="1")
+        with mock.patch("utils.get_request_data.json.loads", wraps=json.loads) as loads:
+            self.middleware(request)
+            data = get_request_data(request)
+            data.pop("token")
+            self.assertEqual(get_request_data(request), {"token": "b'unknown'", "school_id": "1"})
+        self.assertEqual(loads.call_count, 1)
+
+
+class TokenHashMigrationTests(SchoolTestCase):
+
+    def test_backfill_hashes_existing_tokens(self):
+        migration = importlib.import_module("identities.migrations.0004_identity_token_hash")
+        tokens = [self.login(student) for student in self.students]
+        # Rows from before the column existed
+        Identity.objects.update(token_hash=None)
+        migration.backfill_token_hash(apps, None)
+        self.assertEqual(
+            sorted(Identity.objects.values_list("token_hash", flat=True)),
+            sorted(hash_token(token) for token in tokens))
+        self.assertEqual(identity_cache.authenticate(tokens[0]).user_id, self.students[0].id)
+
+
+class IdentitySweeperTests(SchoolTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.student = self.students[0]
+
+    def identity(self, state, days):
+        """
+        @param days: Days from now the identity expires, negative for days ago.
+        """
+        return Identity.objects.create(
+            user=self.student, state=state, expires_at=timezone.now() + timedelta(days=days))
+
+    def states(self):
+        return sorted(Identity.objects.values_list("state__name", flat=True))
+
+    def test_expire_only_marks_lapsed_identities(self):
+        live = self.identity(State.active(), 1)
+        lapsed = [self.identity(State.active(), -1), self.identity(State.activation_pending(), -1)]
+        self.assertEqual(IdentitySweeper(batch_size=1).expire(), 2)
+        self.assertEqual(Identity.objects.get(id=live.id).state, State.active())
+        self.assertEqual(
+            set(Identity.objects.filter(id__in=[identity.id for identity in lapsed]).values_list("state", flat=True)),
+            {State.expired().id})
+
+    def test_purge_only_deletes_expired_identities_past_retention(self):
+        kept = [
+            self.identity(State.expired(), -5), self.identity(State.active(), -40),
+            self.identity(State.activation_pending(), -40), self.identity(State.active(), 1)]
+        for n in range(5):
+            self.identity(State.expired(), -40 - n)
+        self.assertEqual(IdentitySweeper(batch_size=2, retention_days=30).purge(), 5)
+        self.assertEqual(set(Identity.objects.values_list("id", flat=True)), {identity.id for identity in kept})
+
+    def test_batches_are_bounded(self):
+        for n in range(5):
+            self.identity(State.expired(), -40 - n)
+        self.assertEqual(IdentitySweeper(batch_size=2, retention_days=30, max_batches=2).purge(), 4)
+        self.assertEqual(Identity.objects.count(), 1)
+
+    def test_retention_is_at_least_a_day(self):
+        # Today's expired identity is what login reuses the OTP of
+        today = self.identity(State.expired(), -0.5)
+        self.assertEqual(IdentitySweeper(retention_days=0).purge(), 0)
+        self.assertTrue(Identity.objects.filter(id=today.id).exists())
+
+    def test_command(self):
+        self.identity(State.active(), -1)
+        self.identity(State.expired(), -40)
+        out = io.StringIO()
+        call_command("sweep_identities", "--retention-days", "30", stdout=out)
+        self.assertEqual(out.getvalue().strip(), "Expired 1 identities, purged 1 identities")
+        self.assertEqual(self.states(), ["Expired"])
@@ -2,8 +2,10 @@ from django.urls import re_path
 
 from identities.views import IdentitiesAdministration
 
+app_name = 'identities'
+
 urlpatterns = [
-    re_path(r'^login/$', IdentitiesAdministration().login),
-    re_path(r'^verify/$', IdentitiesAdministration().verify_totp),
-    re_path(r'^logout/$', IdentitiesAdministration().logout),
-]
\ No newline at end of file
+    re_path(r'^login/$', IdentitiesAdministration().login, name='login'),
+    re_path(r'^verify/$', IdentitiesAdministration().verify_totp, name='verify'),
+    re_path(r'^logout/$', IdentitiesAdministration().logout, name='logout'),
+]
@@ -1,17 +1,20 @@
 import calendar
 import logging
 
+from django.db import transaction as trx
 from django.db.models import Q
 from django.http import JsonResponse
 from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 
 from base.models import State
+from identities.backend.identity_cache import identity_cache
 from identities.backend.services import IdentityService
 from users.backend.services import UserService
 from utils.common import create_notification_detail, get_client_ip
 from utils.generate_system_aoth_otp import OAuthHelper
 from utils.get_request_data import get_request_data
+from utils.token_manager import hash_token
 from utils.transaction_log_base import TransactionLogBase
 
 lgr = logging.getLogger(__name__)
@@ -54,21 +57,19 @@ class IdentitiesAdministration(TransactionLogBase):
                     generated = OAuthHelper.generate_device_otp()
                     otp = list(generated)
                     key = (otp[1]).decode()
-                    oauth = IdentityService().update(pk=oauth.id, totp_key=key, totp_time_value=otp[2])
-                    totp = otp[0]
-                    if not oauth:
+                    if not IdentityService().update(pk=oauth.id, totp_key=key, totp_time_value=otp[2]):
                         raise Exception("Identity not updated")
+                    totp = otp[0]
                     notification_msg = "Welcome. Your OTP is %s" % totp.decode()
                     notification_details = create_notification_detail(
                         message_code="SC0009", message_type="2", message=notification_msg, destination=user.email)
                     self.send_notification(notifications=notification_details)
                 else:
-                    oauth = IdentityService().update(
-                        pk=oauth.id, otp_key=oauth_today.totp_key, totp_time_value=oauth_today.totp_time_value)
-                    if not oauth:
+                    if not IdentityService().update(
+                            pk=oauth.id, totp_key=oauth_today.totp_key, totp_time_value=oauth_today.totp_time_value):
                         raise Exception("Identity not updated")
             oauth = oauth.extend()
-            user.update_last_activity()
+            UserService().update(pk=user.id, last_login=timezone.now())
             return JsonResponse({
                 "code": "100.000.000",
                 "message": "Login successful",
@@ -95,15 +96,14 @@ class IdentitiesAdministration(TransactionLogBase):
             token = data.get("token", "")
             totp = data.get("otp", "")
             oauth = IdentityService().filter(
-                ~Q(user=None), state__in=[State.active(), State.activation_pending()], token=token,
+                ~Q(user=None), state__in=[State.active(), State.activation_pending()], token_hash=hash_token(token),
                 expires_at__gt=timezone.now()).first()
             if not oauth:
                 raise Exception("Identity not found")
             generated = OAuthHelper.verify_device(oauth.totp_key, str(totp).strip(), float(oauth.totp_time_value))
             if not generated:
                 raise Exception("Invalid OTP")
-            oauth = IdentityService().update(pk=oauth.id, state=State.active())
-            if not oauth:
+            if not IdentityService().update(pk=oauth.id, state=State.active()):
                 raise Exception("Identity not updated")
             oauth = oauth.extend()
             return JsonResponse({
@@ -132,7 +132,12 @@ class IdentitiesAdministration(TransactionLogBase):
             user = UserService().get(id=user_id, state=State.active())
             if not user:
                 raise Exception("User not found")
-            IdentityService().filter(user=user, state=State.active()).update(state=State.expired())
+            identities = list(IdentityService().filter(user=user, state=State.active()).values_list("id", "token"))
+            tokens = [token for identity_id, token in identities]
+            IdentityService().filter(id__in=[identity_id for identity_id, token in identities]).update(
+                state=State.expired())
+            # Only dropped once the expiry is committed, so a concurrent request cannot cache the identity again
+            trx.on_commit(lambda: identity_cache.discard(*tokens))
             return JsonResponse({"code": "100.000.000", "message": "User logged out successfully"})
         except Exception as e:
             lgr.exception("Logout exception: %s" % e)
@@ -14,3 +14,10 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'school_management_system.settings')
 
 application = get_asgi_application()
+
+# Warm the lookup registries once per worker so the first requests do not pay for them
+from base.models import state_registry, transaction_type_registry, notification_type_registry  # noqa: E402
+
+state_registry.warm()
+transaction_type_registry.warm()
+notification_type_registry.warm()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -45,10 +46,12 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'base.backend.middleware.QueryMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'identities.backend.middleware.TokenAuthenticationMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
@@ -92,6 +95,18 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# The default cache is shared by every gunicorn worker on the host; point CACHE_BACKEND/CACHE_LOCATION at
+# memcached or redis when running on more than one host.
+
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get("CACHE_BACKEND", "django.core.cache.backends.filebased.FileBasedCache"),
+        "LOCATION": os.environ.get("CACHE_LOCATION", "/var/tmp/school_management_system_cache"),
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -137,7 +152,93 @@ STATIC_URL = '/static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 TOKEN_EXPIRY_SECONDS = 20000
+TOKEN_EXTEND_THRESHOLD_SECONDS = 18000
+IDENTITY_CACHE_SECONDS = 300
+IDENTITY_RETENTION_DAYS = 30
+IDENTITY_SWEEP_BATCH_SIZE = 1000
+
+# Notifications Bus
+SEND_NOTIFICATIONS = os.environ.get("SEND_NOTIFICATIONS", "False") == "True"
+BUS_URL = os.environ.get("BUS_URL", "")
+BUS_USERNAME = os.environ.get("BUS_USERNAME", "")
+CLIENT_ID = os.environ.get("CLIENT_ID", "")
+CLIENT_SECRET = os.environ.get("CLIENT_SECRET", "")
+APP_CODE = os.environ.get("APP_CODE", "")
+BUS_VERIFY_SSL = os.environ.get("BUS_VERIFY_SSL", "False") == "True"
+BUS_TIMEOUT_SECONDS = 10
+BUS_TOKEN_TTL_SECONDS = 3000
+BUS_POOL_SIZE = 8
+NOTIFICATION_BATCH_SIZE = 100
+NOTIFICATION_WORKER_THREADS = 8
+NOTIFICATION_POLL_INTERVAL_SECONDS = 5
+NOTIFICATION_LEASE_SECONDS = 300
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_RETRY_BACKOFF_SECONDS = 30
+
+BULK_IMPORT_CHUNK_SIZE = 500
+BULK_IMPORT_MAX_ROWS = 5000
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 0)) or os.cpu_count() or 1
+# fork, spawn or forkserver; threaded web servers are safer with forkserver than with fork
+PASSWORD_HASH_START_METHOD = os.environ.get("PASSWORD_HASH_START_METHOD", None)
+PASSWORD_RESET_CHUNK_SIZE = 500
+PAGINATION_DEFAULT_PAGE_SIZE = 50
+PAGINATION_MAX_PAGE_SIZE = 500
+USER_SEARCH_NGRAM_SIZE = 3
+EXPORT_CHUNK_SIZE = 2000
+LOAN_BATCH_MAX_SIZE = 500
+# Loans are due back after the school's LoanPolicy for the book's category, or LOAN_DEFAULT_DAYS without one
+LOAN_DEFAULT_DAYS = 14
+LOAN_POLICY_CACHE_SECONDS = 3600
+OVERDUE_SCAN_BATCH_SIZE = 1000
+OVERDUE_REMINDER_INTERVAL_HOURS = 24
+LIBRARY_STATS_TOP_SIZE = 10
+LIBRARY_STATS_MAX_TOP_SIZE = 100
+LIBRARY_STATS_BATCH_SIZE = 1000
+
+# Transaction logs are buffered in memory and journalled to AUDIT_JOURNAL_DIR until they are flushed in batches
+# Test databases are torn down before a buffer would flush, so tests write through unless they ask for the buffer
+TESTING = sys.argv[1:2] == ["test"]
+AUDIT_BUFFERED = os.environ.get("AUDIT_BUFFERED", str(not TESTING)) == "True"
+AUDIT_BATCH_SIZE = 200
+AUDIT_FLUSH_SECONDS = 2.0
+AUDIT_JOURNAL_DIR = os.environ.get("AUDIT_JOURNAL_DIR", "/var/tmp/school_management_system_audit")
+AUDIT_JOURNAL_FSYNC = os.environ.get("AUDIT_JOURNAL_FSYNC", "False") == "True"
+# Transaction requests and responses are stored as JSON without these keys, compressed above AUDIT_COMPRESS_BYTES
+AUDIT_REDACTED_KEYS = ("password", "new_password", "old_password", "token", "otp")
+AUDIT_COMPRESS_BYTES = 512
+# Months of transactions and notifications kept in the database before archive_audit_logs moves them out
+AUDIT_RETENTION_MONTHS = 3
+AUDIT_PARTITION_MONTHS_AHEAD = 3
+AUDIT_ARCHIVE_CHUNK_SIZE = 5000
+AUDIT_ARCHIVE_DIR = os.environ.get("AUDIT_ARCHIVE_DIR", "/var/tmp/school_management_system_archive")
+
+QUERY_METRICS_ENABLED = os.environ.get("QUERY_METRICS_ENABLED", "True") == "True"
+QUERY_METRICS_ALLOWED_IPS = os.environ.get("QUERY_METRICS_ALLOWED_IPS", "127.0.0.1").split(",")
+# Reverse proxies whose X-Forwarded-For is believed when checking QUERY_METRICS_ALLOWED_IPS
+QUERY_METRICS_TRUSTED_PROXIES = [
+    ip.strip() for ip in os.environ.get("QUERY_METRICS_TRUSTED_PROXIES", "").split(",") if ip.strip()]
+QUERY_SLOW_SECONDS = float(os.environ["QUERY_SLOW_SECONDS"]) if os.environ.get("QUERY_SLOW_SECONDS") else None
+# Keeps the shape of every query a view runs so check_hot_query_indexes also checks them, as benchmark_endpoints does
+QUERY_SHAPES_RECORDED = os.environ.get("QUERY_SHAPES_RECORDED", "False") == "True"
+# Most queries a view may run per request, held in tests with assert_within_query_budget
+QUERY_BUDGETS = {
+    "identities:login": 10,
+    "base:get-schools": 2,
+    "books:filter-books": 4,
+    "books:search-books": 8,
+    "books:issue-book": 12,
+    "books:return-book": 10,
+    "books:issue-books": 12,
+    "books:return-books": 10,
+    "books:library-stats": 6,
+    "users:filter-users": 4,
+    "users:search-users": 4,
+    "users:create-student": 12,
+}
 OTP_VALID_SECONDS = 86400
+ROLE_CACHE_TIMEOUT_SECONDS = 3600
+# How often a worker checks the shared cache for bumped registry and role cache versions
+CACHE_VERSION_CHECK_SECONDS = 5
 
 # AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 # AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
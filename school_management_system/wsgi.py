@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'school_management_system.settings')
 
 application = get_wsgi_application()
+
+# Warm the lookup registries once per worker so the first requests do not pay for them
+from base.models import state_registry, transaction_type_registry, notification_type_registry  # noqa: E402
+
+state_registry.warm()
+transaction_type_registry.warm()
+notification_type_registry.warm()
@@ -0,0 +1,207 @@
+import csv
+import io
+import logging
+
+from django.conf import settings
+from django.db import transaction as trx, IntegrityError
+
+from base.backend.services import ClassroomService
+from base.models import State
+from users.backend.password_hasher import password_hasher
+from users.backend.search import user_search
+from users.backend.services import UserService
+from users.models import Role, User
+from utils.common import generate_password, create_notification_detail
+from utils.transaction_log_base import TransactionLogBase
+
+lgr = logging.getLogger(__name__)
+
+
+class UserImporter(TransactionLogBase):
+    """
+    Creates users in bulk from CSV or JSON rows.
+    Every row is validated up front with a handful of set based queries, passwords are hashed in a process pool and
+    the valid rows are inserted with bulk_create in chunks of BULK_IMPORT_CHUNK_SIZE. Each chunk is logged as one
+    Transaction and its welcome notifications are queued in one insert. Invalid rows are reported and skipped.
+    """
+    ROLES = {"Clerk": Role.clerk, "Teacher": Role.teacher, "Student": Role.student}
+    FIELDS = (
+        "username", "email", "phone_number", "other_phone_number", "first_name", "last_name", "other_name", "gender",
+        "id_no", "reg_no")
+    GENDERS = [gender for gender, label in User.GENDER]
+
+    def __init__(self, school, chunk_size=None, source_ip=None):
+        self.school = school
+        self.chunk_size = chunk_size or settings.BULK_IMPORT_CHUNK_SIZE
+        self.source_ip = source_ip
+
+    @staticmethod
+    def parse_csv(content):
+        """
+        Reads user rows from CSV content with a header line.
+        @param content: The CSV text or bytes.
+        @type content: str | bytes
+        @return: The rows as dicts keyed by the header names.
+        @rtype: list
+        """
+        if isinstance(content, bytes):
+            content = content.decode("utf-8-sig")
+        return [dict(row) for row in csv.DictReader(io.StringIO(content))]
+
+    def run(self, rows):
+        """
+        Validates and creates the given users.
+        @param rows: The user rows, each a dict with the user fields plus role_name and classroom_id.
+        @type rows: list
+        @return: The number of users created and the errors per row (1-based row numbers).
+        @rtype: dict
+        """
+        errors = []
+        users = self.validate(rows, errors)
+        passwords = [generate_password() for _ in users]
+        hashes = password_hasher.hash_many(passwords)
+        created = 0
+        for start in range(0, len(users), self.chunk_size):
+            chunk = users[start:start + self.chunk_size]
+            for (row_number, user), password_hash in zip(chunk, hashes[start:start + self.chunk_size]):
+                user.password = password_hash
+            created += self._create_chunk(chunk, passwords[start:start + self.chunk_size], errors)
+        errors.sort(key=lambda error: error["row"])
+        return {"created": created, "failed": len(errors), "errors": errors}
+
+    def validate(self, rows, errors):
+        """
+        Builds unsaved users for the valid rows, appending a {"row", "error"} entry to errors for every invalid row.
+        @return: (row number, User) pairs for the valid rows.
+        @rtype: list
+        """
+        numbered_rows = []
+        for row_number, row in enumerate(rows, start=1):
+            if isinstance(row, dict):
+                numbered_rows.append((row_number, row))
+            else:
+                errors.append({"row": row_number, "error": "Row must be an object of user fields"})
+        rows = [row for row_number, row in numbered_rows]
+        classroom_ids = {str(row.get("classroom_id") or "").strip() for row in rows} - {""}
+        classrooms = {}
+        if classroom_ids:
+            classrooms = {str(classroom.id): classroom for classroom in ClassroomService().filter(
+                id__in=classroom_ids, school=self.school, state=State.active())}
+        usernames = [self._username(row) for row in rows]
+        id_nos = [str(row.get("id_no") or "").strip() for row in rows]
+        taken_usernames = self._existing("username", usernames)
+        taken_id_nos = self._existing("id_no", id_nos)
+        roles = {name: role() for name, role in self.ROLES.items()}
+        seen_usernames = set()
+        seen_id_nos = set()
+        users = []
+        active = State.active()
+        for (row_number, row), username, id_no in zip(numbered_rows, usernames, id_nos):
+            try:
+                data = {field: str(row.get(field) or "").strip() for field in self.FIELDS}
+                for field, label in (("email", "Email address"), ("phone_number", "Phone number"),
+                                     ("first_name", "First name"), ("last_name", "Last name")):
+                    if not data[field]:
+                        raise Exception("%s not provided" % label)
+                role_name = str(row.get("role_name") or "").strip().title()
+                role = roles.get(role_name)
+                if not role:
+                    raise Exception("Role must be one of %s" % ", ".join(self.ROLES))
+                classroom_id = str(row.get("classroom_id") or "").strip()
+                classroom = None
+                if role_name == "Student":
+                    if not classroom_id:
+                        raise Exception("Classroom id not provided")
+                    classroom = classrooms.get(classroom_id)
+                    if not classroom:
+                        raise Exception("Classroom not found")
+                elif classroom_id:
+                    raise Exception("Only a student can be assigned to a classroom")
+                if username in taken_usernames or username in seen_usernames:
+                    raise Exception("Username %s already exists" % username)
+                if id_no and (id_no in taken_id_nos or id_no in seen_id_nos):
+                    raise Exception("ID number %s already exists" % id_no)
+                data["username"] = username
+                data["gender"] = data["gender"].lower() if data["gender"].lower() in self.GENDERS \
+                    else User.DEFAULT_GENDER
+                for field in ("other_phone_number", "other_name", "id_no", "reg_no"):
+                    data[field] = data[field] or None
+                seen_usernames.add(username)
+                if id_no:
+                    seen_id_nos.add(id_no)
+                users.append((row_number, User(
+                    school=self.school, classroom=classroom, role=role, state=active, is_superuser=False,
+                    is_staff=False, search_document=User.make_search_document(**data), **data)))
+            except Exception as e:
+                errors.append({"row": row_number, "error": str(e)})
+        return users
+
+    @staticmethod
+    def _username(row):
+        return str(row.get("username") or row.get("email") or "").strip().lower()
+
+    @staticmethod
+    def _existing(field, values):
+        values = list({value for value in values if value})
+        existing = set()
+        for start in range(0, len(values), 500):
+            existing.update(UserService().filter(**{"%s__in" % field: values[start:start + 500]}).values_list(
+                field, flat=True))
+        return existing
+
+    def _create_chunk(self, chunk, passwords, errors):
+        transaction = None
+        try:
+            first_row, last_row = chunk[0][0], chunk[-1][0]
+            transaction = self.log_transaction(
+                transaction_type="BulkCreateUsers", source_ip=self.source_ip,
+                reference="%s:%s-%s" % (self.school.code, first_row, last_row))
+            if not transaction:
+                raise Exception("Transaction log not created")
+            with trx.atomic():
+                created = self._insert(chunk, errors)
+                notification_details = []
+                for (row_number, user), password in zip(chunk, passwords):
+                    if user.pk in created:
+                        notification_msg = "Welcome, use your username - %s  and password - %s to login" % (
+                            user.username, password)
+                        notification_details += create_notification_detail(
+                            message_code="SC0009", message_type="2", message=notification_msg,
+                            destination=user.email)
+                response = {"code": "100.000.000", "message": "Users created successfully", "created": len(created)}
+                self.complete_transaction(
+                    transaction, response=response, notification_details=notification_details)
+                # bulk_create skips the post_save signals that keep the search index current
+                trx.on_commit(lambda: user_search.invalidate(self.school.id))
+            return len(created)
+        except Exception as e:
+            lgr.exception("Bulk create users exception: %s" % e)
+            for row_number, user in chunk:
+                if not any(error["row"] == row_number for error in errors):
+                    errors.append({"row": row_number, "error": str(e)})
+            response = {"code": "999.999.999", "message": "Bulk create users failed with an exception", "error": str(e)}
+            self.mark_transaction_failed(transaction, response=response)
+            return 0
+
+    @staticmethod
+    def _insert(chunk, errors):
+        """
+        Inserts a chunk with one bulk_create, falling back to row by row inserts when the chunk hits a constraint
+        (e.g. a username taken since validation) so the failing rows can be reported.
+        @return: The primary keys of the users inserted.
+        @rtype: set
+        """
+        try:
+            with trx.atomic():
+                User.objects.bulk_create([user for row_number, user in chunk])
+            return {user.pk for row_number, user in chunk}
+        except IntegrityError:
+            created = set()
+            for row_number, user in chunk:
+                try:
+                    with trx.atomic():
+                        User.objects.bulk_create([user])
+                    created.add(user.pk)
+                except IntegrityError as e:
+                    errors.append({"row": row_number, "error": str(e)})
+            return created
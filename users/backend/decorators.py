@@ -4,32 +4,39 @@ from functools import wraps
 
 from django.core.handlers.wsgi import WSGIRequest
 from django.http import JsonResponse
-from django.utils import timezone
 
 from base.models import State
-from identities.backend.services import IdentityService
-from users.backend.services import UserService, RoleService
+from identities.backend.identity_cache import identity_cache
 from users.models import Role
 from utils.get_request_data import get_request_data
 
 lgr = logging.getLogger(__name__)
 
 
+def get_user_identity(request):
+    """
+    Fetches the caller attached by the TokenAuthenticationMiddleware, authenticating the token here if the
+    middleware did not run for the request.
+    @param request: The Django HttpRequest.
+    @type request: WSGIRequest
+    @return: The authenticated identity or None.
+    @rtype: UserIdentity | None
+    """
+    if not hasattr(request, "user_identity"):
+        request.user_identity = identity_cache.authenticate(get_request_data(request).get("token", ""))
+    return request.user_identity
+
+
 def user_login_required(inner_function):
     @wraps(inner_function)
     def _wrapped_function(*args, **kwargs):
         try:
             for k in args:
                 if isinstance(k, WSGIRequest):
-                    data = get_request_data(k)
-                    token = data.get("token", "")
-                    if not token:
-                        return JsonResponse({"code": "888.888.001", "message": "Access token not provided"})
-                    oauth = IdentityService().filter(
-                        token=token, expires_at__gt=timezone.now(), state=State.active()).first()
-                    if not oauth:
+                    if not get_user_identity(k):
+                        if not get_request_data(k).get("token", ""):
+                            return JsonResponse({"code": "888.888.001", "message": "Access token not provided"})
                         return JsonResponse({"code": "888.888.002", "message": "Not authenticated"})
-                    oauth.extend()
                     return inner_function(*args, **kwargs)
         except Exception as e:
             lgr.exception("user_login_required decorator exception - %s" % str(e))
@@ -42,10 +49,9 @@ def super_admin(inner_function):
         try:
             for k in args:
                 if isinstance(k, WSGIRequest):
-                    data = get_request_data(k)
-                    user_id = data.get("user_id", "")
-                    user = UserService().get(id=user_id, state=State.active())
-                    if user and user.role == Role.super_admin():
+                    user_identity = get_user_identity(k)
+                    if user_identity and user_identity.user_state_id == State.active().id and \
+                            user_identity.role_id == Role.super_admin().id:
                         return inner_function(*args, **kwargs)
                     return JsonResponse({"code": "888.888.001", "message": "Not authorized"})
         except Exception as e:
@@ -59,10 +65,9 @@ def admin(inner_function):
         try:
             for k in args:
                 if isinstance(k, WSGIRequest):
-                    data = get_request_data(k)
-                    user_id = data.get("user_id", "")
-                    user = UserService().get(id=user_id, state=State.active())
-                    if user and user.role in [Role.super_admin(), Role.admin()]:
+                    user_identity = get_user_identity(k)
+                    if user_identity and user_identity.user_state_id == State.active().id and \
+                            user_identity.role_id in [Role.super_admin().id, Role.admin().id]:
                         return inner_function(*args, **kwargs)
                     return JsonResponse({"code": "888.888.001", "message": "Not authorized"})
         except Exception as e:
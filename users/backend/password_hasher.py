@@ -0,0 +1,87 @@
+import atexit
+import logging
+import math
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+
+lgr = logging.getLogger(__name__)
+
+
+def start_worker():
+    """
+    Sets Django up in a new pool worker. A forked worker inherits the parent's setup, but one started with spawn or
+    forkserver is a fresh interpreter that has to load the settings and apps before make_password can run.
+    """
+    import django
+    django.setup()
+
+
+class ParallelPasswordHasher(object):
+    """
+    Hashes passwords with the configured Django hasher across a pool of worker processes.
+    Password hashing is CPU bound and deliberately slow, so bulk jobs fan the work out to one process per core
+    (PASSWORD_HASH_WORKERS) instead of hashing one password after another in the calling thread.
+    The pool is started on first use and kept for the life of the process, so its workers are started once rather
+    than for every import. They are started with PASSWORD_HASH_START_METHOD, the platform default when unset.
+    """
+
+    def __init__(self, workers=None, start_method=None):
+        self.workers = workers or settings.PASSWORD_HASH_WORKERS
+        self.start_method = start_method or settings.PASSWORD_HASH_START_METHOD
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, initializer=start_worker,
+                    mp_context=multiprocessing.get_context(self.start_method) if self.start_method else None)
+                atexit.register(self.shutdown)
+            return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def hash(self, password):
+        """
+        Hashes a single password in the calling process.
+        @param password: The raw password.
+        @type password: str
+        @return: The encoded password hash.
+        @rtype: str
+        """
+        return make_password(password)
+
+    def hash_many(self, passwords):
+        """
+        Hashes a list of passwords in parallel.
+        @param passwords: The raw passwords.
+        @type passwords: list
+        @return: The encoded password hashes, in the same order as the passwords.
+        @rtype: list
+        """
+        passwords = list(passwords)
+        workers = min(self.workers, len(passwords))
+        if workers < 2:
+            return [self.hash(password) for password in passwords]
+        # A few chunks per worker keeps the processes evenly loaded without a round trip per password
+        chunksize = max(1, math.ceil(len(passwords) / (workers * 4)))
+        try:
+            return list(self.executor().map(make_password, passwords, chunksize=chunksize))
+        except BrokenProcessPool as e:
+            # A worker died, e.g. killed for memory; start a new pool next time and finish this batch here
+            lgr.warning("ParallelPasswordHasher pool broken, hashing in process: %s" % e)
+            self.shutdown()
+            return [self.hash(password) for password in passwords]
+
+
+password_hasher = ParallelPasswordHasher()
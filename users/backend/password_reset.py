@@ -0,0 +1,79 @@
+import logging
+
+from django.conf import settings
+from django.db import transaction as trx
+
+from base.models import State
+from identities.backend.identity_cache import identity_cache
+from identities.backend.services import IdentityService
+from users.backend.password_hasher import password_hasher
+from users.models import User
+from utils.common import generate_password, create_notification_detail
+from utils.transaction_log_base import TransactionLogBase
+
+lgr = logging.getLogger(__name__)
+
+
+class PasswordResetter(TransactionLogBase):
+    """
+    Resets the passwords of many users at once, e.g. a whole school at the start of a term.
+    New passwords are hashed in parallel and written with bulk_update in chunks of PASSWORD_RESET_CHUNK_SIZE. Each
+    chunk is logged as one Transaction, its users' active tokens are revoked and the new passwords are queued as
+    notifications in one insert.
+    """
+
+    def __init__(self, chunk_size=None, source_ip=None):
+        self.chunk_size = chunk_size or settings.PASSWORD_RESET_CHUNK_SIZE
+        self.source_ip = source_ip
+
+    def run(self, users):
+        """
+        Resets the passwords of the given users.
+        @param users: The users whose passwords we are resetting.
+        @type users: QuerySet | list
+        @return: The number of passwords reset and the ids of the users whose reset failed.
+        @rtype: dict
+        """
+        users = list(users)
+        passwords = [generate_password() for _ in users]
+        hashes = password_hasher.hash_many(passwords)
+        reset = 0
+        failed = []
+        for start in range(0, len(users), self.chunk_size):
+            chunk = users[start:start + self.chunk_size]
+            for user, password_hash in zip(chunk, hashes[start:start + self.chunk_size]):
+                user.password = password_hash
+            if self._reset_chunk(chunk, passwords[start:start + self.chunk_size]):
+                reset += len(chunk)
+            else:
+                failed += [str(user.id) for user in chunk]
+        return {"reset": reset, "failed": failed}
+
+    def _reset_chunk(self, chunk, passwords):
+        transaction = None
+        try:
+            transaction = self.log_transaction(
+                transaction_type="BulkResetPasswords", source_ip=self.source_ip,
+                reference="%s-%s" % (chunk[0].id, chunk[-1].id))
+            if not transaction:
+                raise Exception("Transaction log not created")
+            with trx.atomic():
+                User.objects.bulk_update(chunk, ["password"])
+                identities = IdentityService().filter(user__in=chunk, state=State.active())
+                tokens = list(identities.values_list("token", flat=True))
+                identities.update(state=State.expired())
+                trx.on_commit(lambda: identity_cache.discard(*tokens))
+                notification_details = []
+                for user, password in zip(chunk, passwords):
+                    notification_msg = "Your password has been reset, use your username - %s  and password - %s " \
+                                       "to login" % (user.username, password)
+                    notification_details += create_notification_detail(
+                        message_code="SC0009", message_type="2", message=notification_msg, destination=user.email)
+                response = {"code": "100.000.000", "message": "Passwords reset successfully", "reset": len(chunk)}
+                self.complete_transaction(transaction, response=response, notification_details=notification_details)
+            return True
+        except Exception as e:
+            lgr.exception("Bulk reset passwords exception: %s" % e)
+            response = {"code": "999.999.999", "message": "Bulk reset passwords failed with an exception", "error": e}
+            self.mark_transaction_failed(transaction, response=response)
+            return False
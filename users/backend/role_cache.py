@@ -0,0 +1,131 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, connection
+
+from base.models import State
+from users.models import Role, RolePermission, ExtendedPermission
+from utils.shared_version import SharedVersion
+
+lgr = logging.getLogger(__name__)
+
+
+class RoleCache(object):
+    """
+    Versioned snapshot of the active roles and each role's permission set.
+    The snapshot lives in the Django cache so every worker shares it; each worker also keeps the last snapshot it read
+    and only goes back to the cache backend when the shared version number moves. The version itself is reread from
+    the backend at most every CACHE_VERSION_CHECK_SECONDS, so a role or permission lookup does no cache I/O.
+    """
+    EXTENDED_CACHE_SIZE = 10000
+
+    def __init__(self):
+        self._version = SharedVersion("users:role_cache:version")
+        self._snapshot = None
+        self._extended = {}
+        self._lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        return getattr(settings, "ROLE_CACHE_TIMEOUT_SECONDS", 3600)
+
+    def version(self):
+        """
+        Fetches the current snapshot version. Workers only read it from the cache backend every
+        CACHE_VERSION_CHECK_SECONDS, so a lookup normally stays in memory.
+        @return: The current version.
+        @rtype: int
+        """
+        return self._version.get()
+
+    def bump(self):
+        """
+        Moves every worker on to a new snapshot.
+        """
+        self._version.bump()
+
+    def snapshot(self):
+        """
+        Fetches the roles and role permissions snapshot for the current version.
+        @return: A dict holding the version, the roles by name and the permission names by role id.
+        @rtype: dict
+        """
+        version = self.version()
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot["version"] == version:
+            return snapshot
+        key = "users:role_cache:snapshot:%s" % version
+        snapshot = cache.get(key)
+        if snapshot is None:
+            snapshot = self._build(version)
+            if connection.in_atomic_block:
+                # It could hold roles the block wrote and later rolls back, so it is only shared once built outside one
+                return snapshot
+            cache.set(key, snapshot, timeout=self.timeout)
+        with self._lock:
+            self._snapshot = snapshot
+            self._extended = {}
+        return snapshot
+
+    def role(self, name):
+        """
+        Fetches the active role with the given name, creating it if it does not exist.
+        @param name: The name of the role.
+        @type name: str
+        @return: The role, or None before the table exists.
+        @rtype: Role | None
+        """
+        try:
+            role = self.snapshot()["roles"].get(name)
+        except DatabaseError:
+            # Field defaults are evaluated by checks and migrate before migrate has created the table
+            if Role._meta.db_table not in connection.introspection.table_names():
+                return None
+            raise
+        if role is None:
+            role, created = Role.objects.get_or_create(name=name, state=State.active())
+        return role
+
+    def permissions(self, user):
+        """
+        Fetches the permission names granted to a user through their role and their extended permissions.
+        @param user: The user whose permissions we are resolving.
+        @type user: User
+        @return: The permission names.
+        @rtype: frozenset
+        """
+        snapshot = self.snapshot()
+        role_permissions = snapshot["permissions"].get(user.role_id, frozenset())
+        # Kept in this worker under the shared version, which every ExtendedPermission change bumps, so a copy read
+        # before another worker's bump is never used after it
+        local_key = (snapshot["version"], user.id)
+        extended_permissions = self._extended.get(local_key)
+        if extended_permissions is None:
+            key = "users:role_cache:extended:%s:%s" % local_key
+            extended_permissions = cache.get(key)
+            if extended_permissions is None:
+                extended_permissions = frozenset(ExtendedPermission.objects.filter(user_id=user.id).values_list(
+                    "permission__name", flat=True))
+                if connection.in_atomic_block:
+                    # As with the snapshot, what a block read is only shared once read outside one
+                    return role_permissions | extended_permissions
+                cache.set(key, extended_permissions, timeout=self.timeout)
+            with self._lock:
+                if len(self._extended) >= self.EXTENDED_CACHE_SIZE:
+                    self._extended = {}
+                self._extended[local_key] = extended_permissions
+        return role_permissions | extended_permissions
+
+    @staticmethod
+    def _build(version):
+        roles = {role.name: role for role in Role.objects.filter(state=State.active())}
+        permissions = {}
+        for role_id, permission_name in RolePermission.objects.values_list("role_id", "permission__name"):
+            permissions.setdefault(role_id, set()).add(permission_name)
+        permissions = {role_id: frozenset(names) for role_id, names in permissions.items()}
+        return {"version": version, "roles": roles, "permissions": permissions}
+
+
+role_cache = RoleCache()
@@ -0,0 +1,90 @@
+import logging
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Q
+
+from users.backend.services import UserService
+from utils.pagination import KeysetPaginator, page_number
+from utils.search_index import NgramIndex, SchoolSearchIndexes
+
+lgr = logging.getLogger(__name__)
+
+
+class UserSearch(object):
+    """
+    Ranked user search within a school over User.search_document (names, username, email, phone numbers, id_no and
+    reg_no).
+    On PostgreSQL the document has a pg_trgm GIN index, so every term is an index assisted LIKE and the matches are
+    ranked by trigram word similarity. Other databases fall back to an in-memory n-gram index per school, rebuilt when
+    the school's users change.
+    """
+    FIELDS = (
+        "id", "username", "email", "phone_number", "other_phone_number", "first_name", "last_name", "other_name",
+        "gender", "id_no", "reg_no", "school_id", "classroom_id", "role_name", "state_name")
+
+    def __init__(self):
+        self.indexes = SchoolSearchIndexes("users:search", self.build_index)
+
+    def invalidate(self, school_id):
+        """
+        Marks the school's search documents as changed so every worker rebuilds its index on the next search.
+        @param school_id: The school whose users changed.
+        """
+        self.indexes.invalidate(school_id)
+
+    def search(self, school, query, page=None, page_size=None):
+        """
+        Searches a school's users, best matches first.
+        @param school: The school whose users we are searching.
+        @type school: School
+        @param query: The search text. Every word of it must match.
+        @type query: str
+        @param page: The 1-based page number.
+        @type page: int | str | None
+        @param page_size: The number of users per page.
+        @type page_size: int | str | None
+        @return: The users of the page and the number of the next page, None on the last page.
+        @rtype: dict
+        """
+        terms = str(query or "").lower().split()
+        if not terms:
+            raise Exception("Search word not provided")
+        page_size = KeysetPaginator.page_size(page_size)
+        page = page_number(page)
+        offset = (page - 1) * page_size
+        if connection.vendor == "postgresql":
+            rows = self._search_postgresql(school, terms, offset, page_size + 1)
+        else:
+            rows = self._search_index(school, terms, offset, page_size + 1)
+        next_page = page + 1 if len(rows) > page_size else None
+        return {"data": rows[:page_size], "next_page": next_page}
+
+    def _values(self, queryset):
+        return queryset.annotate(role_name=F("role__name"), state_name=F("state__name")).values(*self.FIELDS)
+
+    def _search_postgresql(self, school, terms, offset, limit):
+        from django.contrib.postgres.search import TrigramWordSimilarity
+        condition = Q()
+        for term in terms:
+            condition &= Q(search_document__contains=term)
+        queryset = UserService().filter(condition, school=school).annotate(
+            rank=TrigramWordSimilarity(" ".join(terms), "search_document")).order_by("-rank", "-date_created", "-id")
+        return list(self._values(queryset)[offset:offset + limit])
+
+    def _search_index(self, school, terms, offset, limit):
+        results = self.indexes.get(school.id).search(" ".join(terms))[offset:offset + limit]
+        ids = [user_id for user_id, score in results]
+        rows = {row["id"]: row for row in self._values(UserService().filter(id__in=ids, school=school))}
+        return [rows[user_id] for user_id in ids if user_id in rows]
+
+    @staticmethod
+    def build_index(school_id):
+        index = NgramIndex(n=settings.USER_SEARCH_NGRAM_SIZE)
+        documents = UserService().filter(school_id=school_id).values_list("id", "search_document")
+        for user_id, document in documents.iterator(chunk_size=2000):
+            index.add(user_id, document)
+        return index
+
+
+user_search = UserSearch()
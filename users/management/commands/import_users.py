@@ -0,0 +1,30 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from base.backend.services import SchoolService
+from base.models import State
+from users.backend.bulk_import import UserImporter
+
+
+class Command(BaseCommand):
+    help = "Creates users in bulk from a CSV file (with a header line) or a JSON list of users."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The CSV or JSON file to import.")
+        parser.add_argument("--school-id", required=True, help="The school the users belong to.")
+        parser.add_argument("--format", choices=["csv", "json"], help="Defaults to the file extension.")
+        parser.add_argument("--chunk-size", type=int, help="Users inserted per batch.")
+
+    def handle(self, *args, **options):
+        school = SchoolService().get(id=options["school_id"], state=State.active())
+        if not school:
+            raise CommandError("School not found")
+        file_format = options["format"] or ("json" if options["path"].lower().endswith(".json") else "csv")
+        with open(options["path"], "rb") as f:
+            content = f.read()
+        rows = json.loads(content) if file_format == "json" else UserImporter.parse_csv(content)
+        report = UserImporter(school=school, chunk_size=options["chunk_size"]).run(rows)
+        for error in report["errors"]:
+            self.stderr.write("Row %(row)s: %(error)s" % error)
+        self.stdout.write("Created %(created)s users, %(failed)s rows failed" % report)
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from base.backend.services import SchoolService
+from base.models import State
+from users.backend.password_reset import PasswordResetter
+from users.backend.services import UserService
+
+
+class Command(BaseCommand):
+    help = "Resets the passwords of the active users of a school and sends each user their new password."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--school-id", required=True, help="The school whose users we are resetting.")
+        parser.add_argument("--role", action="append", dest="roles", help="Only reset users with this role name.")
+        parser.add_argument("--classroom-id", help="Only reset users in this classroom.")
+        parser.add_argument("--chunk-size", type=int, help="Users updated per batch.")
+
+    def handle(self, *args, **options):
+        school = SchoolService().get(id=options["school_id"], state=State.active())
+        if not school:
+            raise CommandError("School not found")
+        users = UserService().filter(school=school, state=State.active()).order_by("date_created", "id")
+        if options["roles"]:
+            users = users.filter(role__name__in=options["roles"])
+        if options["classroom_id"]:
+            users = users.filter(classroom_id=options["classroom_id"])
+        report = PasswordResetter(chunk_size=options["chunk_size"]).run(users)
+        for user_id in report["failed"]:
+            self.stderr.write("User %s: password not reset" % user_id)
+        self.stdout.write("Reset %s passwords, %s failed" % (report["reset"], len(report["failed"])))
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.4 on 2026-10-18 17:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('base', '0002_notification_outbox'),
+        ('users', '0005_alter_user_role'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['school', '-date_created', '-id'], name='user_school_created_idx'),
+        ),
+    ]
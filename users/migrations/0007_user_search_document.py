@@ -0,0 +1,54 @@
+# Generated by Django 5.0.4 on 2026-10-18 17:38
+
+from django.db import migrations, models
+
+SEARCH_FIELDS = (
+    'first_name', 'last_name', 'other_name', 'username', 'email', 'phone_number', 'other_phone_number', 'id_no',
+    'reg_no')
+
+
+def backfill_search_document(apps, schema_editor):
+    User = apps.get_model('users', 'User')
+    batch = []
+    for user in User.objects.only('id', *SEARCH_FIELDS).iterator(chunk_size=2000):
+        user.search_document = ' '.join(
+            str(getattr(user, field)).strip().lower() for field in SEARCH_FIELDS
+            if str(getattr(user, field) or '').strip())
+        batch.append(user)
+        if len(batch) >= 2000:
+            User.objects.bulk_update(batch, ['search_document'])
+            batch = []
+    if batch:
+        User.objects.bulk_update(batch, ['search_document'])
+
+
+def create_trigram_index(apps, schema_editor):
+    # The trigram index is PostgreSQL only; other databases search through the in-memory n-gram index
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS user_search_document_trgm_idx ON users_user USING gin (search_document gin_trgm_ops)')
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS user_search_document_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_user_school_created_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='search_document',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_search_document, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.4 on 2026-10-18 17:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('base', '0003_hot_query_indexes'),
+        ('users', '0007_user_search_document'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='role',
+            index=models.Index(fields=['name', 'state'], name='role_name_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['classroom', 'state'], name='user_classroom_state_idx'),
+        ),
+    ]
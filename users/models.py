@@ -3,7 +3,6 @@ import logging
 from django.core.exceptions import ValidationError
 from django.db import models
 from django.contrib.auth.models import AbstractUser, UserManager
-from django.db.models import F
 
 from base.models import GenericBaseModel, State, BaseModel, School, Classroom
 
@@ -13,16 +12,21 @@ lgr.propagate = False
 class Role(GenericBaseModel):
     state = models.ForeignKey(State, default=State.active, on_delete=models.CASCADE)
 
+    HOT_QUERIES = (('name', 'state'),)
+
     def __str__(self):
         return self.name
 
     class Meta:
         ordering = ('-date_created',)
+        indexes = [
+            models.Index(fields=['name', 'state'], name='role_name_state_idx'),
+        ]
 
     @classmethod
     def super_admin(cls):
         try:
-            role, created = cls.objects.get_or_create(name="SuperAdmin", state=State.active())
+            role = role_cache.role("SuperAdmin")
             return role
         except Exception as e:
             lgr.exception("Role model - super_admin exception: %s" % e)
@@ -31,7 +35,7 @@ class Role(GenericBaseModel):
     @classmethod
     def admin(cls):
         try:
-            role, created = cls.objects.get_or_create(name="Admin", state=State.active())
+            role = role_cache.role("Admin")
             return role
         except Exception as e:
             lgr.exception("Role model - admin exception: %s" % e)
@@ -40,7 +44,7 @@ class Role(GenericBaseModel):
     @classmethod
     def clerk(cls):
         try:
-            role, created = cls.objects.get_or_create(name="Clerk", state=State.active())
+            role = role_cache.role("Clerk")
             return role
         except Exception as e:
             lgr.exception("Role model - clerk exception: %s" % e)
@@ -49,7 +53,7 @@ class Role(GenericBaseModel):
     @classmethod
     def student(cls):
         try:
-            role, created = cls.objects.get_or_create(name="Student", state=State.active())
+            role = role_cache.role("Student")
             return role
         except Exception as e:
             lgr.exception("Role model - student exception: %s" % e)
@@ -58,7 +62,7 @@ class Role(GenericBaseModel):
     @classmethod
     def teacher(cls):
         try:
-            role, created = cls.objects.get_or_create(name="Teacher", state=State.active())
+            role = role_cache.role("Teacher")
             return role
         except Exception as e:
             lgr.exception("Role model - teacher exception: %s" % e)
@@ -93,6 +97,9 @@ class User(BaseModel, AbstractUser):
         ('other', 'Other'),
     ]
     DEFAULT_GENDER = "other"
+    SEARCH_FIELDS = (
+        "first_name", "last_name", "other_name", "username", "email", "phone_number", "other_phone_number", "id_no",
+        "reg_no")
 
     other_name = models.CharField(max_length=100, blank=True, null=True)
     gender = models.CharField(max_length=100, default=DEFAULT_GENDER, choices=GENDER)
@@ -104,34 +111,56 @@ class User(BaseModel, AbstractUser):
     classroom = models.ForeignKey(Classroom, null=True, blank=True, on_delete=models.CASCADE)
     role = models.ForeignKey(Role, default=Role.super_admin, on_delete=models.CASCADE)
     state = models.ForeignKey(State, default=State.active, on_delete=models.CASCADE)
+    search_document = models.TextField(null=True, blank=True, editable=False)
 
     objects = UserManager()
 
+    HOT_QUERIES = (('school', '-date_created', '-id'), ('classroom', 'state'), ('username',), ('id_no',))
+
     def __str__(self):
         return "%s %s" % (self.first_name, self.last_name)
 
     class Meta:
         ordering = ('-date_created',)
+        indexes = [
+            models.Index(fields=['school', '-date_created', '-id'], name='user_school_created_idx'),
+            models.Index(fields=['classroom', 'state'], name='user_classroom_state_idx'),
+        ]
 
     @property
     def permissions(self):
         try:
-            permissions_list = RolePermission.objects.filter(role=self.role) \
-                .annotate(permission_name=F("permission__name")).values_list("permission_name", flat=True)
-            return list(permissions_list)
+            return sorted(role_cache.permissions(self))
         except Exception as e:
             lgr.exception("User model - permissions exception: %s" % e)
             return []
 
+    @classmethod
+    def make_search_document(cls, **values):
+        """
+        Builds the text search_users matches against from the user's searchable fields.
+        @param values: The values of the fields in SEARCH_FIELDS.
+        @return: The lower cased values joined by spaces.
+        @rtype: str
+        """
+        return " ".join(
+            str(values[field]).strip().lower() for field in cls.SEARCH_FIELDS if str(values.get(field) or "").strip())
+
     def save(self, *args, **kwargs):
-        if not self.role:
+        if not self.role_id:
             raise ValidationError("A user must have a role")
-        if self.state == State.active() and self.role == Role.student() and not self.classroom:
+        is_student = self.role_id == Role.student().id
+        if self.state_id == State.active().id and is_student and not self.classroom_id:
             raise ValidationError("A student must be assigned to a classroom")
-        if self.role != Role.student() and self.classroom:
+        if not is_student and self.classroom_id:
             raise ValidationError("Only a student can be assigned to a classroom")
-        if self.state == State.inactive() and self.classroom:
+        if self.state_id == State.inactive().id and self.classroom_id:
             raise ValidationError("An inactive student cannot be assigned to a classroom")
+        self.search_document = self.make_search_document(
+            **{field: getattr(self, field) for field in self.SEARCH_FIELDS})
+        update_fields = kwargs.get("update_fields", None)
+        if update_fields is not None and set(update_fields) & set(self.SEARCH_FIELDS):
+            kwargs["update_fields"] = set(update_fields) | {"search_document"}
         super(User, self).save(*args, **kwargs)
 
 class ExtendedPermission(BaseModel):
@@ -143,3 +172,6 @@ class ExtendedPermission(BaseModel):
 
     class Meta:
         ordering = ('-date_created',)
+
+
+from users.backend.role_cache import role_cache  # noqa: E402
@@ -0,0 +1,53 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from identities.backend.identity_cache import identity_cache
+from users.backend.role_cache import role_cache
+from users.backend.search import user_search
+from users.models import Role, Permission, RolePermission, ExtendedPermission, User
+
+
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+@receiver(post_save, sender=RolePermission)
+@receiver(post_delete, sender=RolePermission)
+@receiver(post_save, sender=ExtendedPermission)
+@receiver(post_delete, sender=ExtendedPermission)
+def bump_role_cache(sender, **kwargs):
+    """
+    Moves every worker on to a fresh roles and permissions snapshot once the change is committed.
+    """
+    transaction.on_commit(role_cache.bump)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_search(sender, instance, **kwargs):
+    """
+    Has every worker rebuild the school's user search index once the change is committed.
+    """
+    school_id = instance.school_id
+    transaction.on_commit(lambda: user_search.invalidate(school_id))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def discard_user_identities(sender, instance, **kwargs):
+    """
+    Drops the user's cached identities once the change is committed, since they carry the user's role and state.
+    """
+    user_id = instance.id
+    transaction.on_commit(lambda: identity_cache.discard_users([user_id]))
+
+
+@receiver(post_save, sender=Role)
+def discard_role_identities(sender, instance, **kwargs):
+    """
+    Drops the cached identities of the role's users once the change is committed.
+    """
+    role_id = instance.id
+    transaction.on_commit(lambda: identity_cache.discard_users(
+        User.objects.filter(role_id=role_id).values_list("id", flat=True)))
@@ -1,3 +1,382 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import os
+import tempfile
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.hashers import check_password
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import JsonResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from base.models import State, Transaction
+from identities.backend.identity_cache import identity_cache
+from identities.models import Identity
+from users.backend.bulk_import import UserImporter
+from users.backend.decorators import admin, super_admin, user_login_required
+from users.backend.password_hasher import ParallelPasswordHasher, password_hasher
+from users.backend.password_reset import PasswordResetter
+from users.backend.role_cache import RoleCache, role_cache
+from users.backend.search import user_search
+from users.models import ExtendedPermission, Permission, Role, RolePermission, User
+from utils.search_index import SchoolSearchIndexes
+from utils.testing import SchoolTestCase, SchoolTransactionTestCase
+
+
+class UserSearchTests(SchoolTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.wanjiru = self.make_user("wanjiru", first_name="Wanjiru", last_name="Kamau", reg_no="ADM-1001")
+        self.kamande = self.make_user("kamande", first_name="Kamande", last_name="Otieno", reg_no="ADM-1002")
+
+    def found(self, query):
+        return [row["id"] for row in user_search.search(self.school, query)["data"]]
+
+    def test_every_term_must_match(self):
+        self.assertEqual(self.found("kama"), [self.wanjiru.id, self.kamande.id])
+        self.assertEqual(self.found("kama otieno"), [self.kamande.id])
+        self.assertEqual(self.found("adm-1001"), [self.wanjiru.id])
+        self.assertEqual(self.found("kama mwangi"), [])
+
+    def test_whole_words_rank_first(self):
+        self.assertEqual(self.found("kamande")[0], self.kamande.id)
+        self.assertEqual(self.found("kamau")[0], self.wanjiru.id)
+
+    def test_pages(self):
+        results = user_search.search(self.school, "school.example", page_size=2)
+        self.assertEqual(len(results["data"]), 2)
+        self.assertEqual(results["next_page"], 2)
+        results = user_search.search(self.school, "school.example", page=3, page_size=2)
+        self.assertEqual(len(results["data"]), 1)
+        self.assertIsNone(results["next_page"])
+
+    def test_index_is_built_once(self):
+        self.found("kama")
+        with self.assertNumQueries(1):
+            self.found("kama")
+
+    def test_index_follows_user_changes(self):
+        self.found("kama")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.wanjiru.last_name = "Njoroge"
+            self.wanjiru.save()
+        self.assertEqual(self.found("kama"), [self.kamande.id])
+        self.assertEqual(self.found("njoroge"), [self.wanjiru.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.kamande.delete()
+        self.assertEqual(self.found("kama"), [])
+
+    @override_settings(CACHE_VERSION_CHECK_SECONDS=0)
+    def test_invalidation_reaches_other_workers(self):
+        self.found("kama")
+        # Another worker's indexes, sharing the version through the cache
+        SchoolSearchIndexes(user_search.indexes.name, user_search.build_index).invalidate(self.school.id)
+        with self.assertNumQueries(2):
+            self.found("kama")
+
+    def test_view_reports_errors(self):
+        token = self.login(self.students[0])
+        with self.assertLogs("users.views", "ERROR"):
+            response = self.post("users:search-users", token=token, school_id=str(self.school.id), search_word=" ")
+        self.assertEqual((response["code"], response["error"]), ("999.999.999", "Search word not provided"))
+        response = self.post("users:search-users", token=token, school_id=str(self.school.id), search_word="otieno")
+        self.assertEqual([row["username"] for row in response["data"]], ["kamande"])
+
+
+@override_settings(CACHE_VERSION_CHECK_SECONDS=0)
+class RoleCacheTests(SchoolTransactionTestCase):
+    """
+    Runs outside a test transaction, as the role cache only shares what it reads outside one.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.student = self.students[0]
+        self.borrow = Permission.objects.create(name="borrow_books", state=State.active())
+        self.export = Permission.objects.create(name="export_books", state=State.active())
+        RolePermission.objects.create(role=Role.student(), permission=self.borrow, state=State.active())
+
+    def test_lookups_stay_in_memory(self):
+        self.assertEqual(role_cache.permissions(self.student), {"borrow_books"})
+        with self.assertNumQueries(0):
+            self.assertEqual(role_cache.role("Student"), Role.student())
+            self.assertEqual(role_cache.permissions(self.student), {"borrow_books"})
+
+    def test_changes_reach_other_workers(self):
+        # Another worker's role cache, sharing the snapshot and its version through the cache
+        worker = RoleCache()
+        self.assertEqual(worker.permissions(self.student), {"borrow_books"})
+        ExtendedPermission.objects.create(user=self.student, permission=self.export)
+        self.assertEqual(worker.permissions(self.student), {"borrow_books", "export_books"})
+        RolePermission.objects.filter(permission=self.borrow).delete()
+        self.assertEqual(worker.permissions(self.student), {"export_books"})
+        self.assertEqual(role_cache.permissions(self.student), {"export_books"})
+
+    def test_extended_permissions_are_kept_per_version(self):
+        role_cache.permissions(self.student)
+        version = role_cache.version()
+        self.assertIn((version, self.student.id), role_cache._extended)
+        # Read by a worker just before another worker's bump reached it
+        role_cache._extended[(version, self.student.id)] = frozenset(["stale"])
+        RoleCache().bump()
+        self.assertEqual(role_cache.permissions(self.student), {"borrow_books"})
+
+    def test_nothing_read_in_a_transaction_is_shared(self):
+        class RolledBack(Exception):
+            pass
+
+        try:
+            with transaction.atomic():
+                RolePermission.objects.create(role=Role.student(), permission=self.export, state=State.active())
+                ExtendedPermission.objects.create(user=self.student, permission=self.borrow)
+                role_cache.bump()
+                self.assertEqual(role_cache.permissions(self.student), {"borrow_books", "export_books"})
+                raise RolledBack()
+        except RolledBack:
+            pass
+        version = role_cache.version()
+        self.assertIsNone(cache.get("users:role_cache:snapshot:%s" % version))
+        self.assertIsNone(cache.get("users:role_cache:extended:%s:%s" % (version, self.student.id)))
+        self.assertEqual(role_cache.permissions(self.student), {"borrow_books"})
+
+
+class AccessDecoratorTests(SchoolTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = self.make_user("librarian", role=Role.admin())
+        self.super_admin = self.make_user("principal", role=Role.super_admin())
+
+    @staticmethod
+    def view(*decorators):
+        def allowed(request):
+            return JsonResponse({"code": "100.000.000"})
+        for decorator in reversed(decorators):
+            allowed = decorator(allowed)
+        return lambda **data: json.loads(allowed(RequestFactory().post(
+            "/", data=json.dumps(data), content_type="application/json")).content)["code"]
+
+    def test_login_required(self):
+        view = self.view(user_login_required)
+        self.assertEqual(view(), "888.888.001")
+        self.assertEqual(view(token="b'unknown'"), "888.888.002")
+        self.assertEqual(view(token=self.login(self.students[0])), "100.000.000")
+
+    def test_roles_come_from_the_token_owner(self):
+        admin_view = self.view(user_login_required, admin)
+        super_admin_view = self.view(user_login_required, super_admin)
+        student_token = self.login(self.students[0])
+        # Naming another user in the request does not lend their role
+        self.assertEqual(admin_view(token=student_token, user_id=str(self.admin.id)), "888.888.001")
+        self.assertEqual(admin_view(token=self.login(self.admin)), "100.000.000")
+        self.assertEqual(admin_view(token=self.login(self.super_admin)), "100.000.000")
+        self.assertEqual(
+            super_admin_view(token=self.login(self.admin), user_id=str(self.super_admin.id)), "888.888.001")
+        self.assertEqual(super_admin_view(token=self.login(self.super_admin)), "100.000.000")
+
+    def test_inactive_users_are_refused(self):
+        token = self.login(self.admin)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.admin.state = State.inactive()
+            self.admin.save()
+        self.assertEqual(self.view(user_login_required, admin)(token=token), "888.888.001")
+
+
+def role_label():
+    """
+    Runs in a pool worker, which imports this module and so the models to unpickle it.
+    """
+    return Role._meta.label
+
+
+class PasswordHasherTests(SimpleTestCase):
+
+    def test_workers_set_django_up_when_spawned(self):
+        # Spawned workers do not inherit the parent's setup, as under forkserver too
+        hasher = ParallelPasswordHasher(workers=2, start_method="spawn")
+        self.addCleanup(hasher.shutdown)
+        self.assertEqual(hasher.executor().submit(role_label).result(timeout=60), "users.Role")
+        passwords = ["Kairi-2024", "Mwangi-2024", "Otieno-2024"]
+        hashes = hasher.hash_many(passwords)
+        self.assertEqual(len(hashes), 3)
+        for password, password_hash in zip(passwords, hashes):
+            self.assertTrue(check_password(password, password_hash))
+
+    def test_single_passwords_are_hashed_in_process(self):
+        hasher = ParallelPasswordHasher(workers=4)
+        self.assertTrue(check_password("Kairi-2024", hasher.hash_many(["Kairi-2024"])[0]))
+        self.assertIsNone(hasher._executor)
+
+    @override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+    def test_a_broken_pool_falls_back_to_the_process(self):
+        hasher = ParallelPasswordHasher(workers=2)
+        executor = mock.Mock()
+        executor.map.side_effect = BrokenProcessPool("worker killed")
+        with mock.patch.object(hasher, "executor", return_value=executor), \
+                self.assertLogs("users.backend.password_hasher", "WARNING"):
+            hashes = hasher.hash_many(["Kairi-2024", "Mwangi-2024"])
+        self.assertTrue(check_password("Mwangi-2024", hashes[1]))
+
+
+# Hashed with a fast hasher in the test process, as the pool is covered by PasswordHasherTests
+in_process_hashing = override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+
+
+@in_process_hashing
+@mock.patch.object(password_hasher, "workers", 1)
+class UserImporterTests(SchoolTestCase):
+
+    def row(self, username, role_name="Student", **kwargs):
+        row = {
+            "username": username, "email": "%s@school.example" % username, "phone_number": "0700000000",
+            "first_name": username.title(), "last_name": "Imported", "role_name": role_name,
+            "classroom_id": str(self.classroom.id) if role_name == "Student" else ""}
+        row.update(kwargs)
+        return row
+
+    def test_valid_rows_are_created_and_invalid_ones_reported(self):
+        rows = [
+            self.row("akinyi"), self.row("baraka", role_name="clerk"), self.row("chege", email=""),
+            self.row("student1"), self.row("akinyi"), self.row("dafina", role_name="Principal"),
+            self.row("esther", classroom_id=""), "not a row"]
+        with self.captureOnCommitCallbacks(execute=True):
+            report = UserImporter(self.school, chunk_size=2).run(rows)
+        self.assertEqual((report["created"], report["failed"]), (2, 6))
+        self.assertEqual([error["row"] for error in report["errors"]], [3, 4, 5, 6, 7, 8])
+        self.assertEqual(report["errors"][0]["error"], "Email address not provided")
+        self.assertEqual(report["errors"][1]["error"], "Username student1 already exists")
+        akinyi = User.objects.get(username="akinyi")
+        self.assertEqual((akinyi.role, akinyi.classroom), (Role.student(), self.classroom))
+        self.assertTrue(akinyi.has_usable_password())
+        self.assertEqual(User.objects.get(username="baraka").role, Role.clerk())
+        self.assertEqual(
+            sorted(row["username"] for row in user_search.search(self.school, "imported")["data"]),
+            ["akinyi", "baraka"])
+
+    def test_each_chunk_is_one_transaction(self):
+        UserImporter(self.school, chunk_size=2).run([self.row("user%s" % n) for n in range(5)])
+        self.assertEqual(Transaction.objects.filter(transaction_type__name="BulkCreateUsers").count(), 3)
+        self.assertEqual(User.objects.filter(last_name="Imported").count(), 5)
+
+    def test_rows_taken_since_validation_are_reported(self):
+        rows = [self.row("akinyi"), self.row("baraka")]
+        importer = UserImporter(self.school)
+        with mock.patch.object(importer, "_existing", return_value=set()):
+            self.make_user("baraka")
+            report = importer.run(rows)
+        self.assertEqual((report["created"], report["failed"]), (1, 1))
+        self.assertEqual(report["errors"][0]["row"], 2)
+
+    def test_queries_do_not_grow_with_the_rows(self):
+        # Warms the registries and the role cache
+        UserImporter(self.school).run([self.row("warm")])
+        counts = []
+        for size in (2, 20):
+            rows = [self.row("size%s-%s" % (size, n)) for n in range(size)]
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(UserImporter(self.school).run(rows)["created"], size)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_endpoint(self):
+        token = self.login(self.make_user("librarian", role=Role.admin()))
+        response = self.post(
+            "users:bulk-create-users", token=token, school_id=str(self.school.id),
+            users=[self.row("akinyi"), self.row("baraka", email="")])
+        self.assertEqual(response["code"], "100.000.000")
+        self.assertEqual((response["data"]["created"], response["data"]["failed"]), (1, 1))
+        csv_file = io.BytesIO(b"username,email,phone_number,first_name,last_name,role_name\n"
+                              b"chege,chege@school.example,0700000000,Chege,Imported,Clerk\n")
+        csv_file.name = "users.csv"
+        response = self.client.post(
+            reverse("users:bulk-create-users"), {"token": token, "school_id": str(self.school.id), "file": csv_file})
+        self.assertEqual(response.json()["data"]["created"], 1)
+        self.assertEqual(User.objects.get(username="chege").role, Role.clerk())
+        with self.settings(BULK_IMPORT_MAX_ROWS=1):
+            response = self.post(
+                "users:bulk-create-users", token=token, school_id=str(self.school.id),
+                users=[self.row("dafina"), self.row("esther")])
+        self.assertEqual(response["error"], "At most 1 users can be imported at once")
+        response = self.post(
+            "users:bulk-create-users", token=self.login(self.students[0]), school_id=str(self.school.id),
+            users=[self.row("dafina")])
+        self.assertEqual(response["code"], "888.888.001")
+        self.assertFalse(User.objects.filter(username__in=["dafina", "esther"]).exists())
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as f:
+            f.write("username,email,phone_number,first_name,last_name,role_name,classroom_id\n")
+            f.write("akinyi,akinyi@school.example,0700000000,Akinyi,Imported,Student,%s\n" % self.classroom.id)
+            f.write("baraka,,0700000000,Baraka,Imported,Clerk,\n")
+        self.addCleanup(os.remove, f.name)
+        out, err = io.StringIO(), io.StringIO()
+        call_command("import_users", f.name, "--school-id", str(self.school.id), stdout=out, stderr=err)
+        self.assertEqual(out.getvalue().strip(), "Created 1 users, 1 rows failed")
+        self.assertEqual(err.getvalue().strip(), "Row 2: Email address not provided")
+
+
+class UserExportTests(SchoolTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.token = self.login(self.make_user("librarian", role=Role.admin()))
+
+    def export(self, **data):
+        response = self.call("users:export-users", token=self.token, school_id=str(self.school.id), **data)
+        return b"".join(response.streaming_content).decode()
+
+    def test_filtered_csv(self):
+        rows = list(csv.DictReader(io.StringIO(self.export(role_name="Student"))))
+        self.assertEqual(sorted(row["username"] for row in rows), ["student1", "student2", "student3"])
+        self.assertEqual({row["role_name"] for row in rows}, {"Student"})
+        self.assertNotIn("password", rows[0])
+
+    def test_ndjson_with_chosen_fields(self):
+        rows = [json.loads(line) for line in self.export(format="ndjson", fields="username,state_name").splitlines()]
+        self.assertEqual(
+            sorted(rows, key=lambda row: row["username"]),
+            [{"username": name, "state_name": "Active"} for name in ("librarian", "student1", "student2", "student3")])
+
+    def test_unknown_fields_are_refused(self):
+        with self.assertLogs("users.views", "ERROR"):
+            response = self.post(
+                "users:export-users", token=self.token, school_id=str(self.school.id), fields="username,password")
+        self.assertEqual(response["error"], "Unknown fields: password")
+
+
+@in_process_hashing
+@mock.patch.object(password_hasher, "workers", 1)
+class PasswordResetterTests(SchoolTestCase):
+
+    def test_passwords_are_reset_and_tokens_revoked(self):
+        for student in self.students:
+            student.set_password("Old-2024")
+            student.save()
+        token = self.login(self.students[0])
+        self.assertIsNotNone(identity_cache.authenticate(token))
+        with self.captureOnCommitCallbacks(execute=True):
+            report = PasswordResetter(chunk_size=2).run(User.objects.filter(id__in=[s.id for s in self.students]))
+        self.assertEqual(report, {"reset": 3, "failed": []})
+        for student in User.objects.filter(id__in=[s.id for s in self.students]):
+            self.assertFalse(student.check_password("Old-2024"))
+            self.assertTrue(student.has_usable_password())
+        self.assertEqual(Identity.objects.get(user=self.students[0]).state, State.expired())
+        self.assertIsNone(identity_cache.authenticate(token))
+        self.assertEqual(Transaction.objects.filter(transaction_type__name="BulkResetPasswords").count(), 2)
+
+    def test_command(self):
+        clerk = self.make_user("clerk", role=Role.clerk())
+        clerk.set_password("Old-2024")
+        clerk.save()
+        out = io.StringIO()
+        call_command("reset_passwords", "--school-id", str(self.school.id), "--role", "Clerk", stdout=out)
+        self.assertEqual(out.getvalue().strip(), "Reset 1 passwords, 0 failed")
+        clerk.refresh_from_db()
+        self.assertFalse(clerk.check_password("Old-2024"))
@@ -2,13 +2,17 @@ from django.urls import re_path
 
 from users.views import UsersAdministration
 
+app_name = 'users'
+
 urlpatterns = [
-    re_path(r'create-super-admin/$', UsersAdministration().create_super_admin),
-    re_path(r'create-admin/$', UsersAdministration().create_admin),
-    re_path(r'create-clerk/$', UsersAdministration().create_clerk),
-    re_path(r'create-student/$', UsersAdministration().create_student),
-    re_path(r'edit-user/$', UsersAdministration().edit_user),
-    re_path(r'get-user/$', UsersAdministration().get_user),
-    re_path(r'filter-users/$', UsersAdministration().filter_users),
-    re_path(r'search-users/$', UsersAdministration().search_users),
-]
\ No newline at end of file
+    re_path(r'create-super-admin/$', UsersAdministration().create_super_admin, name='create-super-admin'),
+    re_path(r'create-admin/$', UsersAdministration().create_admin, name='create-admin'),
+    re_path(r'create-clerk/$', UsersAdministration().create_clerk, name='create-clerk'),
+    re_path(r'create-student/$', UsersAdministration().create_student, name='create-student'),
+    re_path(r'bulk-create-users/$', UsersAdministration().bulk_create_users, name='bulk-create-users'),
+    re_path(r'edit-user/$', UsersAdministration().edit_user, name='edit-user'),
+    re_path(r'get-user/$', UsersAdministration().get_user, name='get-user'),
+    re_path(r'filter-users/$', UsersAdministration().filter_users, name='filter-users'),
+    re_path(r'search-users/$', UsersAdministration().search_users, name='search-users'),
+    re_path(r'export-users/$', UsersAdministration().export_users, name='export-users'),
+]
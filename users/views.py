@@ -1,5 +1,6 @@
 import logging
 
+from django.conf import settings
 from django.db import transaction as trx
 from django.db.models import F
 from django.http import JsonResponse
@@ -7,16 +8,28 @@ from django.views.decorators.csrf import csrf_exempt
 
 from base.backend.services import SchoolService, ClassroomService, StateService
 from base.models import State
+from identities.backend.identity_cache import identity_cache
+from users.backend.bulk_import import UserImporter
 from users.backend.decorators import user_login_required, super_admin, admin
+from users.backend.search import user_search
 from users.backend.services import UserService, RoleService
-from users.models import Role
-from utils.common import generate_password, create_notification_detail
+from users.models import Role, User
+from utils.common import generate_password, create_notification_detail, get_client_ip
+from utils.export import StreamingExport
 from utils.get_request_data import get_request_data
+from utils.pagination import KeysetPaginator
 from utils.transaction_log_base import TransactionLogBase
 
 lgr = logging.getLogger(__name__)
 lgr.propagate = False
 
+user_paginator = KeysetPaginator(
+    fields=(
+        "id", "username", "email", "phone_number", "other_phone_number", "first_name", "last_name", "other_name",
+        "gender", "id_no", "reg_no", "school_id", "classroom_id", "role_name", "state_name"),
+    annotations={"role_name": F("role__name"), "state_name": F("state__name")})
+user_export = StreamingExport("users", fields=user_paginator.fields, annotations=user_paginator.annotations)
+
 class UsersAdministration(TransactionLogBase):
     @csrf_exempt
     @user_login_required
@@ -185,6 +198,41 @@ class UsersAdministration(TransactionLogBase):
             self.mark_transaction_failed(transaction, response=response)
             return JsonResponse(response)
 
+    @csrf_exempt
+    @user_login_required
+    @admin
+    def bulk_create_users(self, request):
+        """
+        Creates users in bulk from a JSON list of users or an uploaded CSV file
+        @params: WSGI Request
+        @return: success message and the number of users created with the errors per row or failure message
+        @rtype: JsonResponse
+        """
+        try:
+            data = get_request_data(request)
+            school_id = data.get("school_id", "")
+            if not school_id:
+                raise Exception("School id not provided")
+            school = SchoolService().get(id=school_id, state=State.active())
+            if not school:
+                raise Exception("School not found")
+            if "file" in request.FILES:
+                rows = UserImporter.parse_csv(request.FILES["file"].read())
+            elif data.get("csv", ""):
+                rows = UserImporter.parse_csv(data.get("csv"))
+            else:
+                rows = data.get("users", [])
+            if not rows or not isinstance(rows, list):
+                raise Exception("Users not provided")
+            if len(rows) > settings.BULK_IMPORT_MAX_ROWS:
+                raise Exception("At most %s users can be imported at once" % settings.BULK_IMPORT_MAX_ROWS)
+            report = UserImporter(school=school, source_ip=get_client_ip(request)).run(rows)
+            return JsonResponse({"code": "100.000.000", "message": "Users imported", "data": report})
+        except Exception as e:
+            lgr.exception("Bulk create users exception: %s" % e)
+            return JsonResponse({
+                "code": "999.999.999", "message": "Bulk create users failed with an exception", "error": str(e)})
+
     @csrf_exempt
     @user_login_required
     def edit_user(self, request):
@@ -207,8 +255,14 @@ class UsersAdministration(TransactionLogBase):
                 if not classroom:
                     raise Exception("Classroom not found")
                 data["classroom"] = classroom
+            data["search_document"] = User.make_search_document(
+                **{field: data.get(field, getattr(user, field)) for field in User.SEARCH_FIELDS})
             if not UserService().update(pk=user.id, **data):
                 raise Exception("User not edited")
+            for school_id in {user.school_id, data.get("school_id", user.school_id)}:
+                trx.on_commit(lambda school_id=school_id: user_search.invalidate(school_id))
+            # A queryset update sends no post_save, so drop the cached role and state here
+            trx.on_commit(lambda: identity_cache.discard_user(user))
             return JsonResponse({"code": "100.000.000", "message": "User edited successfully"})
         except Exception as e:
             lgr.exception("Edit user exception: %s" % e)
@@ -235,6 +289,7 @@ class UsersAdministration(TransactionLogBase):
                 raise Exception("User does not exist")
             if not UserService().update(pk=user.id, classroom=None, state=State.inactive()):
                raise Exception("User not deactivated")
+            trx.on_commit(lambda: identity_cache.discard_user(user))
             notification_msg = "User, username: %s has been deactivated successfully" % user.username
             notification_details = create_notification_detail(
                 message_code="SC0009", message_type="2", message=notification_msg, destination=user.email)
@@ -278,53 +333,90 @@ class UsersAdministration(TransactionLogBase):
     @user_login_required
     def filter_users(self, request):
         """
-        Filters users
-        @params: WSGI Request
-        @return: success message and user data or failure message
+        Filters users, a page at a time
+        @params: WSGI Request, optionally with a cursor (the next_cursor of the previous page), page_size and fields
+        @return: success message, a page of user data and the next cursor or failure message
         @rtype: JsonResponse
         """
         try:
             data = get_request_data(request)
             data.pop("token", "")
             data.pop("user_id", "")
-            school_id = data.pop("school_id", "")
-            if not school_id:
-                raise Exception("School id not provided")
-            school = SchoolService().get(id=school_id, state=State.active())
-            if not school:
-                raise Exception("School not found")
-            data["school"] = school
-            if not school:
-                raise Exception("School not found")
-            if "classroom_id" in data:
-                classroom_id = data.pop("classroom_id", "")
-                classroom = ClassroomService().get(id=classroom_id, state=State.active())
-                data["classroom"] = classroom
-            if "role_name" in data:
-                role_name = data.pop("role_name", "")
-                role = RoleService().get(name=role_name, state=State.active())
-                data["role"] = role
-            if "state_name" in data:
-                state_name = data.pop("state_name", "")
-                state = StateService().get(id=state_name)
-                data["state"] = state
-            users_data = UserService().filter(**data).annotate(role_name=F("role__name")) \
-                .annotate(state__name=F("state__name")).values(
-                "id", "username", "email", "phone_number", "other_phone_number", "first_name", "last_name",
-                "other_name", "gender", "id_no", "reg_no", "school_id", "classroom_id", "role_name", "state_name")
-            users_data = list(users_data)
-            return JsonResponse({"code": "100.000.000", "message": "Successfully filtered users", "data": users_data})
+            cursor = data.pop("cursor", None)
+            fields = data.pop("fields", None)
+            page_size = data.pop("page_size", None)
+            data = self.user_filters(data)
+            page = user_paginator.page(
+                UserService().filter(**data), cursor=cursor, fields=fields, page_size=page_size)
+            return JsonResponse({
+                "code": "100.000.000", "message": "Successfully filtered users", "data": page["data"],
+                "next_cursor": page["next_cursor"]})
         except Exception as e:
             lgr.exception("Filter users exception: %s" % e)
-            return JsonResponse({"code": "999.999.999", "message": "Filter users failed with an exception", "error": e})
+            return JsonResponse({
+                "code": "999.999.999", "message": "Filter users failed with an exception", "error": str(e)})
+
+    @csrf_exempt
+    @user_login_required
+    @admin
+    def export_users(self, request):
+        """
+        Streams a school's users as CSV or JSON lines
+        @params: WSGI Request with the same filters as filter_users, optionally with a format (csv or ndjson) and fields
+        @return: the export as an attachment or failure message
+        @rtype: StreamingHttpResponse | JsonResponse
+        """
+        try:
+            data = get_request_data(request)
+            data.pop("token", "")
+            data.pop("user_id", "")
+            export_format = data.pop("format", None)
+            fields = data.pop("fields", None)
+            data = self.user_filters(data)
+            return user_export.response(
+                UserService().filter(**data), export_format=export_format, fields=fields, suffix=data["school"].code)
+        except Exception as e:
+            lgr.exception("Export users exception: %s" % e)
+            return JsonResponse({
+                "code": "999.999.999", "message": "Export users failed with an exception", "error": str(e)})
+
+    @staticmethod
+    def user_filters(data):
+        """
+        Turns the filters sent to filter_users and export_users into queryset filters
+        @param data: The request data without the token and paging options.
+        @type data: dict
+        @return: The filters for UserService().filter
+        @rtype: dict
+        """
+        school_id = data.pop("school_id", "")
+        if not school_id:
+            raise Exception("School id not provided")
+        school = SchoolService().get(id=school_id, state=State.active())
+        if not school:
+            raise Exception("School not found")
+        data["school"] = school
+        if "classroom_id" in data:
+            classroom_id = data.pop("classroom_id", "")
+            classroom = ClassroomService().get(id=classroom_id, state=State.active())
+            data["classroom"] = classroom
+        if "role_name" in data:
+            role_name = data.pop("role_name", "")
+            role = RoleService().get(name=role_name, state=State.active())
+            data["role"] = role
+        if "state_name" in data:
+            state_name = data.pop("state_name", "")
+            state = StateService().get(name=state_name)
+            data["state"] = state
+        return data
 
     @csrf_exempt
     @user_login_required
     def search_users(self, request):
         """
-        Search users
-        @params: WSGI Request
-        @return: success message and user data or failure message
+        Searches a school's users, best matches first
+        @params: WSGI Request, optionally with a page number and page_size
+        @return: success message, a page of user data and the next page number or failure message
         @rtype: JsonResponse
         """
         try:
@@ -336,16 +428,12 @@ class UsersAdministration(TransactionLogBase):
             school = SchoolService().get(id=school_id, state=State.active())
             if not school:
                 raise Exception("School not found")
-            users_data = UserService().filter(
-                school=school, first_name__icontains=search_word, last_name__icontains=search_word,
-                other_name__icontains=search_word, email__icontains=search_word, phone_number__icontains=search_word,
-                other_phone_number__icontains=search_word, id_no__icontains=search_word, reg_no__icontains=search_word,
-                gender__icontains=search_word).annotate(role_name=F("role__name")) \
-                .annotate(state__name=F("state__name")).values(
-                "id", "username", "email", "phone_number", "other_phone_number", "first_name", "last_name",
-                "other_name", "gender", "id_no", "reg_no", "school_id", "classroom_id", "role_name", "state_name")
-            users_data = list(users_data)
-            return JsonResponse({"code": "100.000.000", "message": "Successfully searched users", "data": users_data})
+            results = user_search.search(
+                school, search_word, page=data.get("page", None), page_size=data.get("page_size", None))
+            return JsonResponse({
+                "code": "100.000.000", "message": "Successfully searched users", "data": results["data"],
+                "next_page": results["next_page"]})
         except Exception as e:
             lgr.exception("Search users exception: %s" % e)
-            return JsonResponse({"code": "999.999.999", "message": "Search users failed with an exception", "error": e})
+            return JsonResponse({
+                "code": "999.999.999", "message": "Search users failed with an exception", "error": str(e)})
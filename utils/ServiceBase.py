@@ -34,6 +34,13 @@ class ServiceBase(object):
             lgr.exception('%s Service create exception: %s' % (self.manager.model.__name__, e))
             return None
 
+    def bulk_create(self, objs, *args, **kwargs):
+        try:
+            return self.manager.bulk_create(objs, *args, **kwargs)
+        except Exception as e:
+            lgr.exception('%s Service bulk_create exception: %s' % (self.manager.model.__name__, e))
+            return None
+
     def update(self, pk, *args, **kwargs):
         try:
             data_to_update = self.filter(id=pk)
@@ -19,6 +19,27 @@ def get_client_ip(request):
     return ip
 
 
+def get_peer_ip(request, trusted_proxies=()):
+    """
+    Fetches the address of the client the request came from, for use in access checks. Unlike get_client_ip it only
+    believes X-Forwarded-For when REMOTE_ADDR is one of the trusted proxies, and then takes the last entry a trusted
+    proxy did not add, since any entries before it are whatever the client chose to send.
+    @param request: The Django HttpRequest.
+    @param trusted_proxies: The addresses of the reverse proxies in front of the application.
+    @type trusted_proxies: list | tuple
+    @return: The client address.
+    @rtype: str
+    """
+    ip = request.META.get('REMOTE_ADDR')
+    if ip not in trusted_proxies:
+        return ip
+    forwarded = [address.strip() for address in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')]
+    for address in reversed([address for address in forwarded if address]):
+        if address not in trusted_proxies:
+            return address
+    return ip
+
+
 def generate_password(length=6):
     """
     This function generates the random passwords for users.
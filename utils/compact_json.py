@@ -0,0 +1,76 @@
+import json
+import logging
+import zlib
+
+from django.conf import settings
+from django.db import models
+
+from utils.common import json_super_serializer
+
+lgr = logging.getLogger(__name__)
+
+
+def clean_payload(value):
+    """
+    Prepares a request or response for storage: keys in AUDIT_REDACTED_KEYS (passwords, tokens) are dropped at any
+    depth, and values that are not JSON types, such as exceptions, become strings.
+    @param value: The payload.
+    @return: The payload as plain JSON types.
+    """
+    redacted = {key.lower() for key in settings.AUDIT_REDACTED_KEYS}
+
+    def clean(item):
+        if isinstance(item, dict):
+            return {str(key): clean(val) for key, val in item.items() if str(key).lower() not in redacted}
+        if isinstance(item, (list, tuple)):
+            return [clean(val) for val in item]
+        if item is None or isinstance(item, (str, int, float, bool)):
+            return item
+        return json_super_serializer(item)
+
+    return clean(value)
+
+
+class CompactJSONField(models.BinaryField):
+    """
+    Stores a JSON value as bytes, compressed with zlib when its JSON is longer than AUDIT_COMPRESS_BYTES.
+    The first byte records how the rest was stored, so compressed and plain rows can live side by side.
+    """
+    PLAIN = b"j"
+    COMPRESSED = b"z"
+
+    def from_db_value(self, value, expression, connection):
+        return self.decode(value)
+
+    def to_python(self, value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return self.decode(value)
+        return value
+
+    def get_prep_value(self, value):
+        if value is None:
+            return None
+        return self.encode(value)
+
+    def value_to_string(self, obj):
+        return json.dumps(self.value_from_object(obj))
+
+    @classmethod
+    def encode(cls, value):
+        data = json.dumps(value, separators=(",", ":"), default=json_super_serializer).encode()
+        if len(data) > settings.AUDIT_COMPRESS_BYTES:
+            return cls.COMPRESSED + zlib.compress(data)
+        return cls.PLAIN + data
+
+    @classmethod
+    def decode(cls, value):
+        if value is None:
+            return None
+        value = bytes(value)
+        try:
+            if value[:1] == cls.COMPRESSED:
+                return json.loads(zlib.decompress(value[1:]))
+            return json.loads(value[1:])
+        except Exception as e:
+            lgr.exception("CompactJSONField decode exception: %s" % e)
+            return None
@@ -8,6 +8,7 @@ lgr = logging.getLogger(__name__)
 def get_request_data(request):
     """
     Retrieves the request data irrespective of the method and type it was send.
+    The body is parsed once per request; every call gets its own copy so callers can pop keys freely.
     @param request: The Django HttpRequest.
     @type request: WSGIRequest
     @return: The data from the request as a dict
@@ -17,6 +18,9 @@ def get_request_data(request):
     try:
         data = None
         if request is not None:
+            parsed_data = getattr(request, '_parsed_request_data', None)
+            if parsed_data is not None:
+                return parsed_data.copy()
             request_meta = getattr(request, 'META', {})
             request_method = getattr(request, 'method', None)
             if request_meta.get('CONTENT_TYPE', '') == 'application/json':
@@ -37,7 +41,8 @@ def get_request_data(request):
                     data = json.loads(request_body)
                 else:
                     data = QueryDict()
-            return data
+            request._parsed_request_data = data
+            return data.copy()
     except Exception as e:
         lgr.exception('get_request_data Exception: %s', e)
     return QueryDict()
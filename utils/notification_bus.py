@@ -0,0 +1,168 @@
+import base64
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from utils.common import json_super_serializer
+
+lgr = logging.getLogger(__name__)
+
+
+class NotificationBusError(Exception):
+    pass
+
+
+def encode_files(files):
+    """
+    Turns attachments into JSON types so they can be queued in the notification outbox.
+    @param files: Attachments, in the form requests takes for a multipart upload: a dict or a list of (field, value)
+    pairs, the value being a file, the content or a (file name, file or content[, content type]) tuple.
+    @type files: dict | list | None
+    @return: A [field, file name, base64 content, content type] list per attachment, or None without attachments.
+    @rtype: list | None
+    """
+    if not files:
+        return None
+    encoded = []
+    for field, value in (files.items() if isinstance(files, dict) else files):
+        name, content_type = getattr(value, "name", field), None
+        if isinstance(value, (tuple, list)):
+            name, content_type, value = value[0], value[2] if len(value) > 2 else None, value[1]
+        if hasattr(value, "read"):
+            value = value.read()
+        if isinstance(value, str):
+            value = value.encode()
+        encoded.append([str(field), str(name), base64.b64encode(value).decode(), content_type])
+    return encoded
+
+
+def decode_files(attachments):
+    """
+    Rebuilds attachments queued by encode_files for a multipart upload.
+    @param attachments: The attachments as stored in the outbox.
+    @type attachments: list | None
+    @return: (field, (file name, content, content type)) pairs, or None without attachments.
+    @rtype: list | None
+    """
+    if not attachments:
+        return None
+    return [
+        (field, (name, base64.b64decode(content), content_type)) for field, name, content, content_type in attachments]
+
+
+class NotificationBusClient(object):
+    """
+    Client for the Notifications Bus. Requests go through a keep-alive session holding up to BUS_POOL_SIZE
+    connections, and the bus access token is fetched once and reused until it expires or the bus rejects a message.
+    """
+
+    def __init__(self, pool_size=None):
+        self.pool_size = pool_size or settings.BUS_POOL_SIZE
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._token = None
+        self._token_expires_at = 0
+        self._lock = threading.Lock()
+
+    def access_token(self):
+        """
+        Fetches the cached bus access token, requesting a new one when it has expired.
+        @return: The bus access token.
+        @rtype: str
+        """
+        with self._lock:
+            if self._token and time.monotonic() < self._token_expires_at:
+                return self._token
+            response = self._post("get_access_token", data={
+                "username": settings.BUS_USERNAME,
+                "client_id": settings.CLIENT_ID,
+                "client_secret": settings.CLIENT_SECRET
+            })
+            token = response.get("data", {}).get("token", None)
+            if not token:
+                raise NotificationBusError("Bus access token not issued")
+            expires_in = response.get("data", {}).get("expires_in", None) or settings.BUS_TOKEN_TTL_SECONDS
+            self._token = token
+            # Renew a little early so a token never expires between being read here and reaching the bus
+            self._token_expires_at = time.monotonic() + max(int(expires_in) - 30, 0)
+            return token
+
+    def invalidate_token(self):
+        with self._lock:
+            self._token = None
+            self._token_expires_at = 0
+
+    def send(self, notification, files=None):
+        """
+        Sends a single notification through the bus.
+        @param notification: The notification as built by create_notification_detail.
+        @type notification: dict
+        @param files: Attachments, in the form requests takes for a multipart upload. Defaults to the notification's
+        files.
+        @type files: dict | list | None
+        @return: The bus confirmation code.
+        @rtype: str
+        """
+        payload = dict(notification)
+        queued_files = payload.pop("files", None)
+        files = queued_files if files is None else files
+        payload["token"] = self.access_token()
+        payload["client_id"] = settings.CLIENT_ID
+        payload["app_code"] = settings.APP_CODE
+        payload["replace_tags"] = json.dumps(payload.get("replace_tags", {}), default=json_super_serializer)
+        response = self._post("send_message", data=payload, files=files)
+        confirmation_code = response.get("data", {}).get("confirmation_code", None)
+        if confirmation_code is None:
+            # The bus does not tell an expired token apart from other rejections, so start afresh next time
+            self.invalidate_token()
+            raise NotificationBusError("Message not accepted: %s" % response)
+        return confirmation_code
+
+    def send_many(self, notifications, threads=None):
+        """
+        Sends a list of notifications over the pooled connections with a single token fetch.
+        @param notifications: The notifications as built by create_notification_detail.
+        @type notifications: list
+        @param threads: Concurrent requests, capped at the connection pool size.
+        @type threads: int
+        @return: A (confirmation_code, error) pair per notification, in input order.
+        @rtype: list
+        """
+        if not notifications:
+            return []
+        try:
+            self.access_token()
+        except Exception as e:
+            lgr.warning("NotificationBusClient - access token not fetched: %s" % e)
+            return [(None, e)] * len(notifications)
+        threads = min(threads or self.pool_size, self.pool_size, len(notifications))
+        if threads == 1:
+            return [self._send_safely(notification) for notification in notifications]
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            return list(executor.map(self._send_safely, notifications))
+
+    def _send_safely(self, notification):
+        try:
+            return self.send(notification), None
+        except Exception as e:
+            return None, e
+
+    def _post(self, endpoint, data, files=None):
+        response = self.session.post(
+            url="%s/api/%s/" % (settings.BUS_URL, endpoint), data=data, files=files, verify=settings.BUS_VERIFY_SSL,
+            timeout=settings.BUS_TIMEOUT_SECONDS)
+        try:
+            return response.json()
+        except ValueError:
+            raise NotificationBusError("Invalid response from %s: HTTP %s" % (endpoint, response.status_code))
+
+
+notification_bus = NotificationBusClient()
@@ -0,0 +1,141 @@
+import base64
+import json
+import logging
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+lgr = logging.getLogger(__name__)
+
+
+def page_number(page):
+    """
+    Reads a 1-based page number sent by a client.
+    @param page: The page number, defaults to the first page.
+    @type page: int | str | None
+    @return: The page number.
+    @rtype: int
+    """
+    try:
+        page = int(page or 1)
+    except (TypeError, ValueError):
+        raise Exception("Invalid page")
+    if page < 1:
+        raise Exception("Invalid page")
+    return page
+
+
+def projection(fields, allowed):
+    """
+    Resolves the fields requested by a client against the fields it may have.
+    @param fields: The requested fields, as a list or a comma separated string.
+    @type fields: list | str | None
+    @param allowed: The fields that may be requested, all of them returned when none are.
+    @type allowed: tuple
+    @return: The fields to select.
+    @rtype: list
+    """
+    if not fields:
+        return list(allowed)
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    fields = list(dict.fromkeys(str(field).strip() for field in fields if str(field).strip()))
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise Exception("Unknown fields: %s" % ", ".join(unknown))
+    return fields or list(allowed)
+
+
+class KeysetPaginator(object):
+    """
+    Pages through a queryset newest first on (date_created, id).
+    Each page continues from the last row of the previous one (the cursor) instead of an OFFSET, so fetching a page
+    costs the same index range scan however deep into the results it is. Only the requested fields are selected and
+    the page size is capped at PAGINATION_MAX_PAGE_SIZE.
+    """
+
+    def __init__(self, fields, annotations=None):
+        """
+        @param fields: The fields a page may contain, returned when the caller does not pick any.
+        @type fields: tuple
+        @param annotations: Expressions for the fields that are not columns of the model, keyed by field name.
+        @type annotations: dict
+        """
+        self.fields = tuple(fields)
+        self.annotations = annotations or {}
+
+    def page(self, queryset, cursor=None, fields=None, page_size=None):
+        """
+        Fetches one page of the queryset.
+        @param queryset: The filtered queryset to page through.
+        @type queryset: QuerySet
+        @param cursor: The next_cursor of the previous page, or None for the first page.
+        @type cursor: str | None
+        @param fields: The fields to return, as a list or a comma separated string. Defaults to all the fields.
+        @type fields: list | str | None
+        @param page_size: The number of rows to return.
+        @type page_size: int | str | None
+        @return: The rows of the page and the cursor of the next page, None on the last page.
+        @rtype: dict
+        """
+        fields = self.projection(fields)
+        page_size = self.page_size(page_size)
+        queryset = queryset.order_by("-date_created", "-id")
+        if cursor:
+            date_created, last_id = self.decode(cursor)
+            queryset = queryset.filter(
+                Q(date_created__lt=date_created) | Q(date_created=date_created, id__lt=last_id))
+        queryset = queryset.annotate(**{
+            field: expression for field, expression in self.annotations.items() if field in fields})
+        keys = [key for key in ("date_created", "id") if key not in fields]
+        rows = list(queryset.values(*fields, *keys)[:page_size + 1])
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = self.encode(rows[-1]["date_created"], rows[-1]["id"])
+        for row in rows:
+            for key in keys:
+                row.pop(key)
+        return {"data": rows, "next_cursor": next_cursor}
+
+    def projection(self, fields):
+        """
+        Resolves the fields requested by the client.
+        @param fields: The requested fields, as a list or a comma separated string.
+        @type fields: list | str | None
+        @return: The fields to select.
+        @rtype: list
+        """
+        return projection(fields, self.fields)
+
+    @staticmethod
+    def page_size(page_size):
+        if page_size in (None, ""):
+            return settings.PAGINATION_DEFAULT_PAGE_SIZE
+        try:
+            page_size = int(page_size)
+        except (TypeError, ValueError):
+            raise Exception("Invalid page size")
+        if page_size < 1:
+            raise Exception("Invalid page size")
+        return min(page_size, settings.PAGINATION_MAX_PAGE_SIZE)
+
+    @staticmethod
+    def encode(date_created, last_id):
+        value = json.dumps([date_created.isoformat(), str(last_id)])
+        return base64.urlsafe_b64encode(value.encode()).decode().rstrip("=")
+
+    @staticmethod
+    def decode(cursor):
+        try:
+            cursor = str(cursor)
+            value = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            date_created, last_id = json.loads(value)
+            date_created = parse_datetime(date_created)
+            if date_created is None:
+                raise ValueError(cursor)
+            return date_created, last_id
+        except Exception as e:
+            lgr.warning("KeysetPaginator - invalid cursor %s: %s" % (cursor, e))
+            raise Exception("Invalid cursor")
@@ -0,0 +1,97 @@
+import logging
+import threading
+
+from django.db import connection, transaction
+
+from utils.shared_version import SharedVersion
+
+lgr = logging.getLogger(__name__)
+
+
+class ModelRegistry(object):
+    """
+    Process-wide name -> instance lookup for small, near static tables such as State.
+    The registry is warmed with a single query and cleared when a row is changed or deleted; a new row changes none of
+    the registered ones, so it is just looked up when first asked for. Clearing also bumps a version shared through
+    the Django cache, so the other workers reload the table on their next version check.
+    It is never warmed inside an atomic block, where it could pick up rows the block wrote and later rolls back; such
+    lookups read the one row they need instead.
+    """
+
+    def __init__(self, model, key="name"):
+        self.model = model
+        self.key = key
+        self._entries = {}
+        self._warm = False
+        self._version = SharedVersion("registry:%s:version" % model._meta.label_lower)
+        self._loaded_version = None
+        self._table_exists = False
+        self._lock = threading.Lock()
+
+    def warm(self):
+        """
+        Loads every row of the model into the registry.
+        @return: The number of rows loaded.
+        @rtype: int
+        """
+        try:
+            if not self.table_exists():
+                # Before migrate has created the table, e.g. while checks run against a fresh database
+                return 0
+            version = self._version.get()
+            entries = {getattr(instance, self.key): instance for instance in self.model.objects.all()}
+            with self._lock:
+                self._entries = entries
+                self._warm = True
+                self._loaded_version = version
+            return len(entries)
+        except Exception as e:
+            lgr.exception("%s registry warm exception: %s" % (self.model.__name__, e))
+        return 0
+
+    def get(self, name, **kwargs):
+        """
+        Fetches the instance registered under the given name, creating the row if it does not exist.
+        Rows created inside an atomic block are only registered once the block commits.
+        @param name: The value of the registry key field.
+        @type name: str
+        @param kwargs: Extra field values used when the row has to be created.
+        @return: The model instance, or None before the table exists.
+        """
+        if not self._warm or self._loaded_version != self._version.get():
+            if connection.in_atomic_block:
+                if not self.table_exists():
+                    return None
+                return self._lookup(name, kwargs)
+            self.warm()
+            if not self._warm:
+                return None
+        instance = self._entries.get(name)
+        if instance is not None:
+            return instance
+        return self._lookup(name, kwargs)
+
+    def clear(self):
+        """
+        Drops every registered instance so the next lookup reloads the table, in this worker at once and in the
+        others once the change is committed.
+        """
+        with self._lock:
+            self._entries = {}
+            self._warm = False
+        transaction.on_commit(self._version.bump)
+
+    def table_exists(self):
+        # Tables are not dropped while a worker runs, so the introspection query is only repeated until it succeeds
+        if not self._table_exists:
+            self._table_exists = self.model._meta.db_table in connection.introspection.table_names()
+        return self._table_exists
+
+    def _lookup(self, name, kwargs):
+        instance, created = self.model.objects.get_or_create(**{self.key: name}, defaults=kwargs)
+        transaction.on_commit(lambda: self._register(instance))
+        return instance
+
+    def _register(self, instance):
+        with self._lock:
+            self._entries[getattr(instance, self.key)] = instance
@@ -0,0 +1,231 @@
+import bisect
+import logging
+import re
+import threading
+
+from utils.shared_version import SharedVersion
+
+lgr = logging.getLogger(__name__)
+
+
+class NgramIndex(object):
+    """
+    An in-memory n-gram index over short text documents.
+    Every word of a document is split into overlapping n-grams and each n-gram maps to the documents containing it, so
+    a query term only has to be checked against the documents sharing all of its n-grams instead of every document.
+    """
+    WORD = re.compile(r"\S+")
+
+    def __init__(self, n=3):
+        self.n = n
+        self.documents = {}
+        self.postings = {}
+
+    def grams(self, word):
+        """
+        Splits a word into its n-grams.
+        @param word: The lower cased word.
+        @type word: str
+        @return: The distinct n-grams of the word, or the word itself when it is shorter than n.
+        @rtype: set
+        """
+        if len(word) <= self.n:
+            return {word}
+        return {word[i:i + self.n] for i in range(len(word) - self.n + 1)}
+
+    def add(self, key, document):
+        """
+        Indexes a document, replacing any document already indexed under the key.
+        @param key: The document's key, e.g. a primary key.
+        @param document: The document's text.
+        @type document: str
+        """
+        self.remove(key)
+        words = self.WORD.findall(str(document or "").lower())
+        self.documents[key] = words
+        for word in words:
+            for gram in self.grams(word):
+                self.postings.setdefault(gram, set()).add(key)
+
+    def remove(self, key):
+        """
+        Drops a document from the index.
+        @param key: The document's key.
+        """
+        words = self.documents.pop(key, None)
+        if not words:
+            return
+        for word in words:
+            for gram in self.grams(word):
+                keys = self.postings.get(gram)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.postings[gram]
+
+    def search(self, query):
+        """
+        Finds the documents containing every term of the query, best matches first.
+        A term matching a whole word scores higher than one matching the start of a word, which in turn scores higher
+        than one matching inside a word. Shorter words score higher as more of them is matched.
+        @param query: The search text.
+        @type query: str
+        @return: (key, score) pairs ordered by descending score.
+        @rtype: list
+        """
+        terms = self.WORD.findall(str(query or "").lower())
+        if not terms:
+            return []
+        candidates = None
+        for term in sorted(terms, key=len, reverse=True):
+            candidates = self._candidates(term, candidates)
+            if not candidates:
+                return []
+        results = []
+        for key in candidates:
+            score = 0.0
+            for term in terms:
+                term_score = max(self._score(term, word) for word in self.documents[key])
+                if not term_score:
+                    break
+                score += term_score
+            else:
+                results.append((key, score / len(terms)))
+        results.sort(key=lambda result: result[1], reverse=True)
+        return results
+
+    def _candidates(self, term, candidates):
+        if len(term) < self.n:
+            # Too short to have an n-gram of its own, so check the words directly
+            pool = candidates if candidates is not None else self.documents.keys()
+            return {key for key in pool if any(term in word for word in self.documents[key])}
+        matches = None
+        for gram in sorted(self.grams(term), key=lambda g: len(self.postings.get(g, ()))):
+            keys = self.postings.get(gram)
+            if not keys:
+                return set()
+            matches = set(keys) if matches is None else matches & keys
+            if candidates is not None:
+                matches &= candidates
+            if not matches:
+                return set()
+        return matches
+
+    @staticmethod
+    def _score(term, word):
+        position = word.find(term)
+        if position < 0:
+            return 0.0
+        coverage = len(term) / len(word)
+        if position == 0:
+            return 1.0 + coverage if coverage == 1 else 0.5 + coverage
+        return coverage
+
+
+class PrefixIndex(object):
+    """
+    An in-memory index of the words of short text documents kept in sorted order, for type-ahead search.
+    The words starting with a query term sit next to each other, so each term is a binary search plus a scan over the
+    words it actually matches. The index is built once from all the documents and never changed afterwards.
+    """
+    WORD = re.compile(r"\S+")
+
+    def __init__(self, documents):
+        """
+        @param documents: (key, document text) pairs, the key being e.g. a primary key.
+        @type documents: iterable
+        """
+        self.entries = sorted(
+            (word, key) for key, document in documents for word in set(self.WORD.findall(str(document or "").lower())))
+
+    def search(self, query):
+        """
+        Finds the documents having a word starting with every term of the query, best matches first.
+        A term matching a whole word scores higher than one matching the start of a longer word.
+        @param query: The search text.
+        @type query: str
+        @return: (key, score) pairs ordered by descending score.
+        @rtype: list
+        """
+        terms = set(self.WORD.findall(str(query or "").lower()))
+        if not terms:
+            return []
+        scores = None
+        for term in terms:
+            term_scores = {}
+            for position in range(bisect.bisect_left(self.entries, (term,)), len(self.entries)):
+                word, key = self.entries[position]
+                if not word.startswith(term):
+                    break
+                if scores is not None and key not in scores:
+                    continue
+                score = 2.0 if word == term else 1.0 + len(term) / len(word)
+                term_scores[key] = max(score, term_scores.get(key, 0.0))
+            scores = term_scores if scores is None else {
+                key: score + term_scores[key] for key, score in scores.items() if key in term_scores}
+            if not scores:
+                return []
+        results = [(key, score / len(terms)) for key, score in scores.items()]
+        results.sort(key=lambda result: result[1], reverse=True)
+        return results
+
+
+class SchoolSearchIndexes(object):
+    """
+    Per-school in-memory search indexes shared by the workers through a SharedVersion per school.
+    Each worker keeps the index it last built for a school and rebuilds it once the school's version moves, which
+    invalidate() does whenever the indexed documents change.
+    """
+
+    def __init__(self, name, build):
+        """
+        @param name: The name the versions are cached under.
+        @type name: str
+        @param build: Builds the index of a school, given the school id.
+        @type build: callable
+        """
+        self.name = name
+        self.build = build
+        self._indexes = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def version_key(self, school_id):
+        return "%s:version:%s" % (self.name, school_id)
+
+    def version(self, school_id):
+        """
+        @return: The shared version of the school's documents.
+        @rtype: SharedVersion
+        """
+        version = self._versions.get(school_id)
+        if version is None:
+            with self._lock:
+                version = self._versions.setdefault(school_id, SharedVersion(self.version_key(school_id)))
+        return version
+
+    def invalidate(self, school_id):
+        """
+        Marks the school's documents as changed so every worker rebuilds its index on the next search.
+        @param school_id: The school whose documents changed.
+        """
+        self.version(school_id).bump()
+
+    def get(self, school_id):
+        """
+        Fetches the index of a school, building it when it is missing or out of date.
+        @param school_id: The school whose index we are fetching.
+        @return: The school's index.
+        @rtype: NgramIndex | PrefixIndex
+        """
+        version = self.version(school_id).get()
+        cached = self._indexes.get(school_id)
+        if cached and cached[0] == version:
+            return cached[1]
+        with self._lock:
+            cached = self._indexes.get(school_id)
+            if cached and cached[0] == version:
+                return cached[1]
+            index = self.build(school_id)
+            self._indexes[school_id] = (version, index)
+            return index
@@ -0,0 +1,61 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+lgr = logging.getLogger(__name__)
+
+
+class SharedVersion(object):
+    """
+    A version number kept in the Django cache that every worker moves on from when it is bumped.
+    Each worker keeps the last version it read and only goes back to the cache backend once that copy is
+    CACHE_VERSION_CHECK_SECONDS old, so reading the version on a hot path does not touch the backend every time.
+    A bump is seen at once by the worker that made it and within the check interval by the others.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self._value = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Fetches the current version, seeding it when the cache has none.
+        The seed is time based so a flushed cache never hands out a version a worker has already seen.
+        @return: The current version.
+        @rtype: int
+        """
+        now = time.monotonic()
+        if self._value is not None and now - self._checked_at < settings.CACHE_VERSION_CHECK_SECONDS:
+            return self._value
+        try:
+            value = cache.get(self.key)
+            if value is None:
+                cache.add(self.key, int(time.time() * 1000), timeout=None)
+                value = cache.get(self.key)
+        except Exception as e:
+            lgr.exception("SharedVersion %s get exception: %s" % (self.key, e))
+            value = None
+        with self._lock:
+            # Without a cache backend the worker keeps its own version, which bump still moves on
+            self._value = value if value is not None else (self._value or 0)
+            self._checked_at = now
+            return self._value
+
+    def bump(self):
+        """
+        Moves every worker on to a new version.
+        """
+        try:
+            cache.incr(self.key)
+        except ValueError:
+            cache.add(self.key, int(time.time() * 1000), timeout=None)
+        except Exception as e:
+            lgr.exception("SharedVersion %s bump exception: %s" % (self.key, e))
+        with self._lock:
+            self._value = (self._value or 0) + 1
+            self._checked_at = 0.0
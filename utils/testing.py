@@ -0,0 +1,75 @@
+import json
+
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from base.models import State, School, Classroom, Subject, state_registry, transaction_type_registry, \
+    notification_type_registry
+from identities.models import Identity
+from users.backend.role_cache import role_cache
+from users.models import Role, User
+
+
+class SchoolFixtures(object):
+    """
+    Builds a school with a classroom and a few students. The cache, the registries and the role cache are reset first,
+    as the rows they hold from an earlier test were rolled back with it.
+    """
+
+    def setUp(self):
+        cache.clear()
+        for registry in (state_registry, transaction_type_registry, notification_type_registry):
+            registry.clear()
+        role_cache.bump()
+        self.school = School.objects.create(name="Test School", code="test-school", state=State.active())
+        self.subject = Subject.objects.create(name="English", state=State.active())
+        self.classroom = Classroom.objects.create(name="Form 1A", school=self.school, state=State.active())
+        self.students = [self.make_user("student%s" % n) for n in range(1, 4)]
+
+    def make_user(self, username, email=None, role=None, **kwargs):
+        role = role or Role.student()
+        if role == Role.student():
+            kwargs.setdefault("classroom", self.classroom)
+        values = {"first_name": username.title(), "last_name": "Test", "school": self.school, "state": State.active()}
+        values.update(kwargs)
+        return User.objects.create(
+            username=username, email=email if email is not None else "%s@school.example" % username, role=role,
+            **values)
+
+    @staticmethod
+    def login(user):
+        """
+        @return: An active access token for the user, as login hands it out.
+        @rtype: str
+        """
+        return str(Identity.objects.create(user=user, state=State.active()).token)
+
+    def call(self, name, token=None, **data):
+        """
+        Posts JSON to the endpoint with the given namespaced URL name.
+        @rtype: HttpResponse
+        """
+        if token:
+            data["token"] = token
+        return self.client.post(reverse(name), data=json.dumps(data), content_type="application/json")
+
+    def post(self, name, token=None, **data):
+        """
+        @return: The decoded JSON response of call().
+        @rtype: dict
+        """
+        return self.call(name, token=token, **data).json()
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class SchoolTestCase(SchoolFixtures, TestCase):
+    pass
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class SchoolTransactionTestCase(SchoolFixtures, TransactionTestCase):
+    """
+    For tests that need the registries, the role cache and on-commit work to behave as they do outside a test
+    transaction, such as query budgets.
+    """
@@ -1,5 +1,6 @@
 import base64
 import binascii
+import hashlib
 import os
 from datetime import datetime, timedelta
 from django.conf import settings
@@ -21,6 +22,17 @@ def generate_token():
 	return None
 
 
+def hash_token(token):
+	"""
+	Computes the fixed length digest used to look up and cache an access token.
+	@param token: The access token as sent by the client.
+	@type token: str | bytes
+	@return: The hex encoded SHA-256 digest of the token.
+	@rtype: str
+	"""
+	return hashlib.sha256(str(token).encode("utf-8")).hexdigest()
+
+
 def token_expiry():
 	"""
 	callable functions for generating an expiry time for an access_token
@@ -1,16 +1,16 @@
 import json
 import logging
-import time
-from threading import Thread
 
-import requests
 from django.conf import settings
+from django.utils import timezone
 
-from base.backend.services import TransactionService, TransactionTypeService, NotificationTypeService, \
-    NotificationService
-from base.models import State
+from base.backend.audit_writer import audit_writer
+from base.backend.services import NotificationService
+from base.models import State, Notification, Transaction, transaction_type_registry, notification_type_registry
 from utils.common import json_super_serializer, get_client_ip
+from utils.compact_json import clean_payload
 from utils.get_request_data import get_request_data
+from utils.notification_bus import encode_files
 
 lgr = logging.getLogger(__name__)
 
@@ -39,14 +39,15 @@ class TransactionLogBase(object):
         """
         Logs a transaction of the given type having the provided arguments.
         If transaction reference is not passed, it's generated. Same case for state, defaults to Active.
+        The transaction is handed to the audit writer, which stores it with the next batch.
         @param transaction_type: The name of the type of transaction we are creating.
         @type transaction_type: str
         @param kwargs: Key word arguments to generate the transaction with.
-        @return: The created transaction.
+        @return: The logged transaction.
         @rtype: Transaction | None
         """
         try:
-            transaction_type, created = TransactionTypeService().get_or_create(name=transaction_type)
+            transaction_type = transaction_type_registry.get(transaction_type)
             if not transaction_type:
                 return None
             kwargs.setdefault("state", State.active())
@@ -56,7 +57,8 @@ class TransactionLogBase(object):
                 data = get_request_data(request)
                 kwargs.setdefault("source_ip", get_client_ip(request))
                 kwargs["request"] = data
-            return TransactionService().create(transaction_type=transaction_type, **kwargs)
+            transaction = Transaction(transaction_type=transaction_type, **TransactionLogBase.clean_payloads(kwargs))
+            return audit_writer.write(transaction)
         except Exception as e:
             lgr.exception('TransactionLogBase log_transaction Exception: %s', e)
         return None
@@ -73,8 +75,8 @@ class TransactionLogBase(object):
         try:
             kwargs.setdefault("state", State.completed())
             notifications = kwargs.pop("notification_details", [])
-            # Thread(target=self.send_notification, args=(notifications, transaction)).start()
-            return TransactionService().update(pk=transaction.id, **kwargs)
+            self.send_notification(notifications, transaction)
+            return self.update_transaction(transaction, **kwargs)
         except Exception as e:
             lgr.exception('TransactionLogBase complete_transaction Exception: %s', e)
         return None
@@ -91,17 +93,51 @@ class TransactionLogBase(object):
         try:
             kwargs.setdefault("state", State.failed())
             notifications = kwargs.pop('notification_details', [])
-            # Thread(target=self.send_notification, args=(notifications, transaction)).start()
-            return TransactionService().update(pk=transaction.id, **kwargs)
+            self.send_notification(notifications, transaction)
+            return self.update_transaction(transaction, **kwargs)
         except Exception as e:
             lgr.exception('TransactionLogBase mark_transaction_failed Exception: %s', e)
         return None
 
+    @staticmethod
+    def update_transaction(transaction, **kwargs):
+        """
+        Sets the given fields on a logged transaction and hands it back to the audit writer.
+        @param transaction: The transaction we are updating.
+        @type transaction: Transaction
+        @param kwargs: The fields to set.
+        @return: The transaction updated.
+        @rtype: Transaction
+        """
+        for field, value in TransactionLogBase.clean_payloads(kwargs).items():
+            setattr(transaction, field, value)
+        return audit_writer.write(transaction)
+
+    @staticmethod
+    def clean_payloads(kwargs):
+        """
+        Redacts the request and response about to be stored and records the response's code alongside them so
+        transactions can be filtered on it.
+        @param kwargs: The transaction fields being set.
+        @type kwargs: dict
+        @return: The fields to set.
+        @rtype: dict
+        """
+        for field in ("request", "response"):
+            if field in kwargs:
+                kwargs[field] = clean_payload(kwargs[field]) or None
+        response = kwargs.get("response", None)
+        if isinstance(response, dict) and response.get("code", None):
+            kwargs["response_code"] = str(response["code"])[:20]
+        return kwargs
+
     @staticmethod
     def send_notification(notifications, trans=None):
         """
-        Sends notifications through the Notifications Bus. The notifications are passed in as a list of dictionaries
-        which it then evaluates and makes the http calls
+        Queues notifications for the Notifications Bus. The notifications are passed in as a list of dictionaries
+        which are stored in the notification outbox in one insert; the run_notification_worker command sends them.
+        Queuing inside the caller's database transaction means notifications are only sent if it commits. Files are
+        queued along with their notification, see encode_files.
         @param notifications: list of dictionaries for notifications to be sent
         @type notifications: list
         @param trans: The transaction that the notifications are sent against
@@ -114,11 +150,9 @@ class TransactionLogBase(object):
                 return None
             if not settings.SEND_NOTIFICATIONS:
                 return 'success'
-            access_token_data = {
-                'username': settings.BUS_USERNAME,
-                'client_id': settings.CLIENT_ID,
-                'client_secret': settings.CLIENT_SECRET
-            }
+            now = timezone.now()
+            queued = []
+            system_notification = False
             for notification in notifications:
                 if notification['message_type'] == '1':
                     notification_name = 'SMS'
@@ -126,59 +160,26 @@ class TransactionLogBase(object):
                     notification_name = 'EMAIL'
                 else:
                     notification_name = 'SYS'
-                notification_type = NotificationTypeService().get(name=notification_name)
+                notification_type = notification_type_registry.get(notification_name)
                 message = json.dumps(notification.get('replace_tags', ''), default=json_super_serializer)
-                files = notification.get('files', None)
-                destination = notification.get('destination', '')
-                noti = NotificationService().create(
-                    notification_type=notification_type, title=notification.get('message_code', ''), message=message,
-                    destination=destination, state=State.sent())
-                if not noti:
-                    return 'Notifications Down'
                 if notification_name != 'SYS':
-                    resp = json.loads(
-                        requests.post(
-                            url='%s/api/%s/' % (settings.BUS_URL, 'get_access_token'),
-                            data=access_token_data, verify=False, timeout=None).text)
-                    access_token = resp.get('data', {}).get('token', None)
-                    if access_token is None:
-                        time.sleep(20)
-                        resp = json.loads(
-                            requests.post(
-                                url='%s/api/%s/' % (settings.BUS_URL, 'get_access_token'),
-                                data=access_token_data, verify=False, timeout=None).text)
-                        access_token = resp.get('data', {}).get('token', '')
-                    if access_token is None:
-                        continue
-                    notification['token'] = access_token
-                    notification['client_id'] = settings.CLIENT_ID
-                    notification['app_code'] = settings.APP_CODE
-                    notification['replace_tags'] = json.dumps(
-                        notification['replace_tags'], default=json_super_serializer)
-                    if files:
-                        notification_response = json.loads(
-                            requests.post(
-                                url='%s/api/%s/' % (settings.BUS_URL, 'send_message'), data=notification,
-                                verify=False, files=files, timeout=None).text)
-                    else:
-                        notification_response = json.loads(requests.post(
-                            url='%s/api/%s/' % (settings.BUS_URL, 'send_message'), data=notification,
-                            verify=False, timeout=None).text)
-                    notification_response = notification_response.get('data', {}).get('confirmation_code', None)
-                    if notification_response is None:
-                        continue
-                    if trans is not None:
-                        notification_responses = getattr(trans, 'notification_response', None)
-                        if notification_responses is not None:
-                            notification_responses = notification_responses + "|%s" % notification_response
-                        else:
-                            notification_responses = notification_response
-                        TransactionService().update(trans.id,  notification_response=notification_responses)
+                    state = State.pending()
+                    next_attempt_at = now
                 else:
-                    if trans is not None:
-                        notification_responses = 'Sent'
-                        TransactionService().update(trans.id, notification_response=notification_responses)
+                    state = State.sent()
+                    next_attempt_at = None
+                    system_notification = True
+                queued.append(Notification(
+                    notification_type=notification_type, title=notification.get('message_code', ''),
+                    message=message, destination=notification.get('destination', ''), transaction=trans,
+                    attachments=encode_files(notification.get('files', None)), state=state,
+                    next_attempt_at=next_attempt_at))
+            if not NotificationService().bulk_create(queued):
+                return 'Notifications Down'
+            if system_notification and trans is not None:
+                # Written with the transaction by the complete/failed call that queued the notifications
+                trans.notification_response = 'Sent'
             return 'success'
         except Exception as e:
             lgr.exception("TransactionLogBase send_notification: %s", e)
-        return None
\ No newline at end of file
+        return None